@@ -0,0 +1,304 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+End-to-end benchmark of the backup against the local Salt Portal stand-in.
+
+Each configuration is run repeat times to a new database, and the median of the runs is
+reported: duration, stations and measurements per second, requests per second, MB
+downloaded and the time spent writing to the database. Examples:
+
+    python benchmarks/bench_backup.py
+    python benchmarks/bench_backup.py --stations 20 --latency 0.05 -w 1 -w 8 --engine async
+    python benchmarks/bench_backup.py --json results.json
+    python benchmarks/bench_backup.py --etags --http_cache
+    python benchmarks/bench_backup.py --samples 5000 --parse_series -w 8 -p 0 -p 4
+
+With --http_cache the runs of a configuration share one HTTP cache, the first run fills the
+cache and is reported as cold, the median is of the following runs.
+
+The database write time is the sum of the db_write and db_commit phases of the run
+statistics, see salt_portal_backup.instrumentation.
+"""
+
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+sys.path.insert(0, str(Path(__file__).parent))
+from portal_standin import PortalStandin, serve  # noqa: E402
+
+
+def run_once(portal, engine, max_workers, max_concurrency, backup_kwargs, i_run):
+    from salt_portal_backup import run_backup, run_backup_async
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database_path = str(Path(tmp_dir) / f"bench_{i_run}.db")
+        requests_before = portal.requests
+        start = time.perf_counter()
+        if engine == "async":
+            stats = asyncio.run(
+                run_backup_async(
+                    "standin",
+                    "standin",
+                    database_path,
+                    max_concurrency=max_concurrency,
+                    **backup_kwargs,
+                )
+            )
+        else:
+            stats = run_backup(
+                "standin",
+                "standin",
+                database_path,
+                max_workers=max_workers,
+                # the default max_per_host, raised to allow all the download workers
+                max_per_host=max(max_workers, 4),
+                **backup_kwargs,
+            )
+        duration = time.perf_counter() - start
+
+        phases = stats["phases"]
+        return {
+            "duration_s": duration,
+            "requests": portal.requests - requests_before,
+            "mb": stats["bytes"] / 1e6,
+            "retries": stats["retries"],
+            "db_write_s": sum(
+                phases.get(phase, {}).get("seconds", 0.0) for phase in ("db_write", "db_commit")
+            ),
+            "db_mb": os.path.getsize(database_path) / 1e6,
+        }
+
+
+def run_configuration(
+    portal,
+    engine,
+    max_workers,
+    max_concurrency,
+    repeat,
+    backup_kwargs,
+    http_cache=False,
+    parse_workers=0,
+):
+    http_cache = http_cache and engine == "threads"  # the async engine has no HTTP cache
+    if parse_workers:
+        backup_kwargs = {**backup_kwargs, "parse_workers": parse_workers}
+    runs = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        if http_cache:
+            backup_kwargs = {**backup_kwargs, "http_cache": str(Path(cache_dir) / "cache.db")}
+        for i_run in range(repeat):
+            runs.append(
+                run_once(portal, engine, max_workers, max_concurrency, backup_kwargs, i_run)
+            )
+
+    # with the HTTP cache the first run fills the cache, report the following runs
+    first_run = None
+    if http_cache and repeat > 1:
+        first_run, runs = runs[0], runs[1:]
+
+    duration = statistics.median(run["duration_s"] for run in runs)
+    requests = statistics.median(run["requests"] for run in runs)
+    n_stations = len(portal.stations)
+    n_measurements = sum(len(m) for m in portal.measurements.values())
+    return {
+        "engine": engine,
+        "max_workers": max_workers if engine == "threads" else None,
+        "max_concurrency": max_concurrency if engine == "async" else None,
+        "parse_workers": parse_workers if engine == "threads" else None,
+        "duration_s": round(duration, 3),
+        "stations_per_s": round(n_stations / duration, 2),
+        "measurements_per_s": round(n_measurements / duration, 2),
+        "requests": requests,
+        "requests_per_s": round(requests / duration, 1),
+        "mb_downloaded": round(statistics.median(run["mb"] for run in runs), 2),
+        "db_write_s": round(statistics.median(run["db_write_s"] for run in runs), 3),
+        "db_mb": round(statistics.median(run["db_mb"] for run in runs), 2),
+        "retries": statistics.median(run["retries"] for run in runs),
+        "cold_duration_s": None if first_run is None else round(first_run["duration_s"], 3),
+        "runs": runs if first_run is None else [first_run] + runs,
+    }
+
+
+def print_results(results):
+    columns = [
+        ("engine", "engine"),
+        ("workers", "max_workers"),
+        ("conc.", "max_concurrency"),
+        ("parse", "parse_workers"),
+        ("time (s)", "duration_s"),
+        ("stations/s", "stations_per_s"),
+        ("meas./s", "measurements_per_s"),
+        ("req/s", "requests_per_s"),
+        ("MB", "mb_downloaded"),
+        ("db write (s)", "db_write_s"),
+        ("db MB", "db_mb"),
+        ("retries", "retries"),
+    ]
+    if any(result["cold_duration_s"] is not None for result in results):
+        columns.insert(5, ("cold (s)", "cold_duration_s"))
+    print(" ".join(f"{title:>12}" for title, _ in columns))
+    for result in results:
+        values = ("-" if result[key] is None else result[key] for _, key in columns)
+        print(" ".join(f"{value:>12}" for value in values))
+
+
+@click.command(help="Benchmark the backup against a local stand-in of the Salt Portal.")
+@click.option("--projects", default=2, show_default=True, type=click.IntRange(min=1))
+@click.option("--stations", default=10, show_default=True, help="Stations per project.")
+@click.option("--measurements", default=20, show_default=True, help="Measurements per station.")
+@click.option("--calibrations", default=5, show_default=True, help="Calibrations per station.")
+@click.option("--samples", default=600, show_default=True, help="Samples per measurement csv.")
+@click.option("--latency", default=0.02, show_default=True, help="Delay of each request (s).")
+@click.option("--jitter", default=0.0, show_default=True, help="Random extra delay (s).")
+@click.option("--etags", is_flag=True, default=False, help="Support conditional requests.")
+@click.option("--error_rate", default=0.0, show_default=True, help="Fraction answered with 503.")
+@click.option(
+    "--engine",
+    "engines",
+    multiple=True,
+    default=["threads"],
+    show_default=True,
+    type=click.Choice(["threads", "async"]),
+    help="Backup engine, repeat the option to benchmark several.",
+)
+@click.option(
+    "-w",
+    "--max_workers",
+    multiple=True,
+    default=[1, 8],
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Download workers of the threads engine, repeat the option to benchmark several.",
+)
+@click.option(
+    "-p",
+    "--parse_workers",
+    multiple=True,
+    default=[0],
+    show_default=True,
+    type=click.IntRange(min=0),
+    help="Parse processes of the threads engine, repeat the option to benchmark several.",
+)
+@click.option("--max_concurrency", default=16, show_default=True, type=click.IntRange(min=1))
+@click.option("--repeat", default=3, show_default=True, type=click.IntRange(min=1))
+@click.option(
+    "-c",
+    "--storage_codec",
+    default="none",
+    show_default=True,
+    type=click.Choice(["none", "zlib", "zstd"]),
+)
+@click.option(
+    "--sqlite_profile",
+    default="safe",
+    show_default=True,
+    type=click.Choice(["default", "safe", "fast"]),
+)
+@click.option("--parse_series", is_flag=True, default=False)
+@click.option(
+    "--http_cache",
+    is_flag=True,
+    default=False,
+    help="Share an HTTP cache between the runs of each configuration (threads engine).",
+)
+@click.option("--json", "json_path", default=None, help="Write the results as json to this file.")
+def main(
+    projects,
+    stations,
+    measurements,
+    calibrations,
+    samples,
+    latency,
+    jitter,
+    etags,
+    error_rate,
+    engines,
+    max_workers,
+    parse_workers,
+    max_concurrency,
+    repeat,
+    storage_codec,
+    sqlite_profile,
+    parse_series,
+    http_cache,
+    json_path,
+):
+    portal = PortalStandin(
+        projects,
+        stations,
+        measurements,
+        calibrations,
+        samples,
+        latency=latency,
+        jitter=jitter,
+        etags=etags,
+        error_rate=error_rate,
+    )
+    server = serve(portal)
+
+    # the url of the Salt Portal is read when salt_portal_backup is imported
+    os.environ["SALT_PORTAL_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ.setdefault("TQDM_DISABLE", "1")
+
+    backup_kwargs = {
+        "storage_codec": storage_codec,
+        "sqlite_profile": sqlite_profile,
+        "parse_series": parse_series,
+    }
+
+    configurations = []
+    for engine in engines:
+        if engine == "async":
+            configurations.append((engine, None, max_concurrency, 0))
+        else:
+            configurations.extend(
+                (engine, workers, None, parse)
+                for workers in max_workers
+                for parse in parse_workers
+            )
+
+    results = [
+        run_configuration(
+            portal, engine, workers, concurrency, repeat, backup_kwargs, http_cache, parse
+        )
+        for engine, workers, concurrency, parse in configurations
+    ]
+    server.shutdown()
+
+    print(
+        f"\n{projects} projects x {stations} stations x {measurements} measurements, "
+        f"{samples} samples, {latency * 1000:.0f} ms latency, median of {repeat} runs\n"
+    )
+    print_results(results)
+
+    if json_path is not None:
+        setup = {
+            "projects": projects,
+            "stations": stations,
+            "measurements": measurements,
+            "calibrations": calibrations,
+            "samples": samples,
+            "latency": latency,
+            "jitter": jitter,
+            "etags": etags,
+            "error_rate": error_rate,
+            "repeat": repeat,
+            "http_cache": http_cache,
+            **backup_kwargs,
+        }
+        with open(json_path, "w") as json_file:
+            json.dump({"setup": setup, "results": results}, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
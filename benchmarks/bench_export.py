@@ -0,0 +1,95 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Benchmark of the Parquet export, and of reading the measurements and time series from the
+export compared to reading them from the backup database with pandas.
+
+A backup with parsed time series is made from the local Salt Portal stand-in first.
+
+    python benchmarks/bench_export.py --stations 10 --measurements 50 --samples 2000
+"""
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parent))
+from portal_standin import PortalStandin, serve  # noqa: E402
+
+
+def _timed(function):
+    start = time.perf_counter()
+    result = function()
+    return time.perf_counter() - start, result
+
+
+@click.command(help="Benchmark the Parquet export and reading of the exported datasets.")
+@click.option("--projects", default=2, show_default=True, type=click.IntRange(min=1))
+@click.option("--stations", default=5, show_default=True, help="Stations per project.")
+@click.option("--measurements", default=20, show_default=True, help="Measurements per station.")
+@click.option("--samples", default=2000, show_default=True, help="Samples per measurement csv.")
+@click.option(
+    "-c",
+    "--storage_codec",
+    default="none",
+    show_default=True,
+    type=click.Choice(["none", "zlib", "zstd"]),
+)
+def main(projects, stations, measurements, samples, storage_codec):
+    portal = PortalStandin(projects, stations, measurements, 2, samples)
+    server = serve(portal)
+
+    # the url of the Salt Portal is read when salt_portal_backup is imported
+    os.environ["SALT_PORTAL_URL"] = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ.setdefault("TQDM_DISABLE", "1")
+    from salt_portal_backup import run_backup
+    from salt_portal_backup.export import export_parquet
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database_path = str(Path(tmp_dir) / "bench.db")
+        run_backup(
+            "standin",
+            "standin",
+            database_path,
+            max_workers=8,
+            storage_codec=storage_codec,
+            parse_series=True,
+        )
+        server.shutdown()
+
+        export_dir = Path(tmp_dir) / "export"
+        export_s, _ = _timed(lambda: export_parquet(database_path, export_dir))
+        decode_s, _ = _timed(
+            lambda: export_parquet(
+                database_path,
+                Path(tmp_dir) / "decoded",
+                tables=["measurement_series"],
+                decode_series=True,
+            )
+        )
+
+        results = []
+        with sqlite3.connect(database_path) as connection:
+            for table in ("measurement", "measurement_series"):
+                sqlite_s, frame = _timed(
+                    lambda: pd.read_sql(f"SELECT * FROM {table}", connection)
+                )
+                parquet_s, _ = _timed(lambda: pd.read_parquet(export_dir / table))
+                results.append((table, frame.shape[0], sqlite_s, parquet_s))
+
+    print(f"\nexport {export_s:.2f} s, export with decode_series {decode_s:.2f} s\n")
+    print(f"{'table':>20} {'rows':>10} {'sqlite (s)':>12} {'parquet (s)':>12}")
+    for table, rows, sqlite_s, parquet_s in results:
+        print(f"{table:>20} {rows:>10} {sqlite_s:>12.3f} {parquet_s:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Benchmark of the startup time of the command line interface, each case run in a new python
+process, compared to importing the backup engine.
+
+With --check it fails if the median startup of a case exceeds --max_seconds, e.g. in CI:
+
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --check --max_seconds 0.5
+
+That importing the command line interface loads none of the heavy dependencies is tested in
+tests/test_imports.py.
+"""
+
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+CLI = [sys.executable, "-m", "salt_portal_backup.backup"]
+
+CASES = {
+    "import cli": [sys.executable, "-c", "import salt_portal_backup.backup"],
+    "--help": [*CLI, "--help"],
+    "--version": [*CLI, "--version"],
+    "backup --help": [*CLI, "backup", "--help"],
+    "import run_backup": [sys.executable, "-c", "from salt_portal_backup import run_backup"],
+}
+
+
+def _timed_run(command):
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+@click.command(help="Benchmark the startup time of the command line interface.")
+@click.option("--repeat", default=5, show_default=True, type=click.IntRange(min=1))
+@click.option(
+    "--check",
+    is_flag=True,
+    default=False,
+    help="Fail if the command line interface starts slowly.",
+)
+@click.option(
+    "--max_seconds",
+    default=1.0,
+    show_default=True,
+    help="Maximum median startup time of the command line cases with --check.",
+)
+def main(repeat, check, max_seconds):
+    # a first run of each case compiles the bytecode
+    for command in CASES.values():
+        _timed_run(command)
+
+    results = {
+        name: statistics.median(_timed_run(command) for _ in range(repeat))
+        for name, command in CASES.items()
+    }
+
+    print(f"\n{'case':>20} {'time (s)':>10}")
+    for name, seconds in results.items():
+        print(f"{name:>20} {seconds:>10.3f}")
+
+    if check:
+        slow_cases = [
+            name
+            for name, seconds in results.items()
+            if name != "import run_backup" and seconds > max_seconds
+        ]
+        if slow_cases:
+            raise click.ClickException(
+                f"Cases slower than {max_seconds} s: {', '.join(slow_cases)}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Benchmark of the peak memory of the backup as the number of stations grows, with and
+without low_memory, against the local Salt Portal stand-in.
+
+Each backup runs in a new python process, and the peak resident memory is the peak_rss_mb
+of its run statistics. The stand-in is served from this process, so its content is not
+counted. The growth is the increase of the peak memory from the smallest number of
+stations, with low_memory it should stay flat. Examples:
+
+    python benchmarks/bench_memory.py
+    python benchmarks/bench_memory.py --stations 100 --stations 1000 --sqlite_profile fast
+    python benchmarks/bench_memory.py --check --max_growth_mb 40
+
+With --check it fails if the growth with low_memory exceeds --max_growth_mb.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import click
+
+sys.path.insert(0, str(Path(__file__).parent))
+from portal_standin import PortalStandin, serve  # noqa: E402
+
+# run in the backup process, with the url of the stand-in in SALT_PORTAL_URL
+BACKUP_CODE = """
+import json, sys
+from salt_portal_backup import run_backup
+
+database_path, stats_path, backup_kwargs = sys.argv[1], sys.argv[2], json.loads(sys.argv[3])
+run_backup("standin", "standin", database_path, stats_path=stats_path, **backup_kwargs)
+"""
+
+
+def run_once(portal_url, backup_kwargs):
+    """Statistics of a backup run in a new process"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        stats_path = Path(tmp_dir) / "stats.json"
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                BACKUP_CODE,
+                str(Path(tmp_dir) / "bench.db"),
+                str(stats_path),
+                json.dumps(backup_kwargs),
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            env={**os.environ, "SALT_PORTAL_URL": portal_url, "TQDM_DISABLE": "1"},
+        )
+        return json.loads(stats_path.read_text())
+
+
+@click.command(help="Benchmark the peak memory of the backup by number of stations.")
+@click.option(
+    "--stations",
+    "n_stations",
+    multiple=True,
+    default=[50, 200],
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of stations, repeat the option to benchmark several.",
+)
+@click.option("--measurements", default=10, show_default=True, help="Measurements per station.")
+@click.option("--samples", default=600, show_default=True, help="Samples per measurement csv.")
+@click.option(
+    "--sqlite_profile",
+    default="safe",
+    show_default=True,
+    type=click.Choice(["default", "safe", "fast"]),
+)
+@click.option("-w", "--max_workers", default=4, show_default=True, type=click.IntRange(min=1))
+@click.option(
+    "--check",
+    is_flag=True,
+    default=False,
+    help="Fail if the peak memory with low_memory grows more than --max_growth_mb.",
+)
+@click.option(
+    "--max_growth_mb",
+    default=50.0,
+    show_default=True,
+    help="Maximum growth of the peak memory with low_memory with --check.",
+)
+@click.option("--json", "json_path", default=None, help="Write the results as json to this file.")
+def main(
+    n_stations,
+    measurements,
+    samples,
+    sqlite_profile,
+    max_workers,
+    check,
+    max_growth_mb,
+    json_path,
+):
+    results = []
+    for n in sorted(n_stations):
+        portal = PortalStandin(1, n, measurements, 2, samples)
+        server = serve(portal)
+        portal_url = f"http://127.0.0.1:{server.server_address[1]}"
+        for low_memory in (False, True):
+            stats = run_once(
+                portal_url,
+                {
+                    "sqlite_profile": sqlite_profile,
+                    "max_workers": max_workers,
+                    "max_per_host": max_workers,
+                    "low_memory": low_memory,
+                },
+            )
+            results.append(
+                {
+                    "stations": n,
+                    "low_memory": low_memory,
+                    "duration_s": stats["duration_s"],
+                    "peak_rss_mb": stats["peak_rss_mb"],
+                }
+            )
+        server.shutdown()
+
+    for low_memory in (False, True):
+        runs = [result for result in results if result["low_memory"] == low_memory]
+        for result in runs:
+            result["growth_mb"] = round(result["peak_rss_mb"] - runs[0]["peak_rss_mb"], 1)
+
+    columns = ["stations", "low_memory", "duration_s", "peak_rss_mb", "growth_mb"]
+    print(" ".join(f"{column:>12}" for column in columns))
+    for result in sorted(results, key=lambda result: (result["low_memory"], result["stations"])):
+        print(" ".join(f"{result[column]!s:>12}" for column in columns))
+
+    if json_path is not None:
+        with open(json_path, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+    if check:
+        growth = max(result["growth_mb"] for result in results if result["low_memory"])
+        if growth > max_growth_mb:
+            raise click.ClickException(
+                f"Peak memory with low_memory grew {growth} MB, more than {max_growth_mb} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
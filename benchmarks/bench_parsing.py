@@ -0,0 +1,59 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Benchmark of parsing a station, the measurement and calibration csv files and the station
+page, with lxml (if installed) and with html.parser.
+
+    python benchmarks/bench_parsing.py --measurements 1000 --calibrations 200
+"""
+
+import sys
+import timeit
+from pathlib import Path
+
+import click
+
+sys.path.insert(0, str(Path(__file__).parent))
+from portal_standin import PortalStandin  # noqa: E402
+
+from salt_portal_backup import web_scraping  # noqa: E402
+from salt_portal_backup.web_scraping import StationPage, parse_station_data  # noqa: E402
+
+
+@click.command(help="Benchmark parsing of the station csv files and station page.")
+@click.option("--measurements", default=500, show_default=True)
+@click.option("--calibrations", default=100, show_default=True)
+@click.option("--repeat", default=5, show_default=True, type=click.IntRange(min=1))
+def main(measurements, calibrations, repeat):
+    portal = PortalStandin(1, 1, measurements, calibrations, n_samples=0)
+    station_id = portal.stations[0][1]
+    _, _, measurements_csv = portal.route("GET", f"/station/{station_id}/measurements")
+    _, _, calibrations_csv = portal.route("GET", f"/station/{station_id}/calibrations")
+    _, _, page_html = portal.route("GET", f"/station/{station_id}/")
+    page_html = page_html.decode()
+
+    def parse():
+        station_page = StationPage(
+            None, 0, station_id, {}, fetch_page=lambda url, headers: page_html
+        )
+        return parse_station_data(station_id, measurements_csv, calibrations_csv, station_page)
+
+    parsers = {"html.parser": None}
+    if web_scraping.lxml is not None:
+        parsers = {"lxml": web_scraping.lxml, **parsers}
+
+    print(f"{measurements} measurements, {calibrations} calibrations, best of {repeat}")
+    lxml_module = web_scraping.lxml
+    try:
+        for name, module in parsers.items():
+            web_scraping.lxml = module
+            seconds = min(timeit.repeat(parse, number=1, repeat=repeat))
+            print(f"{name:>12}: {seconds * 1000:8.1f} ms")
+    finally:
+        web_scraping.lxml = lxml_module
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Local stand-in for the Salt Portal, serving synthetic projects, stations, measurements and
+calibrations over HTTP.
+
+Serves the pages and files used by the backup: the login page with a csrf token, the
+station list (station-cfts/), the station pages with table_1 and table_2, the measurement
+and calibration csv files of the stations and the measurement and group csv downloads.
+
+Run the backup against the stand-in by setting the SALT_PORTAL_URL environment variable to
+its url before salt_portal_backup is imported. Can also be run on its own:
+
+    python benchmarks/portal_standin.py --projects 5 --stations 10 --latency 0.02
+"""
+
+import csv
+import hashlib
+import io
+import random
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import click
+
+MEASUREMENT_COLUMNS = [
+    "ID",
+    "group",
+    "Date of Measurement",
+    "End time of Measurement",
+    "Flow (cms)",
+    "Measurement Uncertainty",
+    "Notes",
+    "Modified",
+    "Last Modified By",
+    "Locked from Update and Delete",
+    "Locked By",
+    "Party",
+    "Created By",
+    "Stage (m)",
+    "Stage Time",
+    "DL Stage (m)",
+    "Ref Stage (m)",
+    "Type",
+    "Filename",
+    "RatingCurveIds",
+    "States",
+]
+
+CALIBRATION_COLUMNS = [
+    "Date of Calibration",
+    "Coefficient of Variation of the Calibration Regression(R^2)",
+    "Temperature-adjusted Conductivity vs Concentration Regression Coefficient",
+    "CF.T Uncertainty",
+    "Volume of Distilled H20 used in calibration.",
+    "Mass of salt used in calibration.",
+    "Volume of H20 from stream used in calibration.",
+    "Volume of calibration solution injected at each step of 5-point calibration.",
+    "First calibration step ECT.",
+    "Second calibration step ECT.",
+    "Third calibration step ECT.",
+    "Fourth calibration step ECT.",
+    "Fifth calibration step ECT.",
+    "Filename",
+]
+
+LOGIN_PAGE = (
+    b'<html><body><form method="post">'
+    b'<input type="hidden" name="csrfmiddlewaretoken" value="standin-csrf-token">'
+    b"</form></body></html>"
+)
+
+MAIN_PAGE = (
+    b"<html><body><ul><li>Successfully signed in as standin.</li></ul>"
+    b'<div class="wh-sidenav-content"><p>Salt Portal 0.0.0-standin</p></div></body></html>'
+)
+
+
+def _csv(rows, header=None):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header is not None:
+        writer.writerow(header)
+    writer.writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def _html_datetime(datetime_str):
+    """Datetime as shown in the station page, truncated to minutes without leading zero hour"""
+    date, time_of_day = datetime_str.split(" ")
+    hour, minute, _ = time_of_day.split(":")
+    return f"{date} {int(hour)}:{minute}"
+
+
+class PortalStandin:
+    """Synthetic Salt Portal content with n_projects x n_stations x n_measurements.
+
+    Every third measurement belongs to a group. With shared_groups the group ids are the same
+    for all stations, as when a group has measurements at several stations. Each request
+    is delayed by latency seconds, plus a uniform random jitter of up to jitter seconds.
+
+    A fraction error_rate of the requests, chosen at random, is answered with 503 Service
+    Unavailable, as a portal under load.
+
+    With etags the responses, apart from the login pages, have an ETag header and conditional
+    requests with a matching If-None-Match are answered with 304 Not Modified.
+    """
+
+    def __init__(
+        self,
+        n_projects=2,
+        n_stations=3,
+        n_measurements=5,
+        n_calibrations=2,
+        n_samples=200,
+        latency=0.0,
+        jitter=0.0,
+        shared_groups=False,
+        etags=False,
+        error_rate=0.0,
+        seed=1,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.etags = etags
+        self.error_rate = error_rate
+        self.errors = 0
+        self.random = random.Random(seed)
+        self.requests = 0
+        self._lock = threading.Lock()
+
+        self.stations = []
+        self.measurements = {}
+        self.calibrations = {}
+        self.measurement_csvs = {}
+
+        measurement_id = 1000
+        calibration_id = 500
+        group_base = 70
+        station_id = 10
+        for i_project in range(n_projects):
+            project_id = 100 + i_project
+            for _ in range(n_stations):
+                station_id += 1
+                self.stations.append(
+                    (
+                        f"Station {station_id}",
+                        station_id,
+                        f"Project {project_id}",
+                        project_id,
+                        0.0021,
+                        0.0022,
+                        0.0023,
+                    )
+                )
+
+                measurements = []
+                for i_measurement in range(n_measurements):
+                    measurement_id += 1
+                    day = f"2023-05-{i_measurement % 28 + 1:02d}"
+                    minute = i_measurement % 10
+                    measurements.append(
+                        {
+                            "ID": measurement_id,
+                            "group": group_base + i_measurement // 2
+                            if i_measurement % 3 == 0
+                            else "",
+                            "Date of Measurement": f"{day} 10:0{minute}:00",
+                            "End time of Measurement": f"{day} 10:3{minute}:00",
+                            "Flow (cms)": round(self.random.random(), 4),
+                            "Measurement Uncertainty": 5.1,
+                            "Notes": "" if i_measurement % 2 else "note, with comma",
+                            "Modified": "2023-06-01 12:00:00",
+                            "Last Modified By": "standin",
+                            "Locked from Update and Delete": i_measurement % 2 == 0,
+                            "Locked By": "",
+                            "Party": "SP",
+                            "Created By": "standin",
+                            "Stage (m)": 0.5,
+                            "Stage Time": "",
+                            "DL Stage (m)": "",
+                            "Ref Stage (m)": "",
+                            "Type": "salt",
+                            "Filename": f"m{measurement_id}.csv",
+                            "RatingCurveIds": "",
+                            "States": "ok",
+                        }
+                    )
+                    self.measurement_csvs[measurement_id] = self._measurement_csv(
+                        measurement_id, n_samples
+                    )
+                self.measurements[station_id] = measurements
+                if not shared_groups:
+                    group_base += n_measurements
+
+                calibrations = []
+                for i_calibration in range(n_calibrations):
+                    calibration_id += 1
+                    month = i_calibration % 9 + 1
+                    calibrations.append(
+                        (
+                            calibration_id,
+                            [
+                                f"2023-{month:02d}-{month:02d} {i_calibration % 24:02d}:05:33",
+                                0.99,
+                                0.0021,
+                                0.1,
+                                1.0,
+                                100.0,
+                                1.0,
+                                5.0,
+                                10,
+                                20,
+                                30,
+                                40,
+                                50,
+                                f"c{calibration_id}.csv",
+                            ],
+                        )
+                    )
+                self.calibrations[station_id] = calibrations
+
+    def _measurement_csv(self, measurement_id, n_samples):
+        lines = [f"Measurement,{measurement_id}", "Logger,standin", "", "Time,EC,EC.T,Temperature"]
+        for i in range(n_samples):
+            lines.append(
+                f"2023-05-01 {10 + i // 3600:02d}:{i // 60 % 60:02d}:{i % 60:02d},"
+                f"{100 + self.random.random() * 50:.1f},{101 + self.random.random() * 50:.1f},"
+                f"{7 + (i % 5) / 10:.1f}"
+            )
+        return ("\r\n".join(lines) + "\r\n").encode()
+
+    def _station_page(self, station_id):
+        rows_1 = "".join(
+            f'<tr><td>{m["Date of Measurement"]}</td><td>{m["Flow (cms)"]}</td>'
+            f'<td><a href="/measurement/{m["ID"]}/update">Edit</a> '
+            f'<a href="/measurement/{m["ID"]}/csv-download">Download</a></td></tr>'
+            for m in self.measurements[station_id]
+        )
+        rows_2 = "".join(
+            f"<tr><td>{_html_datetime(row[0])}</td><td>{row[1]}</td>"
+            f'<td><a href="/calibration/{calibration_id}/update">Edit</a></td></tr>'
+            for calibration_id, row in self.calibrations[station_id]
+        )
+        thead = "<thead><tr><th>Date</th></tr></thead>"
+        return (
+            "<html><body>"
+            f'<table id="table_1">{thead}<tbody>{rows_1}</tbody></table>'
+            f'<table id="table_2">{thead}<tbody>{rows_2}</tbody></table>'
+            "</body></html>"
+        ).encode()
+
+    def route(self, method, path):
+        """Response to a request as (status, content type, body)"""
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self.random.random() * self.jitter
+            error = self.random.random() < self.error_rate
+            if error:
+                self.errors += 1
+        if delay:
+            time.sleep(delay)
+
+        if error:
+            return 503, "text/plain", b"Service unavailable"
+
+        if path.startswith("/accounts/login/"):
+            return 200, "text/html", LOGIN_PAGE if method == "GET" else MAIN_PAGE
+
+        if path == "/station-cfts/":
+            return 200, "text/csv", _csv(self.stations)
+
+        match = re.fullmatch(r"/station/(\d+)/(measurements|calibrations)?", path)
+        if match and int(match.group(1)) in self.measurements:
+            station_id = int(match.group(1))
+            if match.group(2) == "measurements":
+                rows = [
+                    [m[column] for column in MEASUREMENT_COLUMNS]
+                    for m in self.measurements[station_id]
+                ]
+                return 200, "text/csv", _csv(rows, MEASUREMENT_COLUMNS)
+            if match.group(2) == "calibrations":
+                rows = [row for _, row in self.calibrations[station_id]]
+                return 200, "text/csv", _csv(rows, CALIBRATION_COLUMNS)
+            return 200, "text/html", self._station_page(station_id)
+
+        match = re.fullmatch(r"/measurement/(\d+)/csv-download", path)
+        if match and int(match.group(1)) in self.measurement_csvs:
+            return 200, "text/csv", self.measurement_csvs[int(match.group(1))]
+
+        match = re.fullmatch(r"/group-measurement/(\d+)/csv-download", path)
+        if match:
+            return 200, "text/csv", f"Group,{match.group(1)}\r\n\r\nID,Flow\r\n1,2\r\n".encode()
+
+        return 404, "text/plain", b"Not found"
+
+
+def serve(portal, host="127.0.0.1", port=0):
+    """Serve the portal in a background thread, returns the server. The url of the stand-in
+    is f"http://{host}:{server.server_address[1]}"."""
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, as the Salt Portal
+        disable_nagle_algorithm = True
+
+        def _respond(self, method):
+            content_length = int(self.headers.get("Content-Length") or 0)
+            if content_length:
+                self.rfile.read(content_length)
+
+            status, content_type, body = portal.route(method, self.path)
+
+            etag = None
+            if portal.etags and status == 200 and not self.path.startswith("/accounts/"):
+                etag = f'"{hashlib.md5(body).hexdigest()}"'
+                if self.headers.get("If-None-Match") == etag:
+                    status, body = 304, b""
+
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            if etag is not None:
+                self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self._respond("GET")
+
+        def do_POST(self):
+            self._respond("POST")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@click.command(help="Serve a local stand-in of the Salt Portal with synthetic data.")
+@click.option("--projects", default=2, show_default=True, type=click.IntRange(min=1))
+@click.option("--stations", default=3, show_default=True, help="Stations per project.")
+@click.option("--measurements", default=5, show_default=True, help="Measurements per station.")
+@click.option("--calibrations", default=2, show_default=True, help="Calibrations per station.")
+@click.option("--samples", default=200, show_default=True, help="Samples per measurement csv.")
+@click.option("--latency", default=0.0, show_default=True, help="Delay of each request (s).")
+@click.option("--jitter", default=0.0, show_default=True, help="Random extra delay (s).")
+@click.option("--etags", is_flag=True, default=False, help="Support conditional requests.")
+@click.option("--error_rate", default=0.0, show_default=True, help="Fraction answered with 503.")
+@click.option("--port", default=8000, show_default=True)
+def main(
+    projects, stations, measurements, calibrations, samples, latency, jitter, etags, error_rate, port
+):
+    portal = PortalStandin(
+        projects,
+        stations,
+        measurements,
+        calibrations,
+        samples,
+        latency=latency,
+        jitter=jitter,
+        etags=etags,
+        error_rate=error_rate,
+    )
+    server = serve(portal, port=port)
+    print(f"Salt Portal stand-in at http://127.0.0.1:{server.server_address[1]}")
+    print(f"Run the backup with SALT_PORTAL_URL=http://127.0.0.1:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
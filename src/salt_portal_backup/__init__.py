@@ -2,4 +2,17 @@
 #
 # SPDX-License-Identifier: BSD-3-Clause
 
-from .salt_portal import run_backup
\ No newline at end of file
+__all__ = ["run_backup", "run_backup_async"]
+
+
+def __getattr__(name):
+    # imported on first use, importing the engines loads pandas, SQLAlchemy and requests
+    if name == "run_backup":
+        from .salt_portal import run_backup
+
+        return run_backup
+    if name == "run_backup_async":
+        from .async_backup import run_backup_async
+
+        return run_backup_async
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
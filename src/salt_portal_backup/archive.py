@@ -0,0 +1,393 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Archive of backup snapshots, storing successive backups in one SQLite file with the data
+they have in common stored once.
+
+The downloaded files of all snapshots are stored compressed in a content addressed blob
+table, as in a backup with storage codec zlib or zstd. The rows of each station, its
+measurements, calibrations and references to its files, are stored as one JSON manifest,
+itself a blob, so a station unchanged since the previous snapshot adds no data to the
+archive. A snapshot is the version metadata of the backup and a manifest referencing the
+station manifests and holding the projects, groups and run statistics.
+
+A snapshot is restored as a standalone backup database with restore_snapshot, inserting the
+rows in bulk and copying the referenced blobs with INSERT ... SELECT. The measurement_series
+table is not archived, it is parsed from the measurement csv data again on restore with
+parse_series=True.
+
+run_backup_archive makes a backup and adds it to an archive, with incremental=True as an
+incremental backup from the latest snapshot.
+"""
+
+import json
+import tempfile
+from pathlib import Path
+
+import pandas as pd
+from sqlalchemy import create_engine, insert, select, text
+from sqlalchemy.orm import DeclarativeBase, Mapped, Session, mapped_column
+
+from .database import (
+    Base,
+    Blob,
+    TEXT,
+    DATABASE_VERSION,
+    MeasurementSeries,
+    Version,
+    initialize_database,
+    finalize_database,
+)
+from .salt_portal import run_backup, store_blobs, write_measurement_series
+from .storage import check_codec, decompress, zstandard
+
+# not archived: the blobs are stored in the blob table of the archive, the version is the
+# snapshot, checkpoints only apply to an interrupted run and the series are parsed again
+NOT_ARCHIVED_TABLES = ("blob", "version", "station_checkpoint", "measurement_series")
+
+# inline payloads and manifests are hashed and stored in batches of this size
+ARCHIVE_BATCH_SIZE = 500
+
+
+class ArchiveBase(DeclarativeBase): ...
+
+
+class Snapshot(ArchiveBase):
+    """Backup stored in the archive, with the version metadata of the backup"""
+
+    __tablename__ = "snapshot"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    run_id: Mapped[str] = mapped_column(TEXT, nullable=True)
+    database_version: Mapped[int] = mapped_column()
+    salt_portal_version: Mapped[str] = mapped_column(TEXT)
+    datetime_created: Mapped[str] = mapped_column(TEXT)
+    created_by_user: Mapped[str] = mapped_column(TEXT)
+    datetime_archived: Mapped[str] = mapped_column(TEXT)
+    n_stations: Mapped[int] = mapped_column()
+    manifest_sha256: Mapped[str] = mapped_column(TEXT)
+
+
+def default_archive_codec():
+    return "zstd" if zstandard is not None else "zlib"
+
+
+def _archive_engine(archive_path):
+    db_engine = create_engine("sqlite:///" + str(archive_path), echo=False)
+    Blob.__table__.create(db_engine, checkfirst=True)
+    ArchiveBase.metadata.create_all(db_engine)
+    return db_engine
+
+
+def _payload_column(table):
+    for mapper in Base.registry.mappers:
+        if mapper.local_table is table:
+            return getattr(mapper.class_, "__payload_column__", None)
+    return None
+
+
+def _station_column(table):
+    """SQL expression of the station of the rows of table, or None if not by station"""
+    if table.name == "station":
+        return "t.id"
+    if "station_id" in table.columns:
+        return "t.station_id"
+    if "measurement_id" in table.columns:
+        return "(SELECT station_id FROM measurement m WHERE m.id = t.measurement_id)"
+    return None
+
+
+def _manifest_bytes(manifest):
+    return json.dumps(manifest, sort_keys=True, separators=(",", ":"), default=str).encode()
+
+
+def _as_bytes(payload):
+    return payload.encode() if isinstance(payload, str) else payload
+
+
+def _store_inline_payloads(s_archive, connection, table, payload_column, codec):
+    """Store the payloads stored inline in table in the blob table of the archive, returns
+    the sha256 of each by primary key"""
+    pk_columns = ", ".join(f"t.{column.name}" for column in table.primary_key.columns)
+    result = connection.execution_options(stream_results=True).execute(
+        text(
+            f"SELECT {pk_columns}, t.{payload_column} FROM {table.name} t "
+            f"WHERE t.blob_sha256 IS NULL AND t.{payload_column} IS NOT NULL"
+        )
+    )
+    hashes = {}
+    for rows in result.partitions(ARCHIVE_BATCH_SIZE):
+        payload_hashes = store_blobs(s_archive, [_as_bytes(row[-1]) for row in rows], codec)
+        hashes.update(zip((tuple(row[:-1]) for row in rows), payload_hashes))
+    return hashes
+
+
+def _table_rows(s_archive, connection, table, codec):
+    """Rows of table, as (columns, rows by station id) where the payload is replaced by the
+    sha256 of the blob holding it. Rows not by station have station id None."""
+    payload_column = _payload_column(table)
+    inline_hashes = {}
+    if payload_column is not None:
+        inline_hashes = _store_inline_payloads(
+            s_archive, connection, table, payload_column, codec
+        )
+
+    columns = [column for column in table.columns.keys() if column != payload_column]
+    station_column = _station_column(table) or "NULL"
+    pk_columns = [column.name for column in table.primary_key.columns]
+    result = connection.execute(
+        text(
+            f"SELECT {station_column}, {', '.join(f't.{c}' for c in columns)} "
+            f"FROM {table.name} t ORDER BY {', '.join(f't.{c}' for c in pk_columns)}"
+        )
+    )
+
+    i_pk = [columns.index(column) for column in pk_columns]
+    i_sha256 = columns.index("blob_sha256") if payload_column is not None else None
+    rows_by_station = {}
+    for station_id, *row in result:
+        if i_sha256 is not None and row[i_sha256] is None:
+            row[i_sha256] = inline_hashes.get(tuple(row[i] for i in i_pk))
+        rows_by_station.setdefault(station_id, []).append(row)
+    return columns, rows_by_station
+
+
+def add_snapshot(database_path, archive_path, storage_codec=None):
+    """Add the backup database at database_path as a snapshot to the archive at archive_path,
+    created if it does not exist. Files stored inline in the backup are compressed with
+    storage_codec, default zstd if installed and otherwise zlib. Returns the snapshot id."""
+    storage_codec = storage_codec or default_archive_codec()
+    check_codec(storage_codec)
+    if storage_codec == "none":
+        raise ValueError("The archive stores compressed files, storage_codec can not be none")
+    if not Path(database_path).exists():
+        raise FileNotFoundError(database_path)
+
+    archive_engine = _archive_engine(archive_path)
+    backup_engine = create_engine(
+        f"sqlite:///file:{Path(database_path).as_posix()}?mode=ro&uri=true", echo=False
+    )
+
+    with backup_engine.connect() as connection:
+        version = connection.execute(select(Version.__table__)).mappings().first()
+    if version is None:
+        raise Exception(f"{database_path} is not a completed backup, it has no version")
+    if version["database_version"] != DATABASE_VERSION:
+        raise Exception(
+            f"Database version {version['database_version']} of {database_path} does not "
+            f"match version {DATABASE_VERSION}, can not archive"
+        )
+
+    # compressed files of the backup are copied as they are, ATTACH is not possible in a
+    # transaction
+    with archive_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("ATTACH DATABASE :path AS backup"), {"path": str(database_path)})
+        try:
+            connection.execute(
+                text("INSERT OR IGNORE INTO main.blob SELECT * FROM backup.blob")
+            )
+        finally:
+            connection.execute(text("DETACH DATABASE backup"))
+
+    station_manifests = {}
+    shared_tables = {}
+    with Session(archive_engine) as s_archive, backup_engine.connect() as connection:
+        for table in Base.metadata.sorted_tables:
+            if table.name in NOT_ARCHIVED_TABLES:
+                continue
+            columns, rows_by_station = _table_rows(s_archive, connection, table, storage_codec)
+            for station_id, rows in rows_by_station.items():
+                if station_id is None:
+                    shared_tables[table.name] = {"columns": columns, "rows": rows}
+                else:
+                    station_manifest = station_manifests.setdefault(station_id, {})
+                    station_manifest[table.name] = {"columns": columns, "rows": rows}
+
+        station_ids = sorted(station_manifests)
+        manifest_hashes = []
+        for i in range(0, len(station_ids), ARCHIVE_BATCH_SIZE):
+            manifest_hashes += store_blobs(
+                s_archive,
+                [
+                    _manifest_bytes(station_manifests[station_id])
+                    for station_id in station_ids[i : i + ARCHIVE_BATCH_SIZE]
+                ],
+                storage_codec,
+            )
+
+        manifest = {"stations": manifest_hashes, "tables": shared_tables}
+        snapshot = Snapshot(
+            run_id=version["run_id"],
+            database_version=version["database_version"],
+            salt_portal_version=version["salt_portal_version"],
+            datetime_created=version["datetime_created"],
+            created_by_user=version["created_by_user"],
+            datetime_archived=pd.Timestamp.now(tz="UTC").isoformat(timespec="seconds"),
+            n_stations=len(station_ids),
+            manifest_sha256=store_blobs(s_archive, [_manifest_bytes(manifest)], storage_codec)[0],
+        )
+        s_archive.add(snapshot)
+        s_archive.commit()
+        snapshot_id = snapshot.id
+
+    backup_engine.dispose()
+    archive_engine.dispose()
+    print(f"Added snapshot {snapshot_id} with {len(station_ids)} stations to {archive_path}")
+    return snapshot_id
+
+
+def list_snapshots(archive_path):
+    """Snapshots in the archive at archive_path, as a data frame ordered by id"""
+    if not Path(archive_path).exists():
+        raise FileNotFoundError(archive_path)
+    archive_engine = _archive_engine(archive_path)
+    with archive_engine.connect() as connection:
+        result = connection.execute(select(Snapshot.__table__).order_by(Snapshot.id))
+        snapshots = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+    archive_engine.dispose()
+    return snapshots
+
+
+def _read_manifest(connection, sha256):
+    row = connection.execute(select(Blob.codec, Blob.data).where(Blob.sha256 == sha256)).first()
+    if row is None:
+        raise Exception(f"Manifest {sha256} is missing from the archive")
+    return json.loads(decompress(row.data, row.codec))
+
+
+def restore_snapshot(
+    archive_path, database_path, snapshot_id=None, sqlite_profile="safe", parse_series=False
+):
+    """Restore a snapshot of the archive at archive_path as a backup database at
+    database_path, by default the latest snapshot.
+
+    With parse_series=True the measurement_series table is parsed from the measurement csv
+    data. See run_backup for sqlite_profile.
+    """
+    if not Path(archive_path).exists():
+        raise FileNotFoundError(archive_path)
+    if database_path is None:
+        raise ValueError("A database path to restore to is required")
+
+    archive_engine = _archive_engine(archive_path)
+    with archive_engine.connect() as connection:
+        statement = select(Snapshot)
+        if snapshot_id is None:
+            statement = statement.order_by(Snapshot.id.desc()).limit(1)
+        else:
+            statement = statement.where(Snapshot.id == snapshot_id)
+        snapshot = connection.execute(statement).mappings().first()
+        if snapshot is None:
+            raise ValueError(
+                f"No snapshot {snapshot_id} in {archive_path}"
+                if snapshot_id is not None
+                else f"No snapshots in {archive_path}"
+            )
+
+        manifest = _read_manifest(connection, snapshot["manifest_sha256"])
+        table_rows = {}
+        for table_name, table_data in manifest["tables"].items():
+            table_rows.setdefault(table_name, []).append(table_data)
+        for manifest_sha256 in manifest["stations"]:
+            for table_name, table_data in _read_manifest(connection, manifest_sha256).items():
+                table_rows.setdefault(table_name, []).append(table_data)
+        codecs = connection.execute(text("SELECT DISTINCT codec FROM blob")).scalars().all()
+    archive_engine.dispose()
+
+    db_engine = initialize_database(database_name=str(database_path), sqlite_profile=sqlite_profile)
+    with Session(db_engine) as s_db:
+        for table in Base.metadata.sorted_tables:
+            records = [
+                dict(zip(table_data["columns"], row))
+                for table_data in table_rows.get(table.name, [])
+                for row in table_data["rows"]
+            ]
+            if records:
+                s_db.execute(insert(table), records)
+
+        s_db.add(
+            Version(
+                id=0,
+                database_version=snapshot["database_version"],
+                salt_portal_version=snapshot["salt_portal_version"],
+                datetime_created=snapshot["datetime_created"],
+                created_by_user=snapshot["created_by_user"],
+                run_id=snapshot["run_id"],
+                storage_codec=codecs[0] if len(codecs) == 1 else default_archive_codec(),
+            )
+        )
+        s_db.commit()
+
+    referenced = " UNION ".join(
+        f"SELECT blob_sha256 FROM main.{table.name} WHERE blob_sha256 IS NOT NULL"
+        for table in Base.metadata.sorted_tables
+        if "blob_sha256" in table.columns
+    )
+    with db_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("ATTACH DATABASE :path AS archive"), {"path": str(archive_path)})
+        try:
+            connection.execute(
+                text(
+                    "INSERT INTO main.blob SELECT * FROM archive.blob "
+                    f"WHERE sha256 IN ({referenced})"
+                )
+            )
+        finally:
+            connection.execute(text("DETACH DATABASE archive"))
+
+    if parse_series:
+        _restore_series(db_engine)
+
+    finalize_database(db_engine)
+    print(f"Restored snapshot {snapshot['id']} to {database_path}")
+
+
+def _restore_series(db_engine):
+    from .reader import BackupReader
+
+    with Session(db_engine) as s_db:
+        s_db.execute(MeasurementSeries.__table__.delete())
+        measurement_ids = s_db.scalars(text("SELECT measurement_id FROM measurement_csv_data"))
+        measurement_ids = list(measurement_ids)
+
+    reader = BackupReader(db_engine.url.database)
+    with Session(db_engine) as s_db:
+        for i in range(0, len(measurement_ids), ARCHIVE_BATCH_SIZE):
+            downloads = [
+                (("measurement", measurement_id), reader.measurement_csv(measurement_id))
+                for measurement_id in measurement_ids[i : i + ARCHIVE_BATCH_SIZE]
+            ]
+            write_measurement_series(s_db, downloads)
+        s_db.commit()
+    reader.close()
+
+
+def run_backup_archive(username, password, archive_path, incremental=False, **backup_kwargs):
+    """Backup to a temporary database with run_backup and add it as a snapshot to the archive
+    at archive_path. With incremental=True the latest snapshot, if any, is restored first and
+    the backup is an incremental backup of it. backup_kwargs are passed to run_backup.
+    Returns the statistics of the backup as a dict, with the id of the snapshot."""
+    # the files are always stored compressed in the archive
+    storage_codec = backup_kwargs.pop("storage_codec", None)
+    if storage_codec in (None, "none"):
+        storage_codec = default_archive_codec()
+    if "database_path" in backup_kwargs:
+        raise ValueError("run_backup_archive backs up to a temporary database")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        database_path = Path(tmp_dir) / "backup.db"
+        has_snapshots = Path(archive_path).exists() and not list_snapshots(archive_path).empty
+        if incremental and has_snapshots:
+            restore_snapshot(archive_path, database_path)
+
+        summary = run_backup(
+            username,
+            password,
+            str(database_path),
+            incremental=incremental and has_snapshots,
+            storage_codec=storage_codec,
+            **backup_kwargs,
+        )
+        summary["snapshot_id"] = add_snapshot(database_path, archive_path, storage_codec)
+    return summary
@@ -0,0 +1,381 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Asyncio engine for the backup, an alternative to the requests based run_backup.
+
+All stations are crawled as concurrent tasks sharing one aiohttp connection pool, with a
+global limit on the number of concurrent requests. Login, headers, parsing and database
+writes are shared with run_backup. Parsing is done in worker threads, while all database
+writes are done from the event loop, one station at a time.
+
+Requires aiohttp, install with: pip install salt-portal-backup[async]
+"""
+
+import asyncio
+import time
+from typing import TYPE_CHECKING
+
+from sqlalchemy.orm import Session
+from tqdm import tqdm
+
+if TYPE_CHECKING:
+    import aiohttp
+else:
+    try:
+        import aiohttp
+    except ImportError:  # optional dependency
+        aiohttp = None
+
+from .web_scraping import URL_BASE, URL_LOGIN, URL_STATION_LIST
+from .web_scraping import (
+    get_login_token,
+    get_login_payload,
+    get_login_header,
+    check_login,
+    get_data_header,
+    parse_projects_stations,
+    parse_station_data,
+    station_page_url,
+    station_csv_url,
+    StationPage,
+)
+from .salt_portal import (
+    write_version,
+    completed_station_ids,
+    write_checkpoint,
+    write_station_list,
+    write_project,
+    write_station_info,
+    write_station,
+    write_downloads,
+    station_unchanged,
+    changed_measurement_ids,
+    get_station_downloads,
+    write_measurement_series,
+    delete_unreferenced_blobs,
+    delete_unlisted_stations,
+    select_stations,
+    write_run_stats,
+    report_run_stats,
+)
+from .instrumentation import BackupStats, endpoint_name
+from .scheduler import RequestScheduler, RETRY_STATUSES
+from .storage import check_codec
+from .database import initialize_database, finalize_database
+
+
+class AsyncPortalClient:
+    """aiohttp session with an adaptive limit on the number of concurrent requests, up to
+    max_concurrency.
+
+    Requests are rate limited and retried by scheduler, a RequestScheduler, and recorded in
+    stats if given, a BackupStats.
+    """
+
+    def __init__(self, session, max_concurrency, stats=None, scheduler=None):
+        self.session = session
+        self.stats = stats
+        if scheduler is None:
+            scheduler = RequestScheduler(max_concurrency=max_concurrency, stats=stats)
+        self.scheduler = scheduler
+        self.in_flight = 0
+        self._slot_free = asyncio.Condition()
+
+    async def _acquire_slot(self):
+        async with self._slot_free:
+            await self._slot_free.wait_for(
+                lambda: self.in_flight < self.scheduler.concurrency.limit
+            )
+            self.in_flight += 1
+
+    async def _release_slot(self):
+        async with self._slot_free:
+            self.in_flight -= 1
+            self._slot_free.notify_all()
+
+    async def _request(self, method, url, **kwargs):
+        connect_timeout, read_timeout = self.scheduler.timeout(url)
+        timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.scheduler.rate_delay())
+            await self._acquire_slot()
+            start = time.perf_counter()
+            try:
+                async with self.session.request(
+                    method, url, timeout=timeout, **kwargs
+                ) as response:
+                    content = await response.read()
+                seconds = time.perf_counter() - start
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+                delay = self.scheduler.retry_delay(
+                    method,
+                    url,
+                    attempt,
+                    sent=not isinstance(error, aiohttp.ClientConnectorError),
+                )
+                if delay is None:
+                    raise
+            else:
+                if self.stats is not None:
+                    self.stats.record_request(url, seconds, len(content), response.status)
+                delay = self.scheduler.retry_delay(
+                    method,
+                    url,
+                    attempt,
+                    status=response.status,
+                    retry_after=response.headers.get("Retry-After"),
+                )
+                if delay is None:
+                    if response.status in RETRY_STATUSES:
+                        response.raise_for_status()
+                    if response.status < 400:
+                        self.scheduler.concurrency.on_response(endpoint_name(url), seconds)
+                    return content, response.get_encoding()
+            finally:
+                await self._release_slot()
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def get(self, url, headers=None):
+        content, _ = await self._request("GET", url, headers=headers)
+        return content
+
+    async def get_text(self, url, headers=None):
+        content, encoding = await self._request("GET", url, headers=headers)
+        return content.decode(encoding)
+
+    async def post_text(self, url, data, headers=None):
+        content, encoding = await self._request("POST", url, data=data, headers=headers)
+        return content.decode(encoding)
+
+
+async def login_salt_portal_async(client, username, password):
+    """Same login flow as login_salt_portal, returns the csrf token and Salt Portal version"""
+    token = get_login_token(await client.get_text(URL_LOGIN))
+
+    header_login = get_login_header(token)
+    # aiohttp would send the fixed Content-Length of the template instead of the real one
+    header_login.pop("Content-Length")
+
+    main_page_html = await client.post_text(
+        URL_LOGIN, data=get_login_payload(token, username, password), headers=header_login
+    )
+
+    return token, check_login(main_page_html)
+
+
+async def backup_station_async(
+    client,
+    s_db,
+    stats,
+    token,
+    run_id,
+    project_id,
+    station,
+    incremental,
+    storage_codec,
+    parse_series,
+    claimed_groups=None,
+):
+    station_id = station["station_id"]
+    stats.count("stations")
+    loop = asyncio.get_running_loop()
+
+    header_station_measurements = get_data_header(token)
+    header_station_measurements["Referer"] = station_page_url(station_id)
+    header_station_page = get_data_header(token)
+
+    with stats.phase("station_csvs"):
+        measurements_csv, calibrations_csv = await asyncio.gather(
+            client.get(station_csv_url(station_id, "measurements"), header_station_measurements),
+            client.get(station_csv_url(station_id, "calibrations"), header_station_measurements),
+        )
+
+    if incremental and station_unchanged(s_db, station_id, measurements_csv, calibrations_csv):
+        stats.count("stations_unchanged")
+        write_station_info(s_db, project_id, station)
+        write_checkpoint(s_db, station_id, run_id)
+        with stats.phase("db_commit"):
+            s_db.commit()
+        return
+
+    # parsing runs in a worker thread, which fetches the station page through the event loop
+    def fetch_page(url, headers):
+        with stats.phase("station_page"):
+            return asyncio.run_coroutine_threadsafe(client.get_text(url, headers), loop).result()
+
+    station_page = StationPage(
+        None, project_id, station_id, header_station_page, fetch_page=fetch_page
+    )
+    with stats.phase("parse"):
+        measurements, calibrations = await asyncio.to_thread(
+            parse_station_data, station_id, measurements_csv, calibrations_csv, station_page
+        )
+
+    removed_ids = None
+    if incremental:
+        changed_ids, removed_ids = changed_measurement_ids(s_db, station_id, measurements)
+        measurements = measurements[measurements["ID"].isin(changed_ids)]
+
+    # groups shared with other stations are claimed by the first station downloading them
+    download_urls = get_station_downloads(measurements, claimed_groups)
+    with stats.phase("downloads"):
+        downloads = await asyncio.gather(
+            *(client.get(url, header_station_measurements) for url in download_urls.values())
+        )
+    for kind, _ in download_urls:
+        stats.count(f"{kind}_downloads")
+
+    # no awaits from here, so the station is written and committed as a whole
+    with stats.phase("db_write"):
+        write_station_info(s_db, project_id, station)
+        write_station(
+            s_db,
+            station_id,
+            measurements_csv,
+            measurements,
+            calibrations_csv,
+            calibrations,
+            removed_ids=removed_ids,
+            storage_codec=storage_codec,
+        )
+        downloads = list(zip(download_urls, downloads))
+        write_downloads(s_db, downloads, storage_codec=storage_codec)
+        if parse_series:
+            write_measurement_series(s_db, downloads)
+
+        write_checkpoint(s_db, station_id, run_id)
+    with stats.phase("db_commit"):
+        s_db.commit()  # all data commit for station here
+
+
+async def run_backup_async(
+    username,
+    password,
+    database_path=None,
+    max_concurrency=16,
+    max_per_host=None,
+    incremental=False,
+    resume=False,
+    storage_codec="none",
+    sqlite_profile="safe",
+    vacuum=False,
+    parse_series=False,
+    stats_path=None,
+    max_rate=None,
+    max_retries=5,
+    timeouts=None,
+    selection=None,
+):
+    """Backup all projects, stations, calibrations and measurements to a SQLite database,
+    using asyncio and aiohttp.
+
+    At most max_concurrency requests are made concurrently, or max_per_host if given and
+    lower, and at most max_concurrency stations are in progress at the same time. See
+    run_backup for incremental, resume,
+    storage_codec, sqlite_profile, vacuum, parse_series, stats_path, max_rate, max_retries,
+    timeouts and selection.
+    """
+    if aiohttp is None:
+        raise ImportError(
+            "run_backup_async requires aiohttp, install with: pip install salt-portal-backup[async]"
+        )
+
+    check_codec(storage_codec)
+
+    incremental = incremental or resume
+
+    db_engine = initialize_database(
+        database_name=database_path, incremental=incremental, sqlite_profile=sqlite_profile
+    )
+
+    stats = BackupStats()
+
+    # all requests go to the Salt Portal, the per host limit bounds the request concurrency
+    request_concurrency = min(max_concurrency, max_per_host or max_concurrency)
+    connector = aiohttp.TCPConnector(limit=max_concurrency, limit_per_host=max_per_host or 0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        scheduler = RequestScheduler(
+            max_rate=max_rate,
+            max_concurrency=request_concurrency,
+            max_retries=max_retries,
+            timeouts=timeouts,
+            stats=stats,
+        )
+        client = AsyncPortalClient(
+            session, request_concurrency, stats=stats, scheduler=scheduler
+        )
+
+        with stats.phase("login"):
+            token, sp_semver = await login_salt_portal_async(client, username, password)
+
+        with Session(db_engine) as s_db:
+            run_id = write_version(
+                s_db, sp_semver, username, resume=resume, storage_codec=storage_codec
+            )
+            completed_ids = completed_station_ids(s_db, run_id)
+
+            header_get_organization = get_data_header(token)
+            header_get_organization["Referer"] = f"{URL_BASE}/"
+            with stats.phase("station_list"):
+                stations_csv = await client.get(URL_STATION_LIST, header_get_organization)
+            projects, stations = parse_projects_stations(stations_csv)
+            listed_stations = stations
+            if selection is not None:
+                projects, stations = select_stations(selection, projects, stations)
+
+            write_station_list(s_db, stations_csv, storage_codec=storage_codec)
+
+            for _, project in projects.iterrows():
+                write_project(s_db, project["project_id"], project["project_name"])
+
+            station_limit = asyncio.Semaphore(max_concurrency)
+            claimed_groups = set()
+
+            async def run_station(station):
+                async with station_limit:
+                    await backup_station_async(
+                        client,
+                        s_db,
+                        stats,
+                        token,
+                        run_id,
+                        station["project_id"],
+                        station,
+                        incremental,
+                        storage_codec,
+                        parse_series,
+                        claimed_groups,
+                    )
+
+            tasks = [
+                asyncio.create_task(run_station(station))
+                for _, station in stations.iterrows()
+                if station["station_id"] not in completed_ids
+            ]
+            try:
+                for task in tqdm(
+                    asyncio.as_completed(tasks), desc=" stations", total=len(tasks), position=0
+                ):
+                    await task
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+            if incremental:
+                with stats.phase("db_commit"):
+                    removed_ids = delete_unlisted_stations(s_db, listed_stations)
+                    stats.count("stations_removed", len(removed_ids))
+                    delete_unreferenced_blobs(s_db)
+
+            summary = write_run_stats(s_db, run_id, "async", stats)
+
+    finalize_database(db_engine, vacuum=vacuum)
+
+    return report_run_stats(summary, stats_path)
@@ -3,19 +3,59 @@
 # SPDX-License-Identifier: BSD-3-Clause
 
 import click
+from click.core import ParameterSource
 
-from salt_portal_backup.salt_portal import run_backup
+# the backup engines, merge and export are imported by the commands using them, so --help,
+# --version and the commands not using pandas, SQLAlchemy or pyarrow start fast
+from salt_portal_backup.selection import StationSelection, parse_shard
 from salt_portal_backup.__about__ import __version__
 
 
-@click.command(
+class DefaultCommandGroup(click.Group):
+    """Group running default_command when no command is given, so salt_portal_backup -u ...
+    still runs the backup"""
+
+    def __init__(self, *args, default_command=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+
+    def parse_args(self, ctx, args):
+        if not args or (args[0] not in self.commands and args[0] not in ("--help", "--version")):
+            args = [self.default_command, *args]
+        return super().parse_args(ctx, args)
+
+
+def _parse_shard(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return parse_shard(value)
+    except ValueError as error:
+        raise click.BadParameter(str(error))
+
+
+@click.group(
+    cls=DefaultCommandGroup,
+    default_command="backup",
     help="""
     Backup projects, stations, calibrations and measurements from Salt Portal 
-    to a SQLite database.
+    to a SQLite database. Runs the backup command if no command is given.
     \b
     
     BSD-3-Clause License\n
     Copyright (c) 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+    """,
+)
+@click.version_option(version=__version__, prog_name="Salt Portal Backup")
+def main():
+    pass
+
+
+@main.command(
+    short_help="Backup Salt Portal to a SQLite database, the default command.",
+    help="""
+    Backup projects, stations, calibrations and measurements from Salt Portal
+    to a SQLite database.
     """
 )
 @click.option(
@@ -42,10 +82,584 @@ from salt_portal_backup.__about__ import __version__
         "the current date and time time."
     ),
 )
-@click.version_option(version=__version__, prog_name="Salt Portal Backup")
-def main(username, password, output_database):
-    run_backup(username, password, output_database)
+@click.option(
+    "-w",
+    "--max_workers",
+    default=1,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help=(
+        "Number of worker threads downloading measurement and group CSVs concurrently. "
+        "Can not be used with --async."
+    ),
+)
+@click.option(
+    "--max_per_host",
+    default=4,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help=(
+        "Maximum number of concurrent requests to the Salt Portal. With --async only if "
+        "given, lowering --max_concurrency."
+    ),
+)
+@click.option(
+    "-i",
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help=(
+        "Update an existing backup database instead of replacing it. Only new or modified "
+        "measurements are downloaded, and measurements deleted in Salt Portal are removed."
+    ),
+)
+@click.option(
+    "-r",
+    "--resume",
+    is_flag=True,
+    default=False,
+    help=(
+        "Resume an interrupted backup to an existing database, skipping the stations "
+        "already completed. Use the same --storage_codec as the interrupted backup. A "
+        "completed backup is updated as with --incremental."
+    ),
+)
+@click.option(
+    "-c",
+    "--storage_codec",
+    default="none",
+    show_default=True,
+    type=click.Choice(["none", "zlib", "zstd"]),
+    help=(
+        "Compress the downloaded csv files with zlib or zstd, storing identical files only "
+        "once. zstd requires the zstandard package."
+    ),
+)
+@click.option(
+    "--sqlite_profile",
+    default="safe",
+    show_default=True,
+    type=click.Choice(["default", "safe", "fast"]),
+    help=(
+        "SQLite settings used while writing the backup. fast is quicker but the database can "
+        "be corrupted if the computer crashes during the backup."
+    ),
+)
+@click.option(
+    "--vacuum",
+    is_flag=True,
+    default=False,
+    help="Rebuild the database file when the backup is complete, reclaiming unused space.",
+)
+@click.option(
+    "--parse_series",
+    is_flag=True,
+    default=False,
+    help=(
+        "Also store the time series of the measurement csv files as numbers in the "
+        "measurement_series table."
+    ),
+)
+@click.option(
+    "--stats_file",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help=(
+        "Write the timings and request statistics of the backup as json to this file. The "
+        "statistics are also stored in the run_stats table of the database."
+    ),
+)
+@click.option(
+    "--stream_downloads",
+    is_flag=True,
+    default=False,
+    help=(
+        "Stream the measurement and group CSVs to temporary files and write them to the "
+        "database in batches, keeping memory use low for large stations. Can not be used with "
+        "--async."
+    ),
+)
+@click.option(
+    "--low_memory",
+    is_flag=True,
+    default=False,
+    help=(
+        "Keep memory use flat for organizations with many stations, limiting the SQLite "
+        "cache and streaming the downloads. Can not be used with --async."
+    ),
+)
+@click.option(
+    "--http_cache",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help=(
+        "SQLite file used as HTTP cache between backups. Unchanged pages and files are "
+        "revalidated instead of downloaded again, and CSVs of locked measurements are read "
+        "from the cache. Can not be used with --async."
+    ),
+)
+@click.option(
+    "--cache_max_size",
+    default=None,
+    type=click.FloatRange(min=0),
+    help="Maximum size of the HTTP cache in MB, least recently used entries are evicted.",
+)
+@click.option(
+    "--cache_max_age",
+    default=None,
+    type=click.FloatRange(min=0),
+    help="Evict entries of the HTTP cache not used for this many days.",
+)
+@click.option(
+    "--max_rate",
+    default=None,
+    type=click.FloatRange(min=0, min_open=True),
+    help="Maximum number of requests per second to the Salt Portal. No limit by default.",
+)
+@click.option(
+    "--max_retries",
+    default=5,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help=(
+        "Retries of requests failing with a server error, throttling, connection error or "
+        "timeout, with exponential backoff."
+    ),
+)
+@click.option(
+    "--project",
+    "project_ids",
+    multiple=True,
+    type=int,
+    help="Only backup the stations of this project id. Can be repeated.",
+)
+@click.option(
+    "--exclude_project",
+    "exclude_project_ids",
+    multiple=True,
+    type=int,
+    help="Skip the stations of this project id. Can be repeated.",
+)
+@click.option(
+    "--station",
+    "station_ids",
+    multiple=True,
+    type=int,
+    help="Only backup this station id. Can be repeated.",
+)
+@click.option(
+    "--exclude_station",
+    "exclude_station_ids",
+    multiple=True,
+    type=int,
+    help="Skip this station id. Can be repeated.",
+)
+@click.option(
+    "--station_name",
+    "station_names",
+    multiple=True,
+    help='Only backup stations with names matching this pattern, e.g. "River*". Can be repeated.',
+)
+@click.option(
+    "--exclude_station_name",
+    "exclude_station_names",
+    multiple=True,
+    help="Skip stations with names matching this pattern. Can be repeated.",
+)
+@click.option(
+    "--shard",
+    default=None,
+    callback=_parse_shard,
+    help=(
+        "Only backup shard i of n of the stations, given as i/n, e.g. 1/4. The shards are "
+        "disjoint and together cover all stations, combine them with the merge command."
+    ),
+)
+@click.option(
+    "--parse_workers",
+    default=0,
+    show_default=True,
+    type=click.IntRange(min=0),
+    help=(
+        "Parse the stations in this number of processes, ahead of writing them to the "
+        "database. 0 parses in the main process. Not used with --async."
+    ),
+)
+@click.option(
+    "--async",
+    "use_async",
+    is_flag=True,
+    default=False,
+    help="Use the asyncio engine, crawling all stations concurrently. Requires aiohttp.",
+)
+@click.option(
+    "--max_concurrency",
+    default=16,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Maximum number of concurrent requests with the asyncio engine.",
+)
+@click.option(
+    "--archive",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help=(
+        "Add the backup as a snapshot to this archive, created if not existing, instead of "
+        "writing a backup database. With --incremental the backup is an incremental backup "
+        "of the latest snapshot. The files are stored compressed, with zstd if installed."
+    ),
+)
+def backup(
+    username,
+    password,
+    output_database,
+    max_workers,
+    max_per_host,
+    incremental,
+    resume,
+    storage_codec,
+    sqlite_profile,
+    vacuum,
+    parse_series,
+    stats_file,
+    stream_downloads,
+    low_memory,
+    http_cache,
+    cache_max_size,
+    cache_max_age,
+    max_rate,
+    max_retries,
+    project_ids,
+    exclude_project_ids,
+    station_ids,
+    exclude_station_ids,
+    station_names,
+    exclude_station_names,
+    shard,
+    parse_workers,
+    use_async,
+    max_concurrency,
+    archive,
+):
+    selection = None
+    if any(
+        (
+            project_ids,
+            exclude_project_ids,
+            station_ids,
+            exclude_station_ids,
+            station_names,
+            exclude_station_names,
+            shard,
+        )
+    ):
+        selection = StationSelection(
+            project_ids=project_ids,
+            exclude_project_ids=exclude_project_ids,
+            station_ids=station_ids,
+            exclude_station_ids=exclude_station_ids,
+            station_names=station_names,
+            exclude_station_names=exclude_station_names,
+            shard=shard,
+        )
+
+    if archive is not None:
+        if output_database is not None or resume or use_async:
+            raise click.UsageError(
+                "--archive backs up to a temporary database, it can not be used with "
+                "--output_database, --resume or --async"
+            )
+        from salt_portal_backup.archive import run_backup_archive
+
+        run_backup_archive(
+            username,
+            password,
+            archive,
+            incremental=incremental,
+            max_workers=max_workers,
+            max_per_host=max_per_host,
+            storage_codec=storage_codec,
+            sqlite_profile=sqlite_profile,
+            parse_series=parse_series,
+            stats_path=stats_file,
+            stream_downloads=stream_downloads,
+            low_memory=low_memory,
+            http_cache=http_cache,
+            cache_max_size_mb=cache_max_size,
+            cache_max_age_days=cache_max_age,
+            max_rate=max_rate,
+            max_retries=max_retries,
+            selection=selection,
+            parse_workers=parse_workers,
+        )
+    elif use_async:
+        if http_cache is not None:
+            raise click.UsageError("--http_cache can not be used with --async")
+        if stream_downloads:
+            raise click.UsageError("--stream_downloads can not be used with --async")
+        if low_memory:
+            raise click.UsageError("--low_memory can not be used with --async")
+        context = click.get_current_context()
+        if context.get_parameter_source("max_workers") != ParameterSource.DEFAULT:
+            raise click.UsageError("--max_workers can not be used with --async")
+        if context.get_parameter_source("max_per_host") == ParameterSource.DEFAULT:
+            # the default of the threads engine would lower the default --max_concurrency
+            max_per_host = None
+
+        import asyncio
+        from salt_portal_backup.async_backup import run_backup_async
+
+        asyncio.run(
+            run_backup_async(
+                username,
+                password,
+                output_database,
+                max_concurrency=max_concurrency,
+                max_per_host=max_per_host,
+                incremental=incremental,
+                resume=resume,
+                storage_codec=storage_codec,
+                sqlite_profile=sqlite_profile,
+                vacuum=vacuum,
+                parse_series=parse_series,
+                stats_path=stats_file,
+                max_rate=max_rate,
+                max_retries=max_retries,
+                selection=selection,
+            )
+        )
+    else:
+        from salt_portal_backup.salt_portal import run_backup
+
+        run_backup(
+            username,
+            password,
+            output_database,
+            max_workers=max_workers,
+            max_per_host=max_per_host,
+            incremental=incremental,
+            resume=resume,
+            storage_codec=storage_codec,
+            sqlite_profile=sqlite_profile,
+            vacuum=vacuum,
+            parse_series=parse_series,
+            stats_path=stats_file,
+            stream_downloads=stream_downloads,
+            low_memory=low_memory,
+            http_cache=http_cache,
+            cache_max_size_mb=cache_max_size,
+            cache_max_age_days=cache_max_age,
+            max_rate=max_rate,
+            max_retries=max_retries,
+            selection=selection,
+            parse_workers=parse_workers,
+        )
+
+
+@main.command(
+    short_help="Merge backup databases into one backup database.",
+    help="""
+    Merge backup databases, e.g. the shards of a backup made with --shard, into a new
+    backup database.
+    """
+)
+@click.argument("databases", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "-o",
+    "--output_database",
+    required=True,
+    help="Path to the new SQLite database to merge the databases into.",
+)
+@click.option(
+    "--sqlite_profile",
+    default="safe",
+    show_default=True,
+    type=click.Choice(["default", "safe", "fast"]),
+    help="SQLite settings used while writing the merged database.",
+)
+@click.option(
+    "--vacuum",
+    is_flag=True,
+    default=False,
+    help="Rebuild the merged database file, reclaiming unused space.",
+)
+def merge(databases, output_database, sqlite_profile, vacuum):
+    from salt_portal_backup.merge import merge_backups
+
+    try:
+        merge_backups(databases, output_database, sqlite_profile=sqlite_profile, vacuum=vacuum)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+
+
+@main.command(
+    short_help="Export a backup database to Parquet datasets.",
+    help="""
+    Export the tables of a backup database to Parquet datasets in OUTPUT_DIR, one directory
+    per table. Measurements, calibrations and their data are partitioned by project and
+    station. Requires pyarrow.
+    """,
+)
+@click.argument("database", type=click.Path(exists=True, dir_okay=False))
+@click.argument("output_dir", type=click.Path(file_okay=False))
+@click.option(
+    "--table",
+    "tables",
+    multiple=True,
+    help="Only export this table. Can be repeated.",
+)
+@click.option(
+    "--decode_series",
+    is_flag=True,
+    default=False,
+    help=(
+        "Parse the time series of the measurement CSVs into the measurement_series dataset, "
+        "also for backups made without --parse_series."
+    ),
+)
+@click.option(
+    "--batch_size",
+    default=50_000,  # EXPORT_BATCH_SIZE of salt_portal_backup.export
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Number of rows read and written at a time.",
+)
+@click.option(
+    "--overwrite",
+    is_flag=True,
+    default=False,
+    help="Replace existing datasets in OUTPUT_DIR.",
+)
+def export(database, output_dir, tables, decode_series, batch_size, overwrite):
+    from salt_portal_backup.export import export_parquet
+
+    try:
+        export_parquet(
+            database,
+            output_dir,
+            tables=tables or None,
+            decode_series=decode_series,
+            batch_size=batch_size,
+            overwrite=overwrite,
+        )
+    except (ValueError, FileExistsError) as error:
+        raise click.UsageError(str(error))
+
+
+@main.command(
+    short_help="Show the changes between two backup databases.",
+    help="""
+    Show the stations, measurements, measurement CSVs and calibrations added, removed or
+    changed in the backup database NEW compared to the backup database OLD.
+    """,
+)
+@click.argument("old", type=click.Path(exists=True, dir_okay=False))
+@click.argument("new", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--output",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="Write all changes to this CSV file, one row per added, removed or changed row.",
+)
+def diff(old, new, output):
+    from salt_portal_backup.diff import diff_backups, diff_summary
+
+    changes = diff_backups(old, new)
+    click.echo(diff_summary(changes).to_string())
+    if output is not None:
+        changes.to_csv(output, index=False)
+        click.echo(f"Wrote {changes.shape[0]} changes to {output}")
+
+
+@main.command(
+    "archive",
+    short_help="Add a backup database to an archive of snapshots.",
+    help="""
+    Add the backup database DATABASE as a snapshot to the archive ARCHIVE, created if not
+    existing. Data unchanged since earlier snapshots is stored only once.
+    """,
+)
+@click.argument("database", type=click.Path(exists=True, dir_okay=False))
+@click.argument("archive", type=click.Path(dir_okay=False))
+@click.option(
+    "-c",
+    "--storage_codec",
+    default=None,
+    type=click.Choice(["zlib", "zstd"]),
+    help="Compression of csv files stored uncompressed in DATABASE. Default zstd if installed.",
+)
+def archive_backup(database, archive, storage_codec):
+    from salt_portal_backup.archive import add_snapshot
+
+    try:
+        add_snapshot(database, archive, storage_codec=storage_codec)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+
+
+@main.command(
+    short_help="List the snapshots of an archive.",
+    help="List the snapshots of the archive ARCHIVE.",
+)
+@click.argument("archive", type=click.Path(exists=True, dir_okay=False))
+def snapshots(archive):
+    from salt_portal_backup.archive import list_snapshots
+
+    columns = ["id", "datetime_created", "created_by_user", "salt_portal_version", "n_stations"]
+    click.echo(list_snapshots(archive)[columns].to_string(index=False))
+
+
+@main.command(
+    short_help="Restore a snapshot of an archive as a backup database.",
+    help="""
+    Restore a snapshot of the archive ARCHIVE as a backup database, by default the latest
+    snapshot.
+    """,
+)
+@click.argument("archive", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "-o",
+    "--output_database",
+    required=True,
+    help="Path to the new SQLite database to restore the snapshot to.",
+)
+@click.option(
+    "--snapshot",
+    "snapshot_id",
+    default=None,
+    type=int,
+    help="Id of the snapshot to restore, see the snapshots command. Default the latest.",
+)
+@click.option(
+    "--sqlite_profile",
+    default="safe",
+    show_default=True,
+    type=click.Choice(["default", "safe", "fast"]),
+    help="SQLite settings used while writing the restored database.",
+)
+@click.option(
+    "--parse_series",
+    is_flag=True,
+    default=False,
+    help="Parse the time series of the measurement CSVs into the measurement_series table.",
+)
+def restore(archive, output_database, snapshot_id, sqlite_profile, parse_series):
+    from salt_portal_backup.archive import restore_snapshot
+
+    try:
+        restore_snapshot(
+            archive,
+            output_database,
+            snapshot_id=snapshot_id,
+            sqlite_profile=sqlite_profile,
+            parse_series=parse_series,
+        )
+    except ValueError as error:
+        raise click.UsageError(str(error))
 
 
 if __name__ == "__main__":
+    import multiprocessing
+
+    multiprocessing.freeze_support()  # parse processes of the pyinstaller executable
     main()
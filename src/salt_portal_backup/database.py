@@ -6,26 +6,173 @@
 TODO: control schema against .sql
 """
 
+import json
 from datetime import datetime
 from pathlib import Path
 
 from sqlalchemy.orm import relationship
 
 from sqlalchemy import ForeignKey, CheckConstraint
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
 from sqlalchemy.dialects.sqlite import (
     TEXT,
 )  # not strictly necessary since sqlite use type affinity, but makes the type explicit
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
-
-DATABASE_VERSION = 1
+from sqlalchemy.orm import declared_attr
+
+from .storage import decompress, content_hash
+
+DATABASE_VERSION = 5
+
+# SQLite pragmas applied to every connection. default keeps the SQLite defaults, safe uses
+# write-ahead logging which stays consistent on crashes, fast turns off syncing to disk and
+# risks a corrupt database if the computer crashes or loses power during the backup.
+SQLITE_PROFILES = {
+    "default": {},
+    "safe": {
+        "page_size": 8192,
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64000,  # KiB
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+    },
+    "fast": {
+        "page_size": 8192,
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -256000,  # KiB
+        "mmap_size": 1073741824,
+        "temp_store": "MEMORY",
+    },
+}
+
+# Pragmas replacing those of the profile in a memory-bounded backup, see run_backup. The page
+# cache and the memory-mapped part of the database file count as resident memory, and grow
+# with the database up to cache_size and mmap_size.
+LOW_MEMORY_PRAGMAS = {
+    "cache_size": -8000,  # KiB
+    "mmap_size": 0,
+}
+
+# Pragmas of the database file, set by the writer and not on the connections reading it
+FILE_PRAGMAS = ("page_size", "journal_mode")
+
+# ms a connection waits for the lock held by another connection before failing with
+# "database is locked", e.g. a reading thread while the writer commits
+BUSY_TIMEOUT_MS = 30_000
+
+# Secondary indexes, created when the backup is finalized instead of being updated on
+# every insert during the backup. The indexes by station and time serve the queries of
+# salt_portal_backup.reader, e.g. the measurements of a station in a time window and the
+# latest calibration of each station, and lookups by station only.
+SECONDARY_INDEXES = {
+    "ix_measurement_station_id_datetime": ("measurement", ("station_id", "datetime")),
+    "ix_measurement_datetime": ("measurement", ("datetime",)),
+    "ix_measurement_group_id": ("measurement", ("group_id",)),
+    "ix_calibration_station_id_datetime": (
+        "calibration",
+        ("station_id", "datetime_of_calibration", "id"),
+    ),
+}
+
+# indexes of earlier versions, replaced by the ones above
+OBSOLETE_INDEXES = ("ix_measurement_station_id", "ix_calibration_station_id")
+
+# Columns of the Salt Portal csv files mapped to the columns of the measurement and
+# calibration tables
+MEASUREMENT_COLUMNS = {
+    "ID": "id",
+    "group": "group_id",
+    "Date of Measurement": "datetime",
+    "End time of Measurement": "datetime_end",
+    "Flow (cms)": "flow_cms",
+    "Measurement Uncertainty": "uncertainty_percent",
+    "Notes": "notes",
+    "Modified": "datetime_modified",
+    "Last Modified By": "modified_by",
+    "Locked from Update and Delete": "locked_update_delete",
+    "Locked By": "locked_by",
+    "Party": "party",
+    "Created By": "created_by",
+    "Stage (m)": "stage_m",
+    "Stage Time": "stage_datetime",
+    "DL Stage (m)": "dl_stage_m",
+    "Ref Stage (m)": "ref_stage_m",
+    "Type": "type",
+    "Filename": "filename",
+    "RatingCurveIds": "rating_curve_ids",
+    "States": "states",
+}
+
+CALIBRATION_COLUMNS = {
+    "ID": "id",
+    "Date of Calibration": "datetime_of_calibration",
+    "Coefficient of Variation of the Calibration Regression(R^2)": "coeff_var_regression_r2",
+    "Temperature-adjusted Conductivity vs Concentration Regression Coefficient": "cf_t",
+    "CF.T Uncertainty": "cf_t_uncertainty",
+    "Volume of Distilled H20 used in calibration.": "volume_distilled_water_calibration_l",
+    "Mass of salt used in calibration.": "mass_salt_calibration_mg",
+    "Volume of H20 from stream used in calibration.": "volume_stream_water_calibration_l",
+    "Volume of calibration solution injected at each step of 5-point calibration.": (
+        "volume_injection_calibration_solution_ml"
+    ),
+    "First calibration step ECT.": "ec_t_step_1",
+    "Second calibration step ECT.": "ec_t_step_2",
+    "Third calibration step ECT.": "ec_t_step_3",
+    "Fourth calibration step ECT.": "ec_t_step_4",
+    "Fifth calibration step ECT.": "ec_t_step_5",
+    "Filename": "filename",
+}
 
 
 class Base(DeclarativeBase): ...
 
 
+class Blob(Base):
+    """Compressed downloaded file, stored once and referenced by its sha256"""
+
+    __tablename__ = "blob"
+    sha256: Mapped[str] = mapped_column(TEXT, primary_key=True)
+    codec: Mapped[str] = mapped_column(TEXT)
+    size: Mapped[int] = mapped_column()
+    data: Mapped[bytes] = mapped_column()
+
+    @property
+    def payload(self):
+        return decompress(self.data, self.codec)
+
+
+class PayloadMixin:
+    """Table holding a downloaded file, stored inline in the payload column or as a reference
+    to the blob table, depending on the storage codec. payload_sha256 is the content_hash of
+    the file in both cases."""
+
+    __payload_column__: str
+
+    blob_sha256: Mapped[str] = mapped_column(ForeignKey("blob.sha256"), nullable=True)
+    payload_sha256: Mapped[str] = mapped_column(TEXT, nullable=True)
+
+    @declared_attr
+    def blob(cls) -> Mapped["Blob"]:
+        return relationship()
+
+    @property
+    def payload(self):
+        if self.blob_sha256 is not None:
+            return self.blob.payload
+        return getattr(self, self.__payload_column__)
+
+    def payload_equals(self, payload):
+        if self.blob_sha256 is not None:
+            return self.blob_sha256 == content_hash(payload)
+        return getattr(self, self.__payload_column__) == payload
+
+
 class Station(Base):
     __tablename__ = "station"
 
@@ -76,22 +223,39 @@ class Measurement(Base):
     filename: Mapped[str] = mapped_column(TEXT)
     rating_curve_ids: Mapped[str] = mapped_column(TEXT, nullable=True)
     states: Mapped[str] = mapped_column(TEXT, nullable=True)
+    row_hash: Mapped[str] = mapped_column(TEXT, nullable=True)
     csv_data: Mapped["MeasurementCSVData"] = relationship(back_populates="measurement")
 
 
-class MeasurementCSVData(Base):
+class MeasurementCSVData(PayloadMixin, Base):
     __tablename__ = "measurement_csv_data"
+    __payload_column__ = "csv_data"
     measurement_id: Mapped[int] = mapped_column(
         ForeignKey("measurement.id"), primary_key=True
     )  # Should be 1-to-1, TODO OK? better to use separate id to make sure?
     measurement: Mapped["Measurement"] = relationship(back_populates="csv_data")
-    csv_data: Mapped[str] = mapped_column(TEXT)
+    csv_data: Mapped[str] = mapped_column(TEXT, nullable=True)
+
+
+class MeasurementSeries(Base):
+    """Numeric time series parsed from the measurement csv data, one row per sample"""
 
+    __tablename__ = "measurement_series"
+    __table_args__ = {"sqlite_with_rowid": False}  # rows stored clustered by measurement
+    measurement_id: Mapped[int] = mapped_column(ForeignKey("measurement.id"), primary_key=True)
+    sample: Mapped[int] = mapped_column(primary_key=True)
+    datetime: Mapped[str] = mapped_column(TEXT, nullable=True)
+    time_s: Mapped[float] = mapped_column(nullable=True)
+    ec: Mapped[float] = mapped_column(nullable=True)
+    ec_t: Mapped[float] = mapped_column(nullable=True)
+    temperature: Mapped[float] = mapped_column(nullable=True)
 
-class MeasurementGroup(Base):
+
+class MeasurementGroup(PayloadMixin, Base):
     __tablename__ = "measurement_group"
+    __payload_column__ = "group_summary"
     id: Mapped[int] = mapped_column(primary_key=True)
-    group_summary: Mapped[str] = mapped_column(TEXT)
+    group_summary: Mapped[str] = mapped_column(TEXT, nullable=True)
     measurements: Mapped["Measurement"] = relationship(back_populates="group")
 
 
@@ -114,6 +278,7 @@ class Calibration(Base):
     ec_t_step_4: Mapped[float] = mapped_column()
     ec_t_step_5: Mapped[float] = mapped_column()
     filename: Mapped[str] = mapped_column(TEXT)
+    row_hash: Mapped[str] = mapped_column(TEXT, nullable=True)
 
 
 class Version(Base):
@@ -123,6 +288,30 @@ class Version(Base):
     salt_portal_version: Mapped[str] = mapped_column(TEXT)
     datetime_created: Mapped[str] = mapped_column(TEXT)
     created_by_user: Mapped[str] = mapped_column(TEXT)
+    run_id: Mapped[str] = mapped_column(TEXT, nullable=True)
+    storage_codec: Mapped[str] = mapped_column(TEXT, nullable=True)
+
+
+class RunStats(Base):
+    """Timings and request statistics of each backup run, summary is a json document"""
+
+    __tablename__ = "run_stats"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    run_id: Mapped[str] = mapped_column(TEXT)
+    engine: Mapped[str] = mapped_column(TEXT)
+    datetime_started: Mapped[str] = mapped_column(TEXT)
+    datetime_completed: Mapped[str] = mapped_column(TEXT)
+    duration_s: Mapped[float] = mapped_column()
+    summary: Mapped[str] = mapped_column(TEXT)
+
+
+class StationCheckpoint(Base):
+    """Stations completed and committed in the run with run_id, used to resume a backup"""
+
+    __tablename__ = "station_checkpoint"
+    station_id: Mapped[int] = mapped_column(ForeignKey("station.id"), primary_key=True)
+    run_id: Mapped[str] = mapped_column(TEXT)
+    datetime_completed: Mapped[str] = mapped_column(TEXT)
 
 
 class RatingCurve(Base):
@@ -132,34 +321,127 @@ class RatingCurve(Base):
     station: Mapped["Station"] = relationship(back_populates="rating_curves")
 
 
-class StationListRaw(Base):
+class StationListRaw(PayloadMixin, Base):
     __tablename__ = "station_list_raw"
+    __payload_column__ = "raw_station_data"
     id: Mapped[int] = mapped_column(primary_key=True)
-    raw_station_data: Mapped[str] = mapped_column(TEXT)
+    raw_station_data: Mapped[str] = mapped_column(TEXT, nullable=True)
 
 
-class MeasurementRaw(Base):
+class MeasurementRaw(PayloadMixin, Base):
     __tablename__ = "measurement_raw"
+    __payload_column__ = "station_raw_measurement_data"
     station_id: Mapped[int] = mapped_column(ForeignKey("station.id"), primary_key=True)
     station: Mapped["Station"] = relationship(back_populates="measurements_raw")
-    station_raw_measurement_data: Mapped[str] = mapped_column(TEXT)
+    station_raw_measurement_data: Mapped[str] = mapped_column(TEXT, nullable=True)
 
 
-class CalibrationRaw(Base):
+class CalibrationRaw(PayloadMixin, Base):
     __tablename__ = "calibration_raw"
+    __payload_column__ = "station_raw_calibration_data"
     station_id: Mapped[int] = mapped_column(ForeignKey("station.id"), primary_key=True)
     station: Mapped["Station"] = relationship(back_populates="calibrations_raw")
-    station_raw_calibration_data: Mapped[str] = mapped_column(TEXT)
-
+    station_raw_calibration_data: Mapped[str] = mapped_column(TEXT, nullable=True)
+
+
+def frame_to_records(frame, column_map, **values) -> list:
+    """Rename the columns of a Salt Portal data frame to the columns of a table, as a list of
+    dicts for bulk inserts. Missing values are None, values are added as constant columns."""
+    records = frame[list(column_map)].rename(columns=column_map)
+    for column, value in values.items():
+        records[column] = value
+    records = records.astype(object).where(records.notna(), None)
+    return records.to_dict("records")
+
+
+def _stored_value(column, value):
+    """value as stored in column, independent of the dtype pandas inferred for the frame it
+    comes from: integers of float columns as int, NaN as None and datetimes as text"""
+    if value is None or value != value:
+        return None
+    python_type = column.type.python_type
+    if python_type is int and not isinstance(value, str):
+        return int(value)
+    if python_type is float and not isinstance(value, str):
+        return float(value)
+    if python_type is str and isinstance(value, datetime):
+        return value.isoformat(sep=" ")
+    return value
+
+
+def add_row_hashes(records, model):
+    """Add row_hash to records of the table of model, the sha256 of the values of the other
+    columns. The values are first normalized to the values stored by the columns, so equal rows
+    have equal hashes. Rows of two backups are compared by their hashes in
+    salt_portal_backup.diff."""
+    columns = model.__table__.columns
+    for record in records:
+        for key, value in record.items():
+            record[key] = _stored_value(columns[key], value)
+        record["row_hash"] = content_hash(json.dumps(sorted(record.items()), default=str))
+    return records
+
+
+def _set_sqlite_pragmas(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # page_size first, it can not be changed once the database is in WAL mode
+        for pragma, value in pragmas.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+        cursor.close()
+
+    return set_pragmas
+
+
+def sqlite_pragmas(sqlite_profile="safe", low_memory=False):
+    """Pragmas set on each connection to the backup database, see initialize_database"""
+    if sqlite_profile not in SQLITE_PROFILES:
+        raise ValueError(
+            f"Unknown SQLite profile {sqlite_profile}, must be one of "
+            f"{', '.join(SQLITE_PROFILES)}"
+        )
+    pragmas = {**SQLITE_PROFILES[sqlite_profile], "busy_timeout": BUSY_TIMEOUT_MS}
+    if low_memory:
+        pragmas.update(LOW_MEMORY_PRAGMAS)
+    return pragmas
+
+
+def create_read_engine(db_engine, sqlite_profile="safe", low_memory=False):
+    """Engine reading the backup database of db_engine from other threads than the writer,
+    with the pragmas of the profile. The connections are closed after use, not kept in a pool,
+    so the database can be finalized."""
+    read_engine = create_engine(db_engine.url, poolclass=NullPool)
+    pragmas = sqlite_pragmas(sqlite_profile, low_memory)
+    for pragma in FILE_PRAGMAS:
+        pragmas.pop(pragma, None)
+    event.listen(read_engine, "connect", _set_sqlite_pragmas(pragmas))
+    return read_engine
+
+
+def initialize_database(
+    database_name: str = None,
+    incremental: bool = False,
+    sqlite_profile: str = "safe",
+    low_memory: bool = False,
+) -> create_engine:
+    """Create the engine for the backup database.
+
+    The tables are dropped and recreated, unless incremental is True in which case the tables
+    of an existing database are kept, as needed for incremental and resumed backups.
+
+    sqlite_profile is one of SQLITE_PROFILES, the pragmas set on each connection, with a
+    busy_timeout of BUSY_TIMEOUT_MS. With low_memory=True the LOW_MEMORY_PRAGMAS replace
+    those of the profile.
+    """
+    pragmas = sqlite_pragmas(sqlite_profile, low_memory)
 
-def initialize_database(database_name: str = None) -> create_engine:
     if database_name is None:
         db_filename = "salt_portal_" + datetime.now().strftime("%Y%m%d_%H%M%S") + ".db"
         database_name = str(
             Path.home() / db_filename
         )  # FIXME can we do create_engine without str concat?
 
-    if Path(database_name).exists():
+    if Path(database_name).exists() and not incremental:
         print(
             "Database file already exists. It is recommended to backup to a new database. "
             "Proceed with existing database, possiblity leading to data loss of already existing data?"
@@ -167,10 +449,55 @@ def initialize_database(database_name: str = None) -> create_engine:
         # TODO implement
 
     db_engine = create_engine("sqlite:///" + database_name, echo=False)
+    event.listen(db_engine, "connect", _set_sqlite_pragmas(pragmas))
 
-    Base.metadata.drop_all(db_engine)
+    if not incremental:
+        Base.metadata.drop_all(db_engine)
     Base.metadata.create_all(db_engine)
 
-    print("Backup to " + database_name)
+    if incremental:
+        print("Incremental backup to " + database_name)
+    else:
+        print("Backup to " + database_name)
 
     return db_engine
+
+
+def create_secondary_indexes(connection):
+    """Create the SECONDARY_INDEXES, drop the OBSOLETE_INDEXES and update the statistics
+    used by the query planner"""
+    for index_name in OBSOLETE_INDEXES:
+        connection.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+    for index_name, (table_name, columns) in SECONDARY_INDEXES.items():
+        connection.execute(
+            text(
+                f"CREATE INDEX IF NOT EXISTS {index_name} "
+                f"ON {table_name} ({', '.join(columns)})"
+            )
+        )
+    connection.execute(text("ANALYZE"))
+
+
+def finalize_database(db_engine, vacuum: bool = False):
+    """Finalize the backup database when the backup is complete.
+
+    Creates the secondary indexes, updates the statistics used by the query planner and
+    optionally rebuilds the database file with VACUUM. A database in WAL mode is set back to
+    the default rollback journal, so the backup is a single self-contained file.
+    """
+    with db_engine.begin() as connection:
+        create_secondary_indexes(connection)
+
+    # VACUUM and journal mode changes can not run inside a transaction
+    with db_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        if vacuum:
+            connection.execute(text("VACUUM"))
+        if connection.execute(text("PRAGMA journal_mode")).scalar() == "wal":
+            connection.execute(text("PRAGMA wal_checkpoint(TRUNCATE)"))
+            try:
+                connection.execute(text("PRAGMA journal_mode = DELETE"))
+            except OperationalError:
+                # needs exclusive access, the database is still complete in WAL mode
+                print("Database is in use by another connection, keeping WAL journal mode")
+
+    db_engine.dispose()
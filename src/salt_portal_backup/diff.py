@@ -0,0 +1,123 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Differences between two backup databases, e.g. the backups of two days.
+
+Both databases are attached to one SQLite connection and compared with set based queries,
+without loading the rows in python. Measurements and calibrations are compared by the
+row_hash stored when they are written, the measurement csv data by the payload_sha256
+stored with them, the sha256 of the content whether it is stored inline or compressed.
+Stations are compared column by column.
+
+The report has one row per change: table, id, station_id and change, which is added,
+removed or changed. Measurement csv data is reported under the table measurement_csv_data.
+"""
+
+from pathlib import Path
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from .database import Base, DATABASE_VERSION
+
+DIFF_CHANGES = ("added", "removed", "changed")
+
+
+def _compared_tables():
+    """(table, id column, station column of the rows, compared value) of the tables compared,
+    the compared value is an SQL expression of the row in {db}"""
+    station_columns = [c for c in Base.metadata.tables["station"].columns.keys() if c != "id"]
+    station_values = ", ".join(f"{{db}}.station.{column}" for column in station_columns)
+    return [
+        ("station", "id", "{db}.station.id", station_values),
+        ("measurement", "id", "{db}.measurement.station_id", "{db}.measurement.row_hash"),
+        (
+            "measurement_csv_data",
+            "measurement_id",
+            "(SELECT station_id FROM {db}.measurement "
+            "WHERE id = {db}.measurement_csv_data.measurement_id)",
+            "{db}.measurement_csv_data.payload_sha256",
+        ),
+        ("calibration", "id", "{db}.calibration.station_id", "{db}.calibration.row_hash"),
+    ]
+
+
+def _check_version(connection, db, path):
+    database_version = connection.execute(
+        text(f"SELECT database_version FROM {db}.version WHERE id = 0")
+    ).scalar()
+    if database_version != DATABASE_VERSION:
+        raise Exception(
+            f"Database version {database_version} of {path} does not match version "
+            f"{DATABASE_VERSION}, can not diff"
+        )
+
+
+def _changes_query(table, id_column, station_column, value):
+    def row(db):
+        return {
+            "id": f"{db}.{table}.{id_column}",
+            "station": station_column.format(db=db),
+            "value": value.format(db=db),
+        }
+
+    old, new = row("old"), row("new")
+    # a row value (a, b, ...) IS NOT (c, d, ...) is not supported, compare a single value
+    if "," in old["value"]:
+        old["value"] = f"json_array({old['value']})"
+        new["value"] = f"json_array({new['value']})"
+
+    return f"""
+        SELECT '{table}' AS "table", {new['id']} AS id, {new['station']} AS station_id,
+            'added' AS change
+        FROM new.{table} LEFT JOIN old.{table} ON {old['id']} = {new['id']}
+        WHERE {old['id']} IS NULL
+        UNION ALL
+        SELECT '{table}', {old['id']}, {old['station']}, 'removed'
+        FROM old.{table} LEFT JOIN new.{table} ON {new['id']} = {old['id']}
+        WHERE {new['id']} IS NULL
+        UNION ALL
+        SELECT '{table}', {new['id']}, {new['station']}, 'changed'
+        FROM old.{table} JOIN new.{table} ON {new['id']} = {old['id']}
+        WHERE {old['value']} IS NOT {new['value']}
+    """
+
+
+def diff_backups(old_database_path, new_database_path):
+    """Compare the backup database at new_database_path to the one at old_database_path.
+
+    Returns the changes as a data frame with the columns table, id, station_id and change,
+    ordered by table, station and id.
+    """
+    for path in (old_database_path, new_database_path):
+        if not Path(path).exists():
+            raise FileNotFoundError(path)
+
+    db_engine = create_engine("sqlite://", echo=False)
+
+    changes = []
+    with db_engine.connect() as connection:
+        for db, path in (("old", old_database_path), ("new", new_database_path)):
+            connection.execute(text(f"ATTACH DATABASE :path AS {db}"), {"path": str(path)})
+            _check_version(connection, db, path)
+
+        for compared_table in _compared_tables():
+            result = connection.execute(text(_changes_query(*compared_table)))
+            changes.append(pd.DataFrame(result.fetchall(), columns=list(result.keys())))
+
+    db_engine.dispose()
+
+    changes = pd.concat(changes, ignore_index=True)
+    order = {table: i for i, (table, *_) in enumerate(_compared_tables())}
+    return changes.sort_values(
+        ["table", "station_id", "id"], key=lambda c: c.map(order) if c.name == "table" else c
+    ).reset_index(drop=True)
+
+
+def diff_summary(changes):
+    """Number of changes by table and change"""
+    summary = pd.crosstab(changes["table"], changes["change"])
+    tables = [table for table, *_ in _compared_tables()]
+    return summary.reindex(index=tables, columns=list(DIFF_CHANGES), fill_value=0)
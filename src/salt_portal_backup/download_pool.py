@@ -0,0 +1,114 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Bounded worker pool for downloading measurement and group CSVs concurrently.
+
+Only the downloads run in worker threads, the results are handed back to the caller
+which remains the single writer to the database session.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+
+class HostLimiter:
+    """Cap the number of concurrent requests against each host"""
+
+    def __init__(self, max_per_host):
+        self.max_per_host = max_per_host
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._semaphores[host]
+
+
+class DownloadPool:
+    """Download urls with up to max_workers threads sharing one requests session.
+
+    With max_workers=1 the downloads are done sequentially in the calling thread.
+    """
+
+    def __init__(self, s_request, max_workers=1, max_per_host=4):
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1")
+        if max_per_host < 1:
+            raise ValueError("max_per_host must be at least 1")
+
+        self.s_request = s_request
+        self.max_workers = max_workers
+        self.host_limiter = HostLimiter(max_per_host)
+        # keep the number of unconsumed responses bounded
+        self.max_pending = 2 * max_workers
+        self._executor = None
+
+        if max_workers > 1:
+            # default pool_maxsize of 10 would otherwise discard connections
+            adapter = HTTPAdapter(pool_maxsize=max_workers)
+            s_request.mount("https://", adapter)
+            s_request.mount("http://", adapter)
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="salt_portal_download"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def get(self, url, headers, process=None):
+        with self.host_limiter(url):
+            if process is None:
+                return self.s_request.get(url, headers=headers)
+
+            with self.s_request.get(url, headers=headers, stream=True) as response:
+                return process(response)
+
+    def download(self, urls, headers, process=None):
+        """Download all urls, urls is a dict of key: url.
+
+        Yields (key, response) in order of completion. If process is given, the responses are
+        streamed and passed to process in the worker thread, and (key, process(response)) is
+        yielded instead.
+        """
+        # headers are shared by the worker threads, don't let later changes leak in
+        headers = headers.copy()
+
+        if self._executor is None:
+            for key, url in urls.items():
+                yield key, self.get(url, headers, process)
+            return
+
+        url_items = iter(urls.items())
+        pending = {}
+        try:
+            while True:
+                for key, url in url_items:
+                    pending[self._executor.submit(self.get, url, headers, process)] = key
+                    if len(pending) >= self.max_pending:
+                        break
+
+                if not pending:
+                    return
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+        finally:
+            for future in pending:
+                future.cancel()
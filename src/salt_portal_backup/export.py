@@ -0,0 +1,254 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Export of a backup database to Parquet datasets, one per table, for reading with pandas,
+polars or other Arrow based tools, e.g. pd.read_parquet("export/measurement").
+
+The tables in PARTITIONED_TABLES are partitioned by project and station, as
+project_id=.../station_id=... directories. The other tables are written unpartitioned. The
+downloaded files are exported with their content, decompressed from the blob table, which
+itself is not exported.
+
+The rows are read and written in batches of batch_size rows, so the memory use does not
+depend on the size of the backup. With decode_series=True the measurement_series dataset is
+parsed from the measurement csv data during the export, see salt_portal_backup.series,
+instead of exported from the measurement_series table.
+
+Requires pyarrow, install with: pip install salt-portal-backup[parquet]
+"""
+
+import shutil
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from sqlalchemy import create_engine, select, text
+
+if TYPE_CHECKING:
+    import pyarrow as pa  # type: ignore[import-untyped]
+    import pyarrow.dataset as pa_dataset  # type: ignore[import-untyped]
+    import pyarrow.parquet as pa_parquet  # type: ignore[import-untyped]
+else:
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset as pa_dataset
+        import pyarrow.parquet as pa_parquet
+    except ImportError:  # optional dependency
+        pa = pa_dataset = pa_parquet = None
+
+from .database import Base
+from .series import series_frame, fill_series_datetime
+from .storage import decompress
+
+EXPORT_BATCH_SIZE = 50_000
+
+# measurement csv files parsed per batch with decode_series, each is many series rows
+SERIES_BATCH_SIZE = 100
+
+PARTITIONED_TABLES = ("measurement", "calibration", "measurement_csv_data", "measurement_series")
+PARTITION_COLUMNS = ("project_id", "station_id")
+
+# files kept open while writing a partitioned dataset, with more stations the files of the least
+# recently written partitions are closed, and a partition written to again gets another file
+MAX_OPEN_FILES = 1024
+
+# not exported, the contents are exported in the tables referencing them
+EXCLUDED_TABLES = ("blob",)
+
+
+def _payload_columns():
+    """Payload column of each table holding downloaded files, by table name"""
+    return {
+        mapper.local_table.name: mapper.class_.__payload_column__
+        for mapper in Base.registry.mappers
+        if hasattr(mapper.class_, "__payload_column__")
+    }
+
+
+def _arrow_type(column):
+    python_type = column.type.python_type
+    if python_type is int:
+        return pa.int64()
+    if python_type is float:
+        return pa.float64()
+    if python_type is bytes:
+        return pa.binary()
+    return pa.string()
+
+
+def _table_query(table, payload_column=None):
+    """SQL selecting the rows of table, with project_id and station_id for the partitioned
+    tables and the compressed blob of the payload, if any"""
+    columns = [f"t.{column}" for column in table.columns.keys() if column != "blob_sha256"]
+    joins = ""
+    if table.name in PARTITIONED_TABLES:
+        if "station_id" in table.columns:
+            columns = ["s.project_id", *columns]
+            joins = " JOIN station s ON s.id = t.station_id"
+        else:
+            columns = ["s.project_id", "m.station_id", *columns]
+            joins = (
+                " JOIN measurement m ON m.id = t.measurement_id"
+                " JOIN station s ON s.id = m.station_id"
+            )
+    if payload_column is not None:
+        columns += ["b.codec", "b.data"]
+        joins += " LEFT JOIN blob b ON b.sha256 = t.blob_sha256"
+    return f"SELECT {', '.join(columns)} FROM {table.name} t{joins}"
+
+
+def _table_schema(table, payload_column=None):
+    fields = []
+    if table.name in PARTITIONED_TABLES:
+        fields += [pa.field("project_id", pa.int64())]
+        if "station_id" not in table.columns:
+            fields += [pa.field("station_id", pa.int64())]
+    for column in table.columns.values():
+        if column.name == "blob_sha256":
+            continue
+        arrow_type = pa.binary() if column.name == payload_column else _arrow_type(column)
+        fields.append(pa.field(column.name, arrow_type))
+    return pa.schema(fields)
+
+
+def _table_batches(connection, table, schema, batch_size, payload_column=None):
+    result = connection.execution_options(stream_results=True).execute(
+        text(_table_query(table, payload_column))
+    )
+    for rows in result.partitions(batch_size):
+        columns = list(zip(*rows))
+        if payload_column is not None:
+            # payloads are stored inline, or compressed in the blob table
+            *columns, codecs, blobs = columns
+            i_payload = schema.get_field_index(payload_column)
+            columns[i_payload] = [
+                decompress(blob, codec) if blob is not None else _as_bytes(inline)
+                for inline, codec, blob in zip(columns[i_payload], codecs, blobs)
+            ]
+        yield pa.RecordBatch.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+            schema=schema,
+        )
+
+
+def _as_bytes(payload):
+    if isinstance(payload, str):
+        return payload.encode()
+    return payload
+
+
+def _series_batches(connection, schema, batch_size):
+    """Record batches of the time series parsed from the measurement csv data"""
+    table = Base.metadata.tables["measurement_csv_data"]
+    measurement = Base.metadata.tables["measurement"]
+    batches = _table_batches(
+        connection, table, _table_schema(table, "csv_data"), batch_size, "csv_data"
+    )
+    for batch in batches:
+        csv_batch = batch.to_pydict()
+        frame = series_frame(list(zip(csv_batch["measurement_id"], csv_batch["csv_data"])))
+        if frame.empty:
+            continue
+        start_datetimes = dict(
+            connection.execute(
+                select(measurement.c.id, measurement.c.datetime).where(
+                    measurement.c.id.in_(csv_batch["measurement_id"])
+                )
+            ).all()
+        )
+        frame = fill_series_datetime(frame, start_datetimes)
+        stations = dict(
+            zip(
+                csv_batch["measurement_id"],
+                zip(csv_batch["project_id"], csv_batch["station_id"]),
+            )
+        )
+        frame["project_id"] = [stations[m_id][0] for m_id in frame["measurement_id"]]
+        frame["station_id"] = [stations[m_id][1] for m_id in frame["measurement_id"]]
+        yield pa.RecordBatch.from_pandas(frame, schema=schema, preserve_index=False)
+
+
+def _write_dataset(batches, path, schema, partitioned, overwrite, n_stations=0):
+    """Write batches to the dataset at path, partitioned by project and station if
+    partitioned, a batch may have rows of all the n_stations stations"""
+    if path.exists() and any(path.iterdir()):
+        if not overwrite:
+            raise FileExistsError(f"Dataset {path} already exists")
+        # partitions of stations no longer in the backup are removed as well
+        shutil.rmtree(path)
+
+    pa_dataset.write_dataset(
+        batches,
+        path,
+        schema=schema,
+        format="parquet",
+        partitioning=list(PARTITION_COLUMNS) if partitioned else None,
+        partitioning_flavor="hive" if partitioned else None,
+        max_partitions=max(n_stations, 1024),
+        max_open_files=MAX_OPEN_FILES,
+    )
+    if not path.exists():
+        # no rows, write the schema so the dataset can still be read
+        path.mkdir(parents=True)
+        pa_parquet.write_table(schema.empty_table(), path / "part-0.parquet")
+
+
+def export_parquet(
+    database_path,
+    output_dir,
+    tables=None,
+    decode_series=False,
+    batch_size=EXPORT_BATCH_SIZE,
+    overwrite=False,
+):
+    """Export the tables of the backup database at database_path to Parquet datasets in
+    output_dir, one directory per table.
+
+    tables is a list of the table names to export, default all tables. With
+    decode_series=True the measurement_series dataset is parsed from the measurement csv
+    data. An existing dataset in output_dir is an error, unless overwrite is True in which
+    case it is replaced. Returns
+    the paths of the exported datasets by table name.
+    """
+    if pa is None:
+        raise ImportError(
+            "export_parquet requires pyarrow, install with: pip install salt-portal-backup[parquet]"
+        )
+
+    all_tables = [t.name for t in Base.metadata.sorted_tables if t.name not in EXCLUDED_TABLES]
+    if tables is None:
+        tables = all_tables
+    unknown_tables = set(tables) - set(all_tables)
+    if unknown_tables:
+        raise ValueError(
+            f"Unknown tables {', '.join(sorted(unknown_tables))}, must be among "
+            f"{', '.join(all_tables)}"
+        )
+    if not Path(database_path).exists():
+        raise FileNotFoundError(database_path)
+
+    payload_columns = _payload_columns()
+    db_engine = create_engine("sqlite:///" + str(database_path), echo=False)
+    dataset_paths = {}
+    with db_engine.connect() as connection:
+        n_stations = connection.execute(text("SELECT count(*) FROM station")).scalar()
+        for table_name in tables:
+            table = Base.metadata.tables[table_name]
+            path = Path(output_dir) / table_name
+            partitioned = table_name in PARTITIONED_TABLES
+
+            if table_name == "measurement_series" and decode_series:
+                schema = _table_schema(table)
+                batches = _series_batches(connection, schema, SERIES_BATCH_SIZE)
+            else:
+                payload_column = payload_columns.get(table_name)
+                schema = _table_schema(table, payload_column)
+                batches = _table_batches(connection, table, schema, batch_size, payload_column)
+
+            _write_dataset(batches, path, schema, partitioned, overwrite, n_stations)
+            dataset_paths[table_name] = path
+            print(f"Exported {table_name} to {path}")
+
+    db_engine.dispose()
+    return dataset_paths
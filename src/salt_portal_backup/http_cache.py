@@ -0,0 +1,262 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Persistent HTTP cache for the requests made during a backup, stored in a separate SQLite
+file next to the backup database.
+
+GET responses with an ETag or Last-Modified header are stored by url, and revalidated on
+the next request with If-None-Match and If-Modified-Since. Urls marked as immutable, the
+csv data of measurements locked from update and delete, are served from the cache without
+a request. Responses setting cookies or marked no-store are never stored. Streamed responses
+are copied to a temporary file as they are read, and stored once read to the end.
+
+The cache is used through CachingAdapter, mounted on the requests session. Requests not
+served from the cache are sent through the RequestScheduler of the adapter, if given.
+"""
+
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPResponse
+
+# header added to responses from the cache, hit (no request) or revalidated (304)
+CACHE_STATUS_HEADER = "X-Salt-Portal-Cache"
+
+_STORED_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+# streamed content larger than this is copied to disk until it is stored
+_SPOOL_MAX_SIZE = 1_000_000
+
+
+class HTTPCache:
+    """Responses stored in the SQLite file at path.
+
+    When closed, entries not used for max_age_days are evicted, followed by the least
+    recently used entries until the stored content is at most max_size_mb.
+    """
+
+    def __init__(self, path, max_size_mb=None, max_age_days=None):
+        self.path = path
+        self.max_size_mb = max_size_mb
+        self.max_age_days = max_age_days
+        self.immutable_urls = set()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS response ("
+            "url TEXT PRIMARY KEY, "
+            "content_type TEXT, "
+            "etag TEXT, "
+            "last_modified TEXT, "
+            "sha256 TEXT, "
+            "size INTEGER, "
+            "content BLOB, "
+            "time_stored REAL, "
+            "time_used REAL)"
+        )
+        self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def mark_immutable(self, urls):
+        """Serve the urls from the cache without a request, if stored"""
+        with self._lock:
+            self.immutable_urls.update(urls)
+
+    def is_immutable(self, url):
+        with self._lock:
+            return url in self.immutable_urls
+
+    def get(self, url):
+        """The stored response of url as a dict, or None"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT content_type, etag, last_modified, content FROM response WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("Content-Type", "ETag", "Last-Modified", "content"), row))
+
+    def touch(self, url):
+        with self._lock:
+            self._connection.execute(
+                "UPDATE response SET time_used = ? WHERE url = ?", (time.time(), url)
+            )
+            self._connection.commit()
+
+    def store(self, url, headers, content):
+        sha256 = hashlib.sha256(content).hexdigest()
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO response VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (url) DO UPDATE SET "
+                "content_type = excluded.content_type, etag = excluded.etag, "
+                "last_modified = excluded.last_modified, time_used = excluded.time_used, "
+                # keep the stored content if unchanged
+                "sha256 = excluded.sha256, size = excluded.size, "
+                "content = iif(sha256 = excluded.sha256, content, excluded.content), "
+                "time_stored = iif(sha256 = excluded.sha256, time_stored, excluded.time_stored)",
+                (
+                    url,
+                    headers.get("Content-Type"),
+                    headers.get("ETag"),
+                    headers.get("Last-Modified"),
+                    sha256,
+                    len(content),
+                    content,
+                    now,
+                    now,
+                ),
+            )
+            self._connection.commit()
+
+    def evict(self):
+        """Evict entries by age and size, returns the number of entries evicted"""
+        with self._lock:
+            evicted = 0
+            if self.max_age_days is not None:
+                evicted += self._connection.execute(
+                    "DELETE FROM response WHERE time_used < ?",
+                    (time.time() - self.max_age_days * 86400,),
+                ).rowcount
+
+            if self.max_size_mb is not None:
+                max_size = self.max_size_mb * 1e6
+                total_size = self._connection.execute(
+                    "SELECT coalesce(sum(size), 0) FROM response"
+                ).fetchone()[0]
+                if total_size > max_size:
+                    lru = self._connection.execute(
+                        "SELECT url, size FROM response ORDER BY time_used"
+                    ).fetchall()
+                    evict_urls = []
+                    for url, size in lru:
+                        if total_size <= max_size:
+                            break
+                        evict_urls.append((url,))
+                        total_size -= size
+                    self._connection.executemany("DELETE FROM response WHERE url = ?", evict_urls)
+                    evicted += len(evict_urls)
+
+            self._connection.commit()
+            return evicted
+
+    def close(self):
+        if self._connection is None:
+            return
+        self.evict()
+        with self._lock:
+            self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._connection.close()
+            self._connection = None
+
+
+def _storable(response):
+    return (
+        response.status_code == 200
+        and "Set-Cookie" not in response.headers
+        and "no-store" not in response.headers.get("Cache-Control", "")
+    )
+
+
+class _StoringStream:
+    """Raw response of a streamed response, storing the content in cache once the response
+    has been streamed to the end. The other attributes are those of the raw response."""
+
+    def __init__(self, raw, cache, url, headers):
+        self._raw = raw
+        self._cache = cache
+        self._url = url
+        self._headers = headers
+        self._spool = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE)
+
+    def stream(self, amt=2**16, decode_content=None):
+        for chunk in self._raw.stream(amt, decode_content=decode_content):
+            self._spool.write(chunk)
+            yield chunk
+        self._spool.seek(0)
+        self._cache.store(self._url, self._headers, self._spool.read())
+        self._spool.close()
+
+    def close(self):
+        self._spool.close()
+        self._raw.close()
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
+class CachingAdapter(HTTPAdapter):
+    """requests transport adapter serving GET requests through an HTTPCache"""
+
+    def __init__(self, cache, scheduler=None, **kwargs):
+        self.cache = cache
+        self.scheduler = scheduler
+        super().__init__(**kwargs)
+
+    def _send(self, request, **kwargs):
+        if self.scheduler is None:
+            return super().send(request, **kwargs)
+        return self.scheduler.send(super().send, request, **kwargs)
+
+    def _cached_response(self, request, entry, cache_status):
+        headers = {name: entry[name] for name in _STORED_HEADERS if entry[name] is not None}
+        headers["Content-Length"] = str(len(entry["content"]))
+        headers[CACHE_STATUS_HEADER] = cache_status
+        raw = HTTPResponse(
+            body=BytesIO(entry["content"]),
+            headers=headers,
+            status=200,
+            reason="OK",
+            preload_content=False,
+            decode_content=False,
+        )
+        return self.build_response(request, raw)
+
+    def send(self, request, stream=False, **kwargs):
+        if request.method != "GET":
+            return self._send(request, stream=stream, **kwargs)
+
+        url = request.url
+        entry = self.cache.get(url)
+
+        if entry is not None and self.cache.is_immutable(url):
+            self.cache.touch(url)
+            return self._cached_response(request, entry, "hit")
+
+        if entry is not None:
+            if entry["ETag"] is not None:
+                request.headers["If-None-Match"] = entry["ETag"]
+            if entry["Last-Modified"] is not None:
+                request.headers["If-Modified-Since"] = entry["Last-Modified"]
+
+        response = self._send(request, stream=stream, **kwargs)
+
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            self.cache.touch(url)
+            return self._cached_response(request, entry, "revalidated")
+
+        has_validator = "ETag" in response.headers or "Last-Modified" in response.headers
+        if _storable(response) and (has_validator or self.cache.is_immutable(url)):
+            if stream:
+                # stored as it is read, reading it here would defeat streaming
+                response.raw = _StoringStream(response.raw, self.cache, url, response.headers)
+            else:
+                self.cache.store(url, response.headers, response.content)
+
+        return response
@@ -0,0 +1,199 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Timing and request statistics of a backup run.
+
+Phases are timed with BackupStats.phase. A phase started inside another phase is only
+counted in the inner phase, so the phase times of a single threaded run add up to at most
+the duration of the run. Phases running concurrently, in download threads or asyncio tasks,
+are summed and can add up to more than the duration of the run.
+
+Requests are recorded per endpoint, the url path with ids replaced by {id}, with the number
+of requests, bytes received and latency percentiles.
+
+The summary also has the peak resident memory of the process, peak_rss_mb.
+"""
+
+import contextvars
+import json
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, UTC
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from .http_cache import CACHE_STATUS_HEADER
+
+LATENCY_PERCENTILES = (50, 90, 99)
+
+_phase_stack = contextvars.ContextVar("phase_stack", default=())
+
+
+def endpoint_name(url):
+    """Endpoint of a url, e.g. /station/{id}/measurements"""
+    return re.sub(r"/\d+(?=/|$)", "/{id}", urlsplit(url).path)
+
+
+def peak_rss_mb():
+    """Peak resident memory of the process in MB, None if it can not be read"""
+    if sys.platform == "win32":
+        return _peak_working_set_mb()
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB on Linux
+    return round(max_rss / 1e6 if sys.platform == "darwin" else max_rss * 1024 / 1e6, 1)
+
+
+def _peak_working_set_mb():
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [
+            ("cb", wintypes.DWORD),
+            ("PageFaultCount", wintypes.DWORD),
+            ("PeakWorkingSetSize", ctypes.c_size_t),
+            ("WorkingSetSize", ctypes.c_size_t),
+            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+            ("PagefileUsage", ctypes.c_size_t),
+            ("PeakPagefileUsage", ctypes.c_size_t),
+        ]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    kernel32 = ctypes.windll.kernel32
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    if not kernel32.K32GetProcessMemoryInfo(
+        kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb
+    ):
+        return None
+    return round(counters.PeakWorkingSetSize / 1e6, 1)
+
+
+class _Frame:
+    def __init__(self):
+        self.child_seconds = 0.0
+
+
+class BackupStats:
+    """Thread safe collection of the phase timings and request statistics of a backup run"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self.datetime_started = datetime.now(UTC).isoformat(timespec="seconds")
+        self.phase_seconds = defaultdict(float)
+        self.phase_counts = defaultdict(int)
+        self.request_latencies = defaultdict(list)
+        self.request_bytes = defaultdict(int)
+        self.request_errors = defaultdict(int)
+        self.retries = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    @contextmanager
+    def phase(self, name):
+        """Time the block as phase name, excluding the time of phases started in the block"""
+        frame = _Frame()
+        stack = _phase_stack.get()
+        token = _phase_stack.set(stack + (frame,))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            _phase_stack.reset(token)
+            with self._lock:
+                self.phase_seconds[name] += seconds - frame.child_seconds
+                self.phase_counts[name] += 1
+                if stack:
+                    stack[-1].child_seconds += seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def record_request(self, url, seconds, n_bytes, status=200):
+        endpoint = endpoint_name(url)
+        with self._lock:
+            self.request_latencies[endpoint].append(seconds)
+            self.request_bytes[endpoint] += n_bytes
+            if status >= 400:
+                self.request_errors[endpoint] += 1
+
+    def record_retry(self, url):
+        with self._lock:
+            self.retries[endpoint_name(url)] += 1
+
+    def response_hook(self, response, *args, **kwargs):
+        """requests response hook recording the request, add to the hooks of a session.
+
+        The body of streamed responses is not read here, their latency is the time until the
+        headers are received and the bytes are taken from the Content-Length header. Responses
+        served from the HTTP cache without a request are only counted.
+        """
+        cache_status = response.headers.get(CACHE_STATUS_HEADER)
+        if cache_status is not None:
+            self.count(f"cache_{cache_status}")
+            if cache_status == "hit":
+                return
+
+        if kwargs.get("stream"):
+            n_bytes = int(response.headers.get("Content-Length", 0))
+            seconds = response.elapsed.total_seconds()
+        else:
+            start = time.perf_counter()
+            n_bytes = len(response.content)  # the body is read here instead of after the hook
+            seconds = response.elapsed.total_seconds() + time.perf_counter() - start
+        self.record_request(response.url, seconds, n_bytes, response.status_code)
+
+    def summary(self):
+        """Statistics of the run as a dict"""
+        with self._lock:
+            endpoints = {}
+            for endpoint, latencies in sorted(self.request_latencies.items()):
+                latencies_ms = np.array(latencies) * 1000
+                endpoints[endpoint] = {
+                    "requests": len(latencies),
+                    "bytes": self.request_bytes[endpoint],
+                    "errors": self.request_errors[endpoint],
+                    "retries": self.retries[endpoint],
+                    **{
+                        f"p{percentile}_ms": round(float(value), 1)
+                        for percentile, value in zip(
+                            LATENCY_PERCENTILES,
+                            np.percentile(latencies_ms, LATENCY_PERCENTILES),
+                        )
+                    },
+                    "max_ms": round(float(latencies_ms.max()), 1),
+                }
+
+            return {
+                "duration_s": round(time.perf_counter() - self._start, 3),
+                "phases": {
+                    name: {"seconds": round(seconds, 3), "count": self.phase_counts[name]}
+                    for name, seconds in self.phase_seconds.items()
+                },
+                "requests": sum(len(latencies) for latencies in self.request_latencies.values()),
+                "bytes": sum(self.request_bytes.values()),
+                "errors": sum(self.request_errors.values()),
+                "retries": sum(self.retries.values()),
+                "endpoints": endpoints,
+                "counters": dict(self.counters),
+                "peak_rss_mb": peak_rss_mb(),
+            }
+
+    def to_json(self, **json_kwargs):
+        return json.dumps(self.summary(), **json_kwargs)
@@ -0,0 +1,153 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Merge backup databases, e.g. the shards of a sharded backup, into one backup database.
+
+The shards are attached to the new database one at a time and their rows copied with
+INSERT ... SELECT, without loading them in python. Shards are merged from the most recently
+created, so if a station was backed up in several shards it is taken from the most recent
+backup, with all its measurements and calibrations. Rows not belonging to a station, like
+projects, groups and blobs, are shared between the shards and stored once.
+"""
+
+import uuid
+from pathlib import Path
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from .database import Base, Version, initialize_database, finalize_database, DATABASE_VERSION
+from .salt_portal import delete_unreferenced_blobs
+
+
+def _shard_version(connection, shard_path):
+    row = (
+        connection.execute(
+            text(
+                "SELECT database_version, salt_portal_version, datetime_created, "
+                "created_by_user, storage_codec FROM shard.version WHERE id = 0"
+            )
+        )
+        .mappings()
+        .first()
+    )
+    if row is None:
+        raise Exception(f"{shard_path} is not a completed backup, it has no version")
+    if row["database_version"] != DATABASE_VERSION:
+        raise Exception(
+            f"Database version {row['database_version']} of {shard_path} does not match "
+            f"version {DATABASE_VERSION}, can not merge"
+        )
+    return dict(row)
+
+
+def _station_filter(table):
+    """Where clause selecting the rows of table belonging to the stations in merge_station,
+    or None if the table is not by station"""
+    columns = table.columns.keys()
+    if table.name == "station":
+        return "id IN (SELECT id FROM temp.merge_station)"
+    if "station_id" in columns:
+        return "station_id IN (SELECT id FROM temp.merge_station)"
+    if "measurement_id" in columns:
+        return (
+            "measurement_id IN (SELECT id FROM shard.measurement "
+            "WHERE station_id IN (SELECT id FROM temp.merge_station))"
+        )
+    return None
+
+
+def merge_shard(connection, shard_path):
+    """Copy the rows of the backup database at shard_path into the database of connection,
+    skipping stations already in it. Returns the number of stations merged."""
+    connection.execute(text("ATTACH DATABASE :path AS shard"), {"path": str(shard_path)})
+    try:
+        connection.execute(text("BEGIN"))
+        connection.execute(text("DELETE FROM temp.merge_station"))
+        n_stations = connection.execute(
+            text(
+                "INSERT INTO temp.merge_station "
+                "SELECT id FROM shard.station WHERE id NOT IN (SELECT id FROM main.station)"
+            )
+        ).rowcount
+
+        for table in Base.metadata.sorted_tables:
+            # the merged backup is a new run, checkpoints of the shard runs do not apply
+            if table.name in ("version", "station_checkpoint"):
+                continue
+            columns = table.columns.keys()
+            if table.name == "run_stats":
+                # run statistics of all shards are kept, with new ids
+                columns = [column for column in columns if column != "id"]
+            column_list = ", ".join(columns)
+            station_filter = _station_filter(table)
+            where = f" WHERE {station_filter}" if station_filter is not None else ""
+            connection.execute(
+                text(
+                    f"INSERT OR IGNORE INTO main.{table.name} ({column_list}) "
+                    f"SELECT {column_list} FROM shard.{table.name}{where}"
+                )
+            )
+        connection.execute(text("COMMIT"))
+    except Exception:
+        connection.execute(text("ROLLBACK"))
+        raise
+    finally:
+        connection.execute(text("DETACH DATABASE shard"))
+    return n_stations
+
+
+def merge_backups(shard_paths, database_path=None, sqlite_profile="safe", vacuum=False):
+    """Merge the backup databases at shard_paths into a new backup database at database_path.
+
+    The shards must have the database version of this version of salt_portal_backup. The
+    version row of the merged database is that of the most recently created shard, with a new
+    run_id. Of shards created at the same time, the first in shard_paths takes precedence.
+    See run_backup for database_path, sqlite_profile and vacuum.
+    """
+    if not shard_paths:
+        raise ValueError("No databases to merge")
+    if database_path is not None and any(
+        Path(database_path).resolve() == Path(shard_path).resolve() for shard_path in shard_paths
+    ):
+        raise ValueError("The merged database can not be one of the databases merged")
+
+    db_engine = initialize_database(database_name=database_path, sqlite_profile=sqlite_profile)
+
+    # explicit transactions, ATTACH and DETACH are not possible inside a transaction
+    with db_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        versions = []
+        for shard_path in shard_paths:
+            connection.execute(text("ATTACH DATABASE :path AS shard"), {"path": str(shard_path)})
+            try:
+                versions.append((_shard_version(connection, shard_path), shard_path))
+            finally:
+                connection.execute(text("DETACH DATABASE shard"))
+
+        connection.execute(text("CREATE TEMP TABLE merge_station (id INTEGER PRIMARY KEY)"))
+        versions.sort(key=lambda version: version[0]["datetime_created"], reverse=True)
+        for _, shard_path in versions:
+            n_stations = merge_shard(connection, shard_path)
+            print(f"Merged {n_stations} stations from {shard_path}")
+
+    latest_version = versions[0][0]
+    codecs = {version["storage_codec"] for version, _ in versions}
+    with Session(db_engine) as s_db:
+        s_db.add(
+            Version(
+                id=0,
+                database_version=DATABASE_VERSION,
+                salt_portal_version=latest_version["salt_portal_version"],
+                datetime_created=latest_version["datetime_created"],
+                created_by_user=latest_version["created_by_user"],
+                run_id=uuid.uuid4().hex,
+                storage_codec=codecs.pop() if len(codecs) == 1 else None,
+            )
+        )
+        s_db.commit()
+        # blobs of stations taken from another shard
+        delete_unreferenced_blobs(s_db)
+
+    finalize_database(db_engine, vacuum=vacuum)
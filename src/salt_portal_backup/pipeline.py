@@ -0,0 +1,170 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Pipelined fetching and parsing of the stations for run_backup, overlapping the parsing with
+the network requests and using several cores.
+
+fetch  threads requesting the station csv files and station page, and once parsed the
+       measurement csv data and group summaries of the station
+parse  a process pool parsing the csv files and station page into data frames
+write  the thread running run_backup, the single writer to the database
+
+The stations are handed to the writer in order, with at most max_pending stations fetched
+or parsed ahead of the station being written, so a slow writer holds back the fetching.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, NamedTuple
+
+import pandas as pd
+from sqlalchemy.orm import Session
+
+from .database import create_read_engine
+from .web_scraping import (
+    URL_BASE,
+    StationPage,
+    get_data_header,
+    get_station_csvs,
+    parse_station_data,
+    station_page_url,
+)
+
+
+class FetchedStation(NamedTuple):
+    """A station fetched and parsed, measurements and calibrations are None if unchanged.
+    downloads is what prefetch returned for the station, see StationPipeline."""
+
+    project_id: int
+    station: pd.Series
+    measurements_csv: bytes
+    calibrations_csv: bytes
+    measurements: pd.DataFrame
+    calibrations: pd.DataFrame
+    unchanged: bool
+    downloads: Any = None
+
+
+def _has_rows(csv_data):
+    """Whether a csv file has rows below the header, only then the station page is needed"""
+    return csv_data.strip().count(b"\n") > 0
+
+
+def parse_station(station_id, measurements_csv, calibrations_csv, page_html):
+    """Parse the csv files of a station with its station page html, in a parse process"""
+    station_page = StationPage(
+        None, None, station_id, {}, fetch_page=lambda url, headers: page_html
+    )
+    return parse_station_data(station_id, measurements_csv, calibrations_csv, station_page)
+
+
+class StationPipeline:
+    """Fetch the stations in fetch_workers threads and parse them in parse_pool, a process
+    pool executor.
+
+    With incremental=True the stations where the csv files are unchanged, as checked against
+    the database of db_engine by unchanged(s_db, station_id, measurements_csv,
+    calibrations_csv), are not parsed.
+
+    prefetch(read_engine, station_id, measurements), if given, is called in the fetch thread
+    for each parsed station, e.g. to download its measurement csv data, and its result is
+    handed to the writer as FetchedStation.downloads. The database of db_engine is read with
+    the pragmas of sqlite_profile and low_memory, see create_read_engine.
+    """
+
+    def __init__(
+        self,
+        s_request,
+        db_engine,
+        stats,
+        token,
+        parse_pool,
+        fetch_workers=4,
+        max_pending=None,
+        incremental=False,
+        unchanged=None,
+        prefetch=None,
+        sqlite_profile="safe",
+        low_memory=False,
+    ):
+        self.s_request = s_request
+        self.stats = stats
+        self.token = token
+        self.parse_pool = parse_pool
+        self.fetch_workers = fetch_workers
+        self.max_pending = max_pending or 2 * fetch_workers
+        self.incremental = incremental
+        self.unchanged = unchanged
+        self.prefetch = prefetch
+        self.read_engine = create_read_engine(db_engine, sqlite_profile, low_memory)
+
+    def fetch_station(self, project_id, station):
+        station_id = station["station_id"]
+        header_station_measurements = get_data_header(self.token)
+        header_station_measurements["Referer"] = station_page_url(station_id)
+
+        with self.stats.phase("station_csvs"):
+            measurements_csv, calibrations_csv = get_station_csvs(
+                self.s_request, station_id, header_station_measurements
+            )
+
+        if self.incremental:
+            # a station is only written after it is fetched, reading it here is safe
+            with Session(self.read_engine) as s_read:
+                if self.unchanged(s_read, station_id, measurements_csv, calibrations_csv):
+                    return FetchedStation(
+                        project_id, station, measurements_csv, calibrations_csv, None, None, True
+                    )
+
+        page_html = None
+        if _has_rows(measurements_csv) or _has_rows(calibrations_csv):
+            header_station_page = get_data_header(self.token)
+            header_station_page["Referer"] = f"{URL_BASE}/project/{project_id}/"
+            with self.stats.phase("station_page"):
+                page_html = self.s_request.get(
+                    station_page_url(station_id), headers=header_station_page
+                ).text
+
+        with self.stats.phase("parse"):
+            measurements, calibrations = self.parse_pool.submit(
+                parse_station, station_id, measurements_csv, calibrations_csv, page_html
+            ).result()
+
+        downloads = None
+        if self.prefetch is not None:
+            downloads = self.prefetch(self.read_engine, station_id, measurements)
+
+        return FetchedStation(
+            project_id,
+            station,
+            measurements_csv,
+            calibrations_csv,
+            measurements,
+            calibrations,
+            False,
+            downloads,
+        )
+
+    def run(self, stations):
+        """Fetch and parse stations, an iterable of (project_id, station). Yields
+        FetchedStation in the order of stations."""
+        stations = iter(stations)
+        pending = deque()
+        with ThreadPoolExecutor(
+            max_workers=self.fetch_workers, thread_name_prefix="salt_portal_fetch"
+        ) as executor:
+            try:
+                while True:
+                    for project_id, station in stations:
+                        pending.append(executor.submit(self.fetch_station, project_id, station))
+                        if len(pending) >= self.max_pending:
+                            break
+
+                    if not pending:
+                        return
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
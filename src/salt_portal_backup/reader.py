@@ -0,0 +1,191 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Read access to a backup database, returning pandas data frames.
+
+    with BackupReader("my_backup.db") as reader:
+        stations = reader.stations()
+        measurements = reader.measurements(station_id, start="2023-01-01", end="2024-01-01")
+        calibrations = reader.latest_calibrations()
+        csv_data = reader.measurement_csv(measurements["id"].iloc[0])
+
+The queries are SQLAlchemy Core selects loaded directly into data frames, using the
+secondary indexes created when the backup is finalized, see database.SECONDARY_INDEXES.
+Backups made by earlier versions can be given the indexes with create_indexes. The
+downloaded files are returned decompressed, the blobs most recently read are kept
+decompressed in an LRU cache of blob_cache_size entries.
+
+Times are stored as text as in the Salt Portal, e.g. 2023-05-01 10:00:00, and compared as
+text. start and end may also be given as datetime or pandas Timestamp.
+"""
+
+import functools
+from pathlib import Path
+
+import pandas as pd
+from sqlalchemy import create_engine, func, select
+
+from .database import (
+    Blob,
+    Calibration,
+    Measurement,
+    MeasurementCSVData,
+    MeasurementGroup,
+    MeasurementSeries,
+    Project,
+    Station,
+    create_secondary_indexes,
+)
+from .storage import decompress
+
+BLOB_CACHE_SIZE = 256
+
+
+def _time_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return pd.Timestamp(value).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _ids(ids):
+    if ids is None:
+        return None
+    if isinstance(ids, (int, str)) or not hasattr(ids, "__iter__"):
+        ids = [ids]
+    return [int(i) for i in ids]
+
+
+class BackupReader:
+    """Read the backup database at database_path. The database is opened read only."""
+
+    def __init__(self, database_path, blob_cache_size=BLOB_CACHE_SIZE):
+        if not Path(database_path).exists():
+            raise FileNotFoundError(database_path)
+        self.database_path = Path(database_path)
+        self.db_engine = create_engine(
+            f"sqlite:///file:{self.database_path.as_posix()}?mode=ro&uri=true", echo=False
+        )
+        self.blob = functools.lru_cache(maxsize=blob_cache_size)(self._read_blob)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.blob.cache_clear()
+        self.db_engine.dispose()
+
+    def create_indexes(self):
+        """Create the secondary indexes in a backup made by an earlier version"""
+        db_engine = create_engine("sqlite:///" + str(self.database_path), echo=False)
+        with db_engine.begin() as connection:
+            create_secondary_indexes(connection)
+        db_engine.dispose()
+
+    def query(self, statement):
+        """Data frame of the rows of a select statement"""
+        with self.db_engine.connect() as connection:
+            result = connection.execute(statement)
+            return pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+    def projects(self):
+        return self.query(select(Project.__table__).order_by(Project.id))
+
+    def stations(self, project_ids=None):
+        """Stations, of the projects in project_ids if given"""
+        statement = select(Station.__table__).order_by(Station.id)
+        if project_ids is not None:
+            statement = statement.where(Station.project_id.in_(_ids(project_ids)))
+        return self.query(statement)
+
+    def measurements(self, station_ids=None, start=None, end=None, columns=None):
+        """Measurements of the stations in station_ids if given, with start <= datetime < end
+        if given, ordered by station and time. columns is a list of the columns of the
+        measurement table to return, default all."""
+        table = Measurement.__table__
+        selected = table.columns if columns is None else [table.c[c] for c in columns]
+        statement = select(*selected).order_by(table.c.station_id, table.c.datetime)
+        if station_ids is not None:
+            statement = statement.where(table.c.station_id.in_(_ids(station_ids)))
+        if start is not None:
+            statement = statement.where(table.c.datetime >= _time_text(start))
+        if end is not None:
+            statement = statement.where(table.c.datetime < _time_text(end))
+        return self.query(statement)
+
+    def calibrations(self, station_ids=None):
+        """Calibrations of the stations in station_ids if given, ordered by station and time"""
+        table = Calibration.__table__
+        statement = select(table).order_by(table.c.station_id, table.c.datetime_of_calibration)
+        if station_ids is not None:
+            statement = statement.where(table.c.station_id.in_(_ids(station_ids)))
+        return self.query(statement)
+
+    def latest_calibrations(self, station_ids=None):
+        """The most recent calibration of each station, of the stations in station_ids if
+        given. Of calibrations at the same time the one with the highest id is returned."""
+        table = Calibration.__table__
+        ranked = select(
+            table,
+            func.row_number()
+            .over(
+                partition_by=table.c.station_id,
+                order_by=(table.c.datetime_of_calibration.desc(), table.c.id.desc()),
+            )
+            .label("rank"),
+        )
+        if station_ids is not None:
+            ranked = ranked.where(table.c.station_id.in_(_ids(station_ids)))
+        ranked = ranked.subquery()
+        statement = (
+            select(*[ranked.c[column.name] for column in table.columns])
+            .where(ranked.c.rank == 1)
+            .order_by(ranked.c.station_id)
+        )
+        return self.query(statement)
+
+    def measurement_series(self, measurement_ids):
+        """Time series of the measurements, if parsed in the backup, see run_backup"""
+        table = MeasurementSeries.__table__
+        statement = (
+            select(table)
+            .where(table.c.measurement_id.in_(_ids(measurement_ids)))
+            .order_by(table.c.measurement_id, table.c.sample)
+        )
+        return self.query(statement)
+
+    def _read_blob(self, sha256):
+        with self.db_engine.connect() as connection:
+            row = connection.execute(
+                select(Blob.codec, Blob.data).where(Blob.sha256 == sha256)
+            ).first()
+        if row is None:
+            raise KeyError(f"No blob {sha256}")
+        return decompress(row.data, row.codec)
+
+    def _payload(self, model, key_column, key):
+        payload_column = getattr(model, model.__payload_column__)
+        with self.db_engine.connect() as connection:
+            row = connection.execute(
+                select(payload_column, model.blob_sha256).where(key_column == int(key))
+            ).first()
+        if row is None:
+            raise KeyError(f"No {model.__tablename__} {key}")
+        inline, sha256 = row
+        if sha256 is not None:
+            return self.blob(sha256)
+        return inline.encode() if isinstance(inline, str) else inline
+
+    def measurement_csv(self, measurement_id):
+        """The downloaded csv data of a measurement, as bytes"""
+        return self._payload(
+            MeasurementCSVData, MeasurementCSVData.measurement_id, measurement_id
+        )
+
+    def group_summary(self, group_id):
+        """The downloaded summary csv of a measurement group, as bytes"""
+        return self._payload(MeasurementGroup, MeasurementGroup.id, group_id)
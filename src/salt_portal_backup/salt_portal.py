@@ -2,24 +2,45 @@
 #
 # SPDX-License-Identifier: BSD-3-Clause
 
-import re
+import contextlib
 import datetime
+import json
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
 
-from bs4 import BeautifulSoup as bs
 import requests
-import numpy as np
+import pandas as pd
 from tqdm import tqdm
 
-from .web_scraping import URL_LOGIN, header_data_template
+from .web_scraping import URL_LOGIN
 from .web_scraping import (
     login_salt_portal,
+    get_login_token,
+    check_login,
+    get_data_header,
     get_projects_stations,
-    get_station_data,
-    get_station_groups,
+    get_station_csvs,
+    parse_station_data,
+    station_page_url,
+    station_group_ids,
+    group_csv_url,
+    StationPage,
 )
 
-from .database import initialize_database, DATABASE_VERSION
+from .download_pool import DownloadPool
+from .pipeline import StationPipeline
+from .http_cache import HTTPCache, CachingAdapter
+from .scheduler import RequestScheduler, ScheduledAdapter
+from .database import initialize_database, finalize_database, frame_to_records, DATABASE_VERSION
+from .database import add_row_hashes
+from .database import MEASUREMENT_COLUMNS, CALIBRATION_COLUMNS
+from .storage import content_hash, compress, check_codec, spool_payload, SPOOL_CHUNK_SIZE
+from .series import series_frame, fill_series_datetime
+from .instrumentation import BackupStats
 from .database import (
+    Blob,
     Calibration,
     CalibrationRaw,
     Measurement,
@@ -29,214 +50,1256 @@ from .database import (
     StationListRaw,
     Project,
     MeasurementCSVData,
+    MeasurementSeries,
     # RatingCurve,
+    RunStats,
+    StationCheckpoint,
     Version,
 )
 
+from sqlalchemy import select, delete, insert, union, func, bindparam, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
 
+# number of streamed downloads written to the database at a time
+STREAM_BATCH_SIZE = 32
 
-def run_backup(username, password, database_path=None):
 
-    db_engine = initialize_database(database_name=database_path)
+def _nan_to_none(value):
+    return None if pd.isna(value) else value
 
-    with requests.session() as s_request, Session(db_engine) as s_db:
-        req = s_request.get(URL_LOGIN).text
-        html = bs(req, "html.parser")
-        token = html.find("input", {"name": "csrfmiddlewaretoken"}).attrs["value"]
 
-        login_res = login_salt_portal(s_request, token, username, password)
+def changed_measurement_ids(s_db, station_id, measurements):
+    """Compare the measurements from the Salt Portal with the ones stored for the station.
 
-        html_main_page = bs(login_res.text, "html.parser")
-        if html_main_page.find("li", string=re.compile("Successfully signed in")) is None:
-            raise Exception("Login failed")
+    A measurement is changed if its Modified or Last Modified By differs from what is stored.
 
-        html_sidenav = html_main_page.find("div", class_="wh-sidenav-content")
-        full_version_tag = html_sidenav.find("p", string=re.compile("Salt Portal "))
-        sp_semver = full_version_tag.text.strip().lstrip("Salt Portal ")
+    Returns the ids of new or changed measurements, and of measurements that are stored but
+    no longer exist in the Salt Portal.
+    """
+    stored = {
+        m_id: (modified, modified_by)
+        for m_id, modified, modified_by in s_db.execute(
+            select(Measurement.id, Measurement.datetime_modified, Measurement.modified_by).where(
+                Measurement.station_id == station_id
+            )
+        )
+    }
+
+    changed_ids = set()
+    for m_id, modified, modified_by in zip(
+        measurements["ID"], measurements["Modified"], measurements["Last Modified By"]
+    ):
+        m_id = int(m_id)
+        if stored.get(m_id) != (_nan_to_none(modified), _nan_to_none(modified_by)):
+            changed_ids.add(m_id)
+
+    removed_ids = set(stored) - {int(m_id) for m_id in measurements["ID"]}
 
-        db_version = Version(
-            id=0,
-            database_version=DATABASE_VERSION,
-            salt_portal_version=sp_semver,
-            datetime_created=datetime.datetime.now(datetime.UTC).isoformat(timespec="seconds"),
-            created_by_user=username,
+    return changed_ids, removed_ids
+
+
+def delete_measurements(s_db, measurement_ids):
+    """Delete the measurements with their csv data and time series, in chunks of 500 ids to
+    stay below the SQLite limit on the number of query parameters"""
+    measurement_ids = list(measurement_ids)
+    for i in range(0, len(measurement_ids), 500):
+        chunk = measurement_ids[i : i + 500]
+        s_db.execute(
+            delete(MeasurementSeries).where(MeasurementSeries.measurement_id.in_(chunk))
+        )
+        s_db.execute(
+            delete(MeasurementCSVData).where(MeasurementCSVData.measurement_id.in_(chunk))
         )
+        s_db.execute(delete(Measurement).where(Measurement.id.in_(chunk)))
 
-        s_db.add(db_version)
-        s_db.commit()
 
-        # set the token for all the headers in this session
-        header_data_template["Cookie"] = header_data_template["Cookie"].format(token=token)
+def delete_unlisted_stations(s_db, stations):
+    """Delete the stations no longer in the station list of the Salt Portal, stations, with
+    their measurements, calibrations and csv files, and the projects and measurement groups
+    left without stations or measurements. Returns the ids of the deleted stations."""
+    listed_ids = {int(station_id) for station_id in stations["station_id"]}
+    removed_ids = set(s_db.scalars(select(Station.id))) - listed_ids
+    removed_list = list(removed_ids)
+    for i in range(0, len(removed_list), 500):
+        chunk = removed_list[i : i + 500]
+        removed_measurement_ids = s_db.scalars(
+            select(Measurement.id).where(Measurement.station_id.in_(chunk))
+        ).all()
+        delete_measurements(s_db, removed_measurement_ids)
+        for model in (Calibration, MeasurementRaw, CalibrationRaw, StationCheckpoint):
+            s_db.execute(delete(model).where(model.station_id.in_(chunk)))
+        s_db.execute(delete(Station).where(Station.id.in_(chunk)))
 
-        header_get_organization = header_data_template.copy()
-        projects, stations, stations_csv = get_projects_stations(
-            s_request, header_get_organization
+    listed_project_ids = {int(project_id) for project_id in stations["project_id"]}
+    s_db.execute(delete(Project).where(Project.id.not_in(listed_project_ids)))
+    s_db.execute(
+        delete(MeasurementGroup).where(
+            MeasurementGroup.id.not_in(
+                select(Measurement.group_id).where(Measurement.group_id.is_not(None))
+            )
         )
+    )
+    s_db.commit()
+    return removed_ids
 
-        station_list_raw_insert = StationListRaw(**{"raw_station_data": stations_csv})
 
-        s_db.add(station_list_raw_insert)
-        s_db.commit()
+def store_blobs(s_db, payloads, codec):
+    """Store the payloads compressed with the codec in the blob table, returns the sha256 of
+    each payload. Payloads already stored, or repeated in payloads, are only stored once."""
+    hashes = [content_hash(payload) for payload in payloads]
 
-        header_station_measurements = header_data_template.copy()
-        header_station_page = header_data_template.copy()
+    stored = set()
+    unique_hashes = list(set(hashes))
+    # stay below the SQLite limit of variables in a statement
+    for i in range(0, len(unique_hashes), 500):
+        stored.update(
+            s_db.scalars(select(Blob.sha256).where(Blob.sha256.in_(unique_hashes[i : i + 500])))
+        )
 
-        for _, project in tqdm(
-            projects.iterrows(), desc=" projects", total=projects.shape[0], position=0
-        ):
-            project_name = project["project_name"]
-            project_id = project["project_id"]
+    blob_records = {}
+    for sha256, payload in zip(hashes, payloads):
+        if sha256 in stored or sha256 in blob_records:
+            continue
+        blob_records[sha256] = {
+            "sha256": sha256,
+            "codec": codec,
+            "size": len(payload),
+            "data": compress(payload, codec),
+        }
 
-            project_insert = Project(**{"id": project_id, "name": project_name})
+    if blob_records:
+        s_db.execute(
+            sqlite_insert(Blob).on_conflict_do_nothing(index_elements=[Blob.sha256]),
+            list(blob_records.values()),
+        )
 
-            s_db.add(project_insert)
-            s_db.commit()
+    return hashes
 
-            stations_in_project = stations[stations["project_id"] == project_id]
 
-            for _, station in tqdm(
-                stations_in_project.iterrows(),
-                desc=" station in project",
-                total=stations_in_project.shape[0],
-                leave=False,
-                position=1,
-            ):
-                station_name = station["station_name"]
-                station_id = station["station_id"]
+def payload_records(s_db, payload_column, payloads, storage_codec):
+    """Column values storing each of the payloads (downloaded files).
 
-                header_station_measurements["Referer"] = (
-                    f"https://wit.fathomscientific.com/station/{station_id}/"
-                )
+    With storage codec none the payload is stored inline in payload_column, otherwise
+    compressed in the blob table and referenced by blob_sha256. The hash of the payload is
+    stored in payload_sha256 either way.
+    """
+    if storage_codec == "none":
+        return [
+            {
+                payload_column: payload,
+                "blob_sha256": None,
+                "payload_sha256": None if payload is None else content_hash(payload),
+            }
+            for payload in payloads
+        ]
 
-                station_insert = Station(
-                    **{
-                        "id": station_id,
-                        "station_name": station_name,
-                        "project_id": project_id,
-                        "cft_1": station["cft_1"],
-                        "cft_2": station["cft_2"],
-                        "cft_3": station["cft_3"],
-                    }
-                )
+    return [
+        {payload_column: None, "blob_sha256": sha256, "payload_sha256": sha256}
+        for sha256 in store_blobs(s_db, payloads, storage_codec)
+    ]
+
+
+def delete_unreferenced_blobs(s_db):
+    """Delete blobs no longer referenced, e.g. of measurements deleted in an incremental backup"""
+    referenced = union(
+        *(
+            select(model.blob_sha256).where(model.blob_sha256.is_not(None))
+            for model in (
+                MeasurementCSVData,
+                MeasurementGroup,
+                StationListRaw,
+                MeasurementRaw,
+                CalibrationRaw,
+            )
+        )
+    )
+    s_db.execute(delete(Blob).where(Blob.sha256.not_in(referenced)))
+    s_db.commit()
+
+
+def _utc_now():
+    return datetime.datetime.now(datetime.UTC).isoformat(timespec="seconds")
+
+
+def write_version(s_db, sp_semver, username, resume=False, storage_codec="none"):
+    """Write the version row, which also identifies the backup run.
+
+    Returns the run_id, which with resume=True is the run_id of the stored run to continue.
+    A stored run that completed, with its statistics in run_stats, is not continued, a new
+    run is started instead. The run to continue must use the storage_codec it was started
+    with.
+    """
+    # check the version first, the version row of older databases does not match the model
+    stored_database_version = s_db.scalar(select(Version.database_version))
+    if stored_database_version is not None and stored_database_version != DATABASE_VERSION:
+        raise Exception(
+            f"Database version {stored_database_version} of existing database does "
+            f"not match version {DATABASE_VERSION}, incremental backup not possible"
+        )
+
+    stored_version = s_db.get(Version, 0)
+
+    if resume and stored_version is not None and stored_version.run_id is not None:
+        completed = s_db.scalar(
+            select(RunStats.id).where(RunStats.run_id == stored_version.run_id).limit(1)
+        )
+        if completed is not None:
+            print("The last backup run completed, starting a new run")
+        elif stored_version.storage_codec != storage_codec:
+            raise ValueError(
+                f"The interrupted backup uses storage codec {stored_version.storage_codec}, "
+                f"resume it with the same storage codec instead of {storage_codec}"
+            )
+        else:
+            return stored_version.run_id
+
+    db_version = Version(
+        id=0,
+        database_version=DATABASE_VERSION,
+        salt_portal_version=sp_semver,
+        datetime_created=_utc_now(),
+        created_by_user=username,
+        run_id=uuid.uuid4().hex,
+        storage_codec=storage_codec,
+    )
+
+    s_db.merge(db_version)
+    s_db.commit()
+
+    return db_version.run_id
+
+
+def completed_station_ids(s_db, run_id):
+    """Ids of the stations already completed in the run"""
+    return set(
+        s_db.scalars(
+            select(StationCheckpoint.station_id).where(StationCheckpoint.run_id == run_id)
+        )
+    )
+
+
+def write_checkpoint(s_db, station_id, run_id):
+    """Mark the station as completed in the run, committed together with the station data"""
+    s_db.merge(
+        StationCheckpoint(station_id=station_id, run_id=run_id, datetime_completed=_utc_now())
+    )
+
+
+def write_station_list(s_db, stations_csv, storage_codec="none"):
+    station_list_raw_insert = StationListRaw(
+        id=1, **payload_records(s_db, "raw_station_data", [stations_csv], storage_codec)[0]
+    )
+
+    s_db.merge(station_list_raw_insert)
+    s_db.commit()
+
+
+def write_project(s_db, project_id, project_name):
+    project_insert = Project(**{"id": project_id, "name": project_name})
+
+    s_db.merge(project_insert)
+    s_db.commit()
+
+
+def station_unchanged(s_db, station_id, measurements_csv, calibrations_csv):
+    """True if the measurement and calibration csv files of the station are identical to the
+    ones stored"""
+    stored_measurements_raw = s_db.get(MeasurementRaw, station_id)
+    stored_calibrations_raw = s_db.get(CalibrationRaw, station_id)
+    return (
+        stored_measurements_raw is not None
+        and stored_calibrations_raw is not None
+        and stored_measurements_raw.payload_equals(measurements_csv)
+        and stored_calibrations_raw.payload_equals(calibrations_csv)
+    )
+
+
+def write_station_info(s_db, project_id, station):
+    station_insert = Station(
+        **{
+            "id": station["station_id"],
+            "station_name": station["station_name"],
+            "project_id": project_id,
+            "cft_1": station["cft_1"],
+            "cft_2": station["cft_2"],
+            "cft_3": station["cft_3"],
+        }
+    )
+
+    # NOTE: commit at the end of the station loop
+    s_db.merge(station_insert)
+
+
+def write_station(
+    s_db,
+    station_id,
+    measurements_csv,
+    measurements,
+    calibrations_csv,
+    calibrations,
+    removed_ids=None,
+    storage_codec="none",
+):
+    """Add the measurements and calibrations of a station to the session.
+
+    The rows are bulk inserted, the csv data of the measurements and the groups are inserted
+    with write_downloads.
 
-                # NOTE: commit at the end of the station loop
-                s_db.add(station_insert)
+    For an incremental backup removed_ids is given, the ids of stored measurements that no
+    longer exist in the Salt Portal. The stored versions of the measurements are then replaced,
+    the removed measurements deleted and the calibrations of the station replaced.
+    """
+    if removed_ids is not None:
+        delete_measurements(s_db, {int(m_id) for m_id in measurements["ID"]} | removed_ids)
+        s_db.execute(delete(Calibration).where(Calibration.station_id == station_id))
 
-                # Get the measurements and calibrations of a station
-                measurements_csv, measurements, calibrations_csv, calibrations = get_station_data(
-                    s_request,
-                    project_id,
-                    station_id,
-                    header_station_measurements,
-                    header_station_page,
+    measurement_records = add_row_hashes(
+        frame_to_records(measurements, MEASUREMENT_COLUMNS, station_id=station_id),
+        Measurement,
+    )
+    if measurement_records:
+        s_db.execute(insert(Measurement), measurement_records)
+
+    measurement_raw_insert = MeasurementRaw(
+        station_id=station_id,
+        **payload_records(
+            s_db, "station_raw_measurement_data", [measurements_csv], storage_codec
+        )[0],
+    )
+    s_db.merge(measurement_raw_insert)
+
+    calibration_records = add_row_hashes(
+        frame_to_records(calibrations, CALIBRATION_COLUMNS, station_id=station_id),
+        Calibration,
+    )
+    if calibration_records:
+        s_db.execute(insert(Calibration), calibration_records)
+
+    calibration_raw_insert = CalibrationRaw(
+        station_id=station_id,
+        **payload_records(
+            s_db, "station_raw_calibration_data", [calibrations_csv], storage_codec
+        )[0],
+    )
+    s_db.merge(calibration_raw_insert)
+
+
+def get_station_downloads(measurements, claimed_groups=None):
+    """Urls of the measurement csv data and group summaries to download for the measurements,
+    as a dict of (kind, id): url where kind is measurement or group.
+
+    claimed_groups is a set of the groups already downloaded in the run, or being downloaded
+    for another station. Those are skipped, and the groups to download are added to it, so
+    a group shared by several stations is downloaded once per run.
+    """
+    groups = station_group_ids(measurements)
+    if claimed_groups is not None:
+        groups = [group for group in groups if group not in claimed_groups]
+        claimed_groups.update(groups)
+
+    download_urls = {
+        ("measurement", int(measurement_id)): download_link
+        for measurement_id, download_link in zip(
+            measurements["ID"], measurements["download_link"]
+        )
+    }
+    for group in groups:
+        download_urls[("group", group)] = group_csv_url(group)
+
+    return download_urls
+
+
+def group_stations(projects, stations):
+    """The stations of each project of projects, as a dict of data frames by project id,
+    grouped once instead of filtering the stations for each project"""
+    grouped = dict(tuple(stations.groupby("project_id", sort=False)))
+    return {
+        project_id: grouped.get(project_id, stations.iloc[:0])
+        for project_id in projects["project_id"]
+    }
+
+
+def select_stations(selection, projects, stations):
+    """Apply a StationSelection to the projects and stations to backup"""
+    n_stations = stations.shape[0]
+    projects, stations = selection.apply(projects, stations)
+    print(f"Selected {stations.shape[0]} of {n_stations} stations")
+    return projects, stations
+
+
+def locked_measurement_urls(measurements):
+    """Download urls of the measurements locked from update and delete, which can not change"""
+    locked = (
+        measurements["Locked from Update and Delete"].astype(str).str.lower().isin(["true", "1"])
+    )
+    return set(measurements.loc[locked, "download_link"].dropna())
+
+
+def write_downloads(s_db, downloads, storage_codec="none"):
+    """Insert downloaded measurement csv data and group summaries, downloads is a list of
+    ((kind, id), content) as from get_station_downloads"""
+    measurement_downloads = [
+        (key, content) for (kind, key), content in downloads if kind == "measurement"
+    ]
+    group_downloads = [(key, content) for (kind, key), content in downloads if kind == "group"]
+
+    if measurement_downloads:
+        csv_records = payload_records(
+            s_db, "csv_data", [content for _, content in measurement_downloads], storage_codec
+        )
+        for (key, _), record in zip(measurement_downloads, csv_records):
+            record["measurement_id"] = key
+        s_db.execute(insert(MeasurementCSVData), csv_records)
+
+    if group_downloads:
+        group_records = payload_records(
+            s_db, "group_summary", [content for _, content in group_downloads], storage_codec
+        )
+        for (key, _), record in zip(group_downloads, group_records):
+            record["id"] = key
+
+        # groups can be shared between stations, replace a group already stored
+        upsert_groups = sqlite_insert(MeasurementGroup)
+        upsert_groups = upsert_groups.on_conflict_do_update(
+            index_elements=[MeasurementGroup.id],
+            set_={
+                "group_summary": upsert_groups.excluded.group_summary,
+                "blob_sha256": upsert_groups.excluded.blob_sha256,
+                "payload_sha256": upsert_groups.excluded.payload_sha256,
+            },
+        )
+        s_db.execute(upsert_groups, group_records)
+
+
+def measurement_downloads(downloads):
+    """(measurement_id, content) of the measurement csv data in downloads"""
+    return [(key, content) for (kind, key), content in downloads if kind == "measurement"]
+
+
+def write_measurement_series(s_db, downloads, series=None):
+    """Parse the time series of the downloaded measurement csv data and insert them, with one
+    bulk insert for all the downloads. downloads is as for write_downloads, series the time
+    series if already parsed from downloads. Datetimes missing from the csv data are the
+    datetime of the measurement plus time_s."""
+    if series is None:
+        series = series_frame(measurement_downloads(downloads))
+    if series.empty:
+        return
+
+    missing_ids = series.loc[series["datetime"].isna(), "measurement_id"].unique()
+    if len(missing_ids):
+        start_datetimes = dict(
+            s_db.execute(
+                select(Measurement.id, Measurement.datetime).where(
+                    Measurement.id.in_([int(m_id) for m_id in missing_ids])
                 )
+            ).all()
+        )
+        series = fill_series_datetime(series, start_datetimes)
 
-                # loop over measurements, insert each measurement and
-                # download and insert each measurement_data_csv in corresponding table
-                for mi, md in tqdm(
-                    measurements.iterrows(),
-                    desc=" measurement at station",
-                    total=measurements.shape[0],
-                    leave=False,
-                    position=2,
-                ):
-                    measurement_data_csv = s_request.get(
-                        md["download_link"], headers=header_station_measurements
-                    )
+    series_records = series.astype(object).where(series.notna(), None).to_dict("records")
+    s_db.execute(insert(MeasurementSeries), series_records)
 
-                    measurement_insert = Measurement(
-                        **{
-                            "id": md["ID"],
-                            "station_id": station_id,
-                            "group_id": md["group"],
-                            "datetime": md["Date of Measurement"],
-                            "datetime_end": md["End time of Measurement"],
-                            "flow_cms": md["Flow (cms)"],
-                            "uncertainty_percent": md["Measurement Uncertainty"],
-                            "notes": md["Notes"],
-                            "datetime_modified": md["Modified"],
-                            "modified_by": md["Last Modified By"],
-                            "locked_update_delete": md["Locked from Update and Delete"],
-                            "locked_by": md["Locked By"],
-                            "party": md["Party"],
-                            "created_by": md["Created By"],
-                            "stage_m": md["Stage (m)"],
-                            "stage_datetime": md["Stage Time"],
-                            "dl_stage_m": md["DL Stage (m)"],
-                            "ref_stage_m": md["Ref Stage (m)"],
-                            "type": md["Type"],
-                            "filename": md["Filename"],
-                            "rating_curve_ids": md["RatingCurveIds"],
-                            "states": md["States"],
-                        }
-                    )
-                    measurement_csv_insert = MeasurementCSVData(
-                        **{"measurement_id": md["ID"], "csv_data": measurement_data_csv.content}
-                    )
 
-                    s_db.add(measurement_insert)
-                    s_db.add(measurement_csv_insert)
+def _write_spooled_data(s_db, table_name, column, rowid, payload):
+    """Write the spooled data of payload into the zeroblob in column of the row with rowid,
+    chunk by chunk with incremental blob I/O where supported (Python 3.11+)"""
+    dbapi_connection = s_db.connection().connection.driver_connection
+    if hasattr(dbapi_connection, "blobopen"):
+        with dbapi_connection.blobopen(table_name, column, rowid) as blob:
+            for chunk in payload.chunks():
+                blob.write(chunk)
+    else:
+        s_db.execute(
+            text(f"UPDATE {table_name} SET {column} = :data WHERE rowid = :rowid"),
+            {"data": b"".join(payload.chunks()), "rowid": rowid},
+        )
+
+
+def store_spooled_blobs(s_db, payloads):
+    """Store spooled payloads in the blob table as store_blobs, returns the sha256 of each"""
+    hashes = [payload.sha256 for payload in payloads]
+
+    stored = set()
+    unique_hashes = list(set(hashes))
+    for i in range(0, len(unique_hashes), 500):
+        stored.update(
+            s_db.scalars(select(Blob.sha256).where(Blob.sha256.in_(unique_hashes[i : i + 500])))
+        )
+
+    new_payloads = {}
+    for payload in payloads:
+        if payload.sha256 not in stored:
+            new_payloads.setdefault(payload.sha256, payload)
+
+    if new_payloads:
+        s_db.execute(
+            insert(Blob).values(data=func.zeroblob(bindparam("stored_size"))),
+            [
+                {
+                    "sha256": payload.sha256,
+                    "codec": payload.codec,
+                    "size": payload.size,
+                    "stored_size": payload.stored_size,
+                }
+                for payload in new_payloads.values()
+            ],
+        )
+        blob_rowids = s_db.execute(
+            select(text("rowid"), Blob.sha256).where(Blob.sha256.in_(list(new_payloads)))
+        )
+        for rowid, sha256 in blob_rowids:
+            _write_spooled_data(s_db, "blob", "data", rowid, new_payloads[sha256])
+
+    return hashes
+
+
+def write_spooled_downloads(s_db, downloads, storage_codec="none", parse_series=False):
+    """Insert streamed downloads as write_downloads, downloads is a list of
+    ((kind, id), SpooledPayload). The data is copied from the spooled files into the database
+    in chunks, so only the chunks are held in memory. With parse_series=True the time series
+    of the measurement csv data are parsed and returned, to be written with
+    write_measurement_series, otherwise None is returned."""
+    for kind, table, payload_column in (
+        ("measurement", MeasurementCSVData, "csv_data"),
+        ("group", MeasurementGroup, "group_summary"),
+    ):
+        kind_downloads = [(key, payload) for (k, key), payload in downloads if k == kind]
+        if not kind_downloads:
+            continue
+
+        # the measurement and group ids are the rowids of the tables
+        id_column = "measurement_id" if kind == "measurement" else "id"
+        if storage_codec == "none":
+            records = [
+                {
+                    id_column: key,
+                    "blob_sha256": None,
+                    "payload_sha256": payload.sha256,
+                    "stored_size": payload.stored_size,
+                }
+                for key, payload in kind_downloads
+            ]
+            values = {payload_column: func.zeroblob(bindparam("stored_size"))}
+        else:
+            hashes = store_spooled_blobs(s_db, [payload for _, payload in kind_downloads])
+            records = [
+                {id_column: key, "blob_sha256": sha256, "payload_sha256": sha256}
+                for (key, _), sha256 in zip(kind_downloads, hashes)
+            ]
+            values = {payload_column: None}
+
+        if kind == "measurement":
+            s_db.execute(insert(table).values(**values), records)
+        else:
+            # groups can be shared between stations, replace a group already stored
+            upsert_groups = sqlite_insert(table).values(**values)
+            upsert_groups = upsert_groups.on_conflict_do_update(
+                index_elements=[table.id],
+                set_={
+                    "group_summary": upsert_groups.excluded.group_summary,
+                    "blob_sha256": upsert_groups.excluded.blob_sha256,
+                    "payload_sha256": upsert_groups.excluded.payload_sha256,
+                },
+            )
+            s_db.execute(upsert_groups, records)
+
+        if storage_codec == "none":
+            for key, payload in kind_downloads:
+                _write_spooled_data(s_db, table.__tablename__, payload_column, key, payload)
 
-                measurement_raw_insert = MeasurementRaw(
-                    **{"station_id": station_id, "station_raw_measurement_data": measurements_csv}
+    if parse_series:
+        return series_frame(
+            [
+                (key, payload.read_payload())
+                for (kind, key), payload in downloads
+                if kind == "measurement"
+            ]
+        )
+    return None
+
+
+def write_run_stats(s_db, run_id, engine, stats):
+    """Store the statistics of the run in the run_stats table, returns the statistics"""
+    summary = stats.summary()
+    summary["run_id"] = run_id
+    summary["engine"] = engine
+
+    s_db.add(
+        RunStats(
+            run_id=run_id,
+            engine=engine,
+            datetime_started=stats.datetime_started,
+            datetime_completed=_utc_now(),
+            duration_s=summary["duration_s"],
+            summary=json.dumps(summary),
+        )
+    )
+    s_db.commit()
+
+    return summary
+
+
+def report_run_stats(summary, stats_path=None):
+    """Print a short summary of the run, and write the statistics as json to stats_path"""
+    peak_memory = ""
+    if summary.get("peak_rss_mb") is not None:
+        peak_memory = f", peak memory {summary['peak_rss_mb']:.0f} MB"
+    print(
+        f"Backup completed in {summary['duration_s']:.1f} s, {summary['requests']} requests, "
+        f"{summary['bytes'] / 1e6:.1f} MB downloaded{peak_memory}"
+    )
+    if stats_path is not None:
+        with open(stats_path, "w") as stats_file:
+            json.dump(summary, stats_file, indent=2)
+
+    return summary
+
+
+def spool_response(storage_codec):
+    """Function spooling a streamed response, compressed with storage_codec, for the
+    download pool"""
+
+    def spool(response):
+        return spool_payload(response.iter_content(SPOOL_CHUNK_SIZE), storage_codec)
+
+    return spool
+
+
+def write_streamed_downloads(s_db, stats, downloads, storage_codec, parse_series):
+    """Write the spooled downloads of a station, an iterable of ((kind, id), SpooledPayload),
+    in batches of STREAM_BATCH_SIZE, closing the payloads once written. The time series, with
+    parse_series=True, are written in one bulk insert when all are written."""
+    series = []
+    batch = []
+    try:
+        for download in downloads:
+            batch.append(download)
+            if len(batch) >= STREAM_BATCH_SIZE:
+                with stats.phase("db_write"):
+                    series.append(write_spooled_downloads(s_db, batch, storage_codec, parse_series))
+                for _, payload in batch:
+                    payload.close()
+                batch = []
+
+        with stats.phase("db_write"):
+            series.append(write_spooled_downloads(s_db, batch, storage_codec, parse_series))
+            if parse_series:
+                write_measurement_series(s_db, None, series=pd.concat(series, ignore_index=True))
+    finally:
+        for _, payload in batch:
+            payload.close()
+
+
+def stream_station_downloads(
+    s_db, stats, download_pool, download_urls, headers, storage_codec, parse_series
+):
+    """Stream the downloads of a station to spooled files in the download pool, writing them
+    to the database as they complete, see write_streamed_downloads"""
+    downloads = download_pool.download(
+        download_urls, headers, process=spool_response(storage_codec)
+    )
+    write_streamed_downloads(
+        s_db,
+        stats,
+        tqdm(
+            downloads,
+            desc=" measurement at station",
+            total=len(download_urls),
+            leave=False,
+            position=2,
+        ),
+        storage_codec,
+        parse_series,
+    )
+
+
+class StationDownloads(NamedTuple):
+    """Downloads of a station made ahead of writing it, see prefetch_station_downloads"""
+
+    measurements: pd.DataFrame
+    removed_ids: set | None
+    download_urls: dict
+    downloads: list
+
+
+def prefetch_station_downloads(
+    read_engine,
+    station_id,
+    measurements,
+    stats,
+    download_pool,
+    token,
+    incremental=False,
+    storage_codec="none",
+    stream_downloads=False,
+    cache=None,
+    claimed_groups=None,
+    groups_lock=None,
+):
+    """Download the measurement csv data and group summaries of a parsed station, in a fetch
+    thread of StationPipeline, for store_station to write. With incremental=True only the
+    changed measurements are downloaded, as compared to the database of read_engine. With
+    stream_downloads=True the downloads are spooled to temporary files. claimed_groups is as
+    for get_station_downloads, shared by the fetch threads and guarded by groups_lock."""
+    removed_ids = None
+    if incremental:
+        # a station is only written after it is fetched, reading it here is safe
+        with Session(read_engine) as s_read:
+            changed_ids, removed_ids = changed_measurement_ids(s_read, station_id, measurements)
+        measurements = measurements[measurements["ID"].isin(changed_ids)]
+
+    with groups_lock or contextlib.nullcontext():
+        download_urls = get_station_downloads(measurements, claimed_groups)
+    if cache is not None:
+        cache.mark_immutable(locked_measurement_urls(measurements))
+
+    headers = get_data_header(token)
+    headers["Referer"] = station_page_url(station_id)
+    process = spool_response(storage_codec) if stream_downloads else None
+    with stats.phase("downloads"):
+        downloads = [
+            (download_key, response if stream_downloads else response.content)
+            for download_key, response in download_pool.download(download_urls, headers, process)
+        ]
+    return StationDownloads(measurements, removed_ids, download_urls, downloads)
+
+
+def commit_station(s_db, stats, low_memory=False):
+    with stats.phase("db_commit"):
+        s_db.commit()
+    if low_memory:
+        # nothing is kept in the session between stations
+        s_db.expunge_all()
+
+
+def store_station(
+    s_db,
+    stats,
+    download_pool,
+    run_id,
+    station_id,
+    measurements_csv,
+    measurements,
+    calibrations_csv,
+    calibrations,
+    headers,
+    incremental=False,
+    storage_codec="none",
+    parse_series=False,
+    stream_downloads=False,
+    cache=None,
+    parse_pool=None,
+    claimed_groups=None,
+    low_memory=False,
+    prefetched=None,
+):
+    """Write a parsed station, download its measurement csv data and group summaries in
+    download_pool and write them, and commit the station. cache is the HTTPCache of the run,
+    if any. With parse_pool, an executor, the time series are parsed in the pool while the
+    downloads are written. claimed_groups is as for get_station_downloads. prefetched are the
+    StationDownloads of the station if already downloaded, see prefetch_station_downloads.
+    See run_backup for the other arguments."""
+    removed_ids = None
+    if prefetched is not None:
+        measurements, removed_ids = prefetched.measurements, prefetched.removed_ids
+    elif incremental:
+        changed_ids, removed_ids = changed_measurement_ids(s_db, station_id, measurements)
+        measurements = measurements[measurements["ID"].isin(changed_ids)]
+
+    with stats.phase("db_write"):
+        write_station(
+            s_db,
+            station_id,
+            measurements_csv,
+            measurements,
+            calibrations_csv,
+            calibrations,
+            removed_ids=removed_ids,
+            storage_codec=storage_codec,
+        )
+
+    # download measurement csv data and group summaries in the pool, and insert
+    # them here when all are downloaded, or in batches when streamed
+    if prefetched is not None:
+        download_urls = prefetched.download_urls
+        downloads = prefetched.downloads
+        if stream_downloads:
+            try:
+                write_streamed_downloads(s_db, stats, downloads, storage_codec, parse_series)
+            finally:
+                # the payloads not yet written if the write fails
+                for _, payload in downloads:
+                    payload.close()
+    else:
+        download_urls = get_station_downloads(measurements, claimed_groups)
+        if cache is not None:
+            cache.mark_immutable(locked_measurement_urls(measurements))
+
+        with stats.phase("downloads"):
+            if stream_downloads:
+                stream_station_downloads(
+                    s_db,
+                    stats,
+                    download_pool,
+                    download_urls,
+                    headers,
+                    storage_codec,
+                    parse_series,
                 )
-                s_db.add(measurement_raw_insert)
-
-                for cal_i, cal_d in calibrations.iterrows():
-                    calibration_insert = Calibration(
-                        **{
-                            "id": cal_d["ID"],
-                            "station_id": station_id,
-                            "datetime_of_calibration": cal_d["Date of Calibration"],
-                            "coeff_var_regression_r2": cal_d[
-                                "Coefficient of Variation of the Calibration Regression(R^2)"
-                            ],
-                            "cf_t": cal_d[
-                                "Temperature-adjusted Conductivity vs Concentration Regression Coefficient"
-                            ],
-                            "cf_t_uncertainty": cal_d["CF.T Uncertainty"],
-                            "volume_distilled_water_calibration_l": cal_d[
-                                "Volume of Distilled H20 used in calibration."
-                            ],
-                            "mass_salt_calibration_mg": cal_d["Mass of salt used in calibration."],
-                            "volume_stream_water_calibration_l": cal_d[
-                                "Volume of H20 from stream used in calibration."
-                            ],
-                            "volume_injection_calibration_solution_ml": cal_d[
-                                "Volume of calibration solution injected at each step of 5-point calibration."
-                            ],
-                            "ec_t_step_1": cal_d["First calibration step ECT."],
-                            "ec_t_step_2": cal_d["Second calibration step ECT."],
-                            "ec_t_step_3": cal_d["Third calibration step ECT."],
-                            "ec_t_step_4": cal_d["Fourth calibration step ECT."],
-                            "ec_t_step_5": cal_d["Fifth calibration step ECT."],
-                            "filename": cal_d["Filename"],
-                        }
+            else:
+                downloads = [
+                    (download_key, response.content)
+                    for download_key, response in tqdm(
+                        download_pool.download(download_urls, headers),
+                        desc=" measurement at station",
+                        total=len(download_urls),
+                        leave=False,
+                        position=2,
                     )
+                ]
+    for kind, _ in download_urls:
+        stats.count(f"{kind}_downloads")
+
+    with stats.phase("db_write"):
+        if not stream_downloads:
+            series = None
+            if parse_series and parse_pool is not None:
+                # parsed in the pool while the downloads are written
+                series = parse_pool.submit(series_frame, measurement_downloads(downloads))
+            write_downloads(s_db, downloads, storage_codec=storage_codec)
+            if parse_series:
+                write_measurement_series(
+                    s_db, downloads, series=series.result() if series is not None else None
+                )
 
-                    s_db.add(calibration_insert)
+        write_checkpoint(s_db, station_id, run_id)
+    commit_station(s_db, stats, low_memory)  # all data commit for station here
 
-                calibration_raw_insert = CalibrationRaw(
-                    **{"station_id": station_id, "station_raw_calibration_data": calibrations_csv}
+
+def backup_stations(
+    s_request,
+    s_db,
+    stats,
+    download_pool,
+    token,
+    run_id,
+    projects,
+    stations,
+    completed_ids,
+    incremental=False,
+    storage_codec="none",
+    parse_series=False,
+    stream_downloads=False,
+    cache=None,
+    low_memory=False,
+):
+    """Backup the stations one at a time, by project, skipping the stations in completed_ids.
+    See store_station for the arguments."""
+
+    def fetch_page(url, headers):
+        with stats.phase("station_page"):
+            return s_request.get(url, headers=headers).text
+
+    claimed_groups = set()
+    stations_by_project = group_stations(projects, stations)
+    header_station_measurements = get_data_header(token)
+    header_station_page = get_data_header(token)
+
+    for _, project in tqdm(
+        projects.iterrows(), desc=" projects", total=projects.shape[0], position=0
+    ):
+        project_name = project["project_name"]
+        project_id = project["project_id"]
+
+        write_project(s_db, project_id, project_name)
+
+        stations_in_project = stations_by_project[project_id]
+
+        for _, station in tqdm(
+            stations_in_project.iterrows(),
+            desc=" station in project",
+            total=stations_in_project.shape[0],
+            leave=False,
+            position=1,
+        ):
+            station_id = station["station_id"]
+            if station_id in completed_ids:
+                continue
+
+            stats.count("stations")
+            header_station_measurements["Referer"] = station_page_url(station_id)
+
+            write_station_info(s_db, project_id, station)
+
+            # Get the measurements and calibrations of a station
+            with stats.phase("station_csvs"):
+                measurements_csv, calibrations_csv = get_station_csvs(
+                    s_request, station_id, header_station_measurements
                 )
-                s_db.add(calibration_raw_insert)
-
-                # TODO refactor, see get_station_groups in web_scraping.py
-                groups = [int(x) for x in set(measurements["group"]) if ~np.isnan(x)]
-                group_inserts = []
-                for group in groups:
-                    group_csv_link = (
-                        f"https://wit.fathomscientific.com/group-measurement/{group}/csv-download"
-                    )
-                    group_csv_data = s_request.get(
-                        group_csv_link, headers=header_station_measurements
-                    )
 
-                    group_inserts.append(
-                        MeasurementGroup(**{"id": group, "group_summary": group_csv_data.content})
-                    )
+            if incremental and station_unchanged(
+                s_db, station_id, measurements_csv, calibrations_csv
+            ):
+                stats.count("stations_unchanged")
+                write_checkpoint(s_db, station_id, run_id)
+                commit_station(s_db, stats, low_memory)
+                continue
+
+            station_page = StationPage(
+                s_request, project_id, station_id, header_station_page, fetch_page=fetch_page
+            )
+            with stats.phase("parse"):
+                measurements, calibrations = parse_station_data(
+                    station_id, measurements_csv, calibrations_csv, station_page
+                )
+
+            store_station(
+                s_db,
+                stats,
+                download_pool,
+                run_id,
+                station_id,
+                measurements_csv,
+                measurements,
+                calibrations_csv,
+                calibrations,
+                header_station_measurements,
+                incremental=incremental,
+                storage_codec=storage_codec,
+                parse_series=parse_series,
+                stream_downloads=stream_downloads,
+                cache=cache,
+                claimed_groups=claimed_groups,
+                low_memory=low_memory,
+            )
+
+
+def backup_stations_pipelined(
+    s_request,
+    s_db,
+    db_engine,
+    stats,
+    download_pool,
+    parse_pool,
+    token,
+    run_id,
+    projects,
+    stations,
+    completed_ids,
+    incremental=False,
+    storage_codec="none",
+    parse_series=False,
+    stream_downloads=False,
+    cache=None,
+    fetch_workers=2,
+    low_memory=False,
+    sqlite_profile="safe",
+):
+    """Backup the stations fetched in fetch_workers threads and parsed in parse_pool, a
+    process pool executor, ahead of the station being written, see StationPipeline. The
+    measurement csv data and group summaries are downloaded in the fetch threads as well, see
+    prefetch_station_downloads, leaving the writer to write. The stations are written in the
+    same order as by backup_stations. With low_memory=True at most fetch_workers stations are
+    fetched ahead. See store_station for the other arguments."""
+    for _, project in projects.iterrows():
+        write_project(s_db, project["project_id"], project["project_name"])
+
+    claimed_groups = set()
+    groups_lock = threading.Lock()
+    stations_by_project = group_stations(projects, stations)
+    n_stations = sum(
+        int((~stations_in_project["station_id"].isin(completed_ids)).sum())
+        for stations_in_project in stations_by_project.values()
+    )
+    # the station rows are created as the pipeline consumes them
+    station_list = (
+        (project_id, station)
+        for project_id, stations_in_project in stations_by_project.items()
+        for _, station in stations_in_project.iterrows()
+        if station["station_id"] not in completed_ids
+    )
+
+    def prefetch(read_engine, station_id, measurements):
+        return prefetch_station_downloads(
+            read_engine,
+            station_id,
+            measurements,
+            stats,
+            download_pool,
+            token,
+            incremental=incremental,
+            storage_codec=storage_codec,
+            stream_downloads=stream_downloads,
+            cache=cache,
+            claimed_groups=claimed_groups,
+            groups_lock=groups_lock,
+        )
+
+    pipeline = StationPipeline(
+        s_request,
+        db_engine,
+        stats,
+        token,
+        parse_pool,
+        fetch_workers=fetch_workers,
+        max_pending=fetch_workers if low_memory else None,
+        incremental=incremental,
+        unchanged=station_unchanged,
+        prefetch=prefetch,
+        sqlite_profile=sqlite_profile,
+        low_memory=low_memory,
+    )
+    for fetched in tqdm(
+        pipeline.run(station_list), desc=" stations", total=n_stations, position=0
+    ):
+        station_id = fetched.station["station_id"]
+        stats.count("stations")
+        write_station_info(s_db, fetched.project_id, fetched.station)
+
+        if fetched.unchanged:
+            stats.count("stations_unchanged")
+            write_checkpoint(s_db, station_id, run_id)
+            commit_station(s_db, stats, low_memory)
+            continue
+
+        # downloaded in the fetch threads, no headers needed
+        store_station(
+            s_db,
+            stats,
+            download_pool,
+            run_id,
+            station_id,
+            fetched.measurements_csv,
+            fetched.measurements,
+            fetched.calibrations_csv,
+            fetched.calibrations,
+            None,
+            incremental=incremental,
+            storage_codec=storage_codec,
+            parse_series=parse_series,
+            stream_downloads=stream_downloads,
+            cache=cache,
+            parse_pool=parse_pool,
+            claimed_groups=claimed_groups,
+            low_memory=low_memory,
+            prefetched=fetched.downloads,
+        )
+
+
+def run_backup(
+    username,
+    password,
+    database_path=None,
+    max_workers=1,
+    max_per_host=4,
+    incremental=False,
+    resume=False,
+    storage_codec="none",
+    sqlite_profile="safe",
+    vacuum=False,
+    parse_series=False,
+    stats_path=None,
+    stream_downloads=False,
+    http_cache=None,
+    cache_max_size_mb=None,
+    cache_max_age_days=None,
+    max_rate=None,
+    max_retries=5,
+    timeouts=None,
+    selection=None,
+    parse_workers=0,
+    low_memory=False,
+):
+    """Backup all projects, stations, calibrations and measurements to a SQLite database.
+
+    Measurement CSVs and group summaries are downloaded by a pool of max_workers threads,
+    with at most max_per_host concurrent requests to the Salt Portal. All database inserts
+    are still done from the calling thread.
+
+    With incremental=True an existing backup database is updated instead of replaced. Stations
+    where the measurement and calibration csv files are unchanged are skipped, and otherwise
+    only the csv data of new or modified measurements is downloaded. Measurements and stations
+    that no longer exist in the Salt Portal are deleted from the backup.
+
+    With resume=True an interrupted backup to an existing database is continued. Stations
+    completed in the interrupted run are skipped, the remaining stations are backed up as
+    in an incremental backup.
+
+    The downloaded csv files are stored inline with storage_codec none, or compressed with
+    zlib or zstd and deduplicated in the blob table.
+
+    sqlite_profile sets the SQLite pragmas used while writing the backup, one of default, safe
+    and fast. fast does not sync to disk and the database can be corrupted if the computer
+    crashes during the backup. Secondary indexes are created when the backup is complete, and
+    with vacuum=True the database file is rebuilt to reclaim unused space.
+
+    With parse_series=True the time series in the downloaded measurement csv data are also
+    parsed and stored as numbers in the measurement_series table.
+
+    Timings and request statistics of the run are stored in the run_stats table, and also
+    written as json to stats_path if given. Returns the statistics as a dict.
+
+    With stream_downloads=True the measurement csv data and group summaries are streamed to
+    temporary files, compressed while downloading, and written to the database in batches of
+    STREAM_BATCH_SIZE downloads, keeping the memory use independent of the size of a station.
+
+    http_cache is the path of an SQLite file caching the responses of the Salt Portal between
+    runs, see salt_portal_backup.http_cache. Responses are revalidated with conditional
+    requests, and the csv data of locked measurements are not requested again. The cache is
+    limited to cache_max_size_mb and cache_max_age_days if given.
+
+    Requests are limited to max_rate per second if given, and failed requests (429 and 5xx
+    responses, connection errors and timeouts) are retried up to max_retries times with
+    exponential backoff. The number of concurrent requests is adapted to the latency of the
+    Salt Portal, up to max_per_host, or up to the number of threads making requests if fewer:
+    max_workers, plus the 2 * parse_workers threads fetching stations with parse_workers > 0.
+    timeouts sets the (connect, read) timeouts in seconds by
+    endpoint, see salt_portal_backup.scheduler.
+
+    selection, a StationSelection, limits the backup to some of the projects and stations,
+    e.g. one shard of the stations. The station list csv is always stored in full.
+
+    With parse_workers > 0 the stations are fetched by 2 * parse_workers threads and parsed
+    by a pool of parse_workers processes, ahead of the station being written, see
+    salt_portal_backup.pipeline. The fetch threads also download the measurement csv data
+    and group summaries, in the download pool. The time series are then also parsed in the
+    pool. As with any process pool, a script calling run_backup must guard it with
+    if __name__ == "__main__" on platforms where processes are spawned, e.g. Windows.
+
+    With low_memory=True the memory use is bounded independent of the number of stations:
+    the SQLite page cache and memory mapping are limited, see database.LOW_MEMORY_PRAGMAS,
+    the downloads are streamed as with stream_downloads=True, the session is emptied after
+    each station and with parse_workers > 0 fewer stations are fetched ahead. The peak
+    resident memory of the process is reported as peak_rss_mb in the statistics.
+    """
+    check_codec(storage_codec)
+    if parse_workers < 0:
+        raise ValueError("parse_workers must be 0 or more")
+
+    # a resumed backup writes the remaining stations as an incremental backup
+    incremental = incremental or resume
+    stream_downloads = stream_downloads or low_memory
+
+    db_engine = initialize_database(
+        database_name=database_path,
+        incremental=incremental,
+        sqlite_profile=sqlite_profile,
+        low_memory=low_memory,
+    )
+
+    # the downloads and, when pipelined, the stations are fetched by these threads
+    fetch_workers = 2 * parse_workers
+    request_threads = max_workers + fetch_workers
+
+    stats = BackupStats()
+    scheduler = RequestScheduler(
+        max_rate=max_rate,
+        # no more requests can be in flight than there are threads making them
+        max_concurrency=min(max_per_host, request_threads),
+        max_retries=max_retries,
+        timeouts=timeouts,
+        stats=stats,
+    )
+
+    if http_cache is not None:
+        cache = HTTPCache(
+            http_cache, max_size_mb=cache_max_size_mb, max_age_days=cache_max_age_days
+        )
+    else:
+        cache = contextlib.nullcontext()
+
+    if parse_workers > 0:
+        parse_pool = ProcessPoolExecutor(max_workers=parse_workers)
+    else:
+        parse_pool = contextlib.nullcontext()
+
+    with requests.session() as s_request, Session(db_engine) as s_db, DownloadPool(
+        s_request, max_workers=max_workers, max_per_host=max_per_host
+    ) as download_pool, cache, parse_pool:
+        s_request.hooks["response"].append(stats.response_hook)
+        if http_cache is not None:
+            adapter = CachingAdapter(
+                cache, scheduler=scheduler, pool_maxsize=max(request_threads, 10)
+            )
+        else:
+            adapter = ScheduledAdapter(scheduler, pool_maxsize=max(request_threads, 10))
+        s_request.mount("https://", adapter)
+        s_request.mount("http://", adapter)
+
+        with stats.phase("login"):
+            token = get_login_token(s_request.get(URL_LOGIN).text)
+
+            login_res = login_salt_portal(s_request, token, username, password)
+            sp_semver = check_login(login_res.text)
+
+        run_id = write_version(
+            s_db, sp_semver, username, resume=resume, storage_codec=storage_codec
+        )
+        completed_ids = completed_station_ids(s_db, run_id)
+
+        # the token is set in the headers for all requests in this session
+        header_get_organization = get_data_header(token)
+        with stats.phase("station_list"):
+            projects, stations, stations_csv = get_projects_stations(
+                s_request, header_get_organization
+            )
+        listed_stations = stations
+        if selection is not None:
+            projects, stations = select_stations(selection, projects, stations)
+
+        write_station_list(s_db, stations_csv, storage_codec=storage_codec)
+
+        if parse_workers > 0:
+            backup_stations_pipelined(
+                s_request,
+                s_db,
+                db_engine,
+                stats,
+                download_pool,
+                parse_pool,
+                token,
+                run_id,
+                projects,
+                stations,
+                completed_ids,
+                incremental=incremental,
+                storage_codec=storage_codec,
+                parse_series=parse_series,
+                stream_downloads=stream_downloads,
+                cache=cache if http_cache is not None else None,
+                fetch_workers=fetch_workers,
+                low_memory=low_memory,
+                sqlite_profile=sqlite_profile,
+            )
+        else:
+            backup_stations(
+                s_request,
+                s_db,
+                stats,
+                download_pool,
+                token,
+                run_id,
+                projects,
+                stations,
+                completed_ids,
+                incremental=incremental,
+                storage_codec=storage_codec,
+                parse_series=parse_series,
+                stream_downloads=stream_downloads,
+                cache=cache if http_cache is not None else None,
+                low_memory=low_memory,
+            )
+
+        if incremental:
+            with stats.phase("db_commit"):
+                removed_ids = delete_unlisted_stations(s_db, listed_stations)
+                stats.count("stations_removed", len(removed_ids))
+                delete_unreferenced_blobs(s_db)
+
+        summary = write_run_stats(s_db, run_id, "threads", stats)
 
-                s_db.add_all(group_inserts)
+    finalize_database(db_engine, vacuum=vacuum)
 
-                s_db.commit()  # all data commit for station here
+    return report_run_stats(summary, stats_path)
@@ -0,0 +1,285 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Rate limiting, retries and adaptive concurrency for the requests to the Salt Portal.
+
+RequestScheduler combines:
+
+- a token bucket limiting the request rate to max_rate requests per second,
+- retries with exponential backoff and full jitter on 429 and 5xx responses, connection
+  errors and timeouts, honouring the Retry-After header,
+- AIMD (additive increase, multiplicative decrease) of the number of concurrent requests,
+  increased while the latency of an endpoint is close to the lowest latency seen for it and
+  halved on throttling, server errors, timeouts or when the latency grows,
+- a timeout per endpoint, see ENDPOINT_TIMEOUTS.
+
+With the requests engine the scheduler is used through ScheduledAdapter, mounted on the
+session. The asyncio engine uses the same scheduler in AsyncPortalClient.
+"""
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .instrumentation import endpoint_name
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+# status codes where the request was not processed, also retried for POST requests
+NOT_PROCESSED_STATUSES = frozenset({429, 503})
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (10.0, 60.0)
+ENDPOINT_TIMEOUTS = {
+    "/station-cfts/": (10.0, 120.0),
+    "/measurement/{id}/csv-download": (10.0, 300.0),
+    "/group-measurement/{id}/csv-download": (10.0, 300.0),
+}
+
+
+def retry_after_seconds(value):
+    """Seconds to wait from a Retry-After header, in seconds or as an HTTP date, or None"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Token bucket with rate tokens per second and room for burst tokens"""
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, returns the seconds to wait before it can be used"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # tokens can go negative, later callers wait for the tokens reserved before them
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on the number of concurrent requests, between minimum and maximum.
+
+    A response is slow when its latency is more than latency_factor times the lowest latency
+    seen for its endpoint, plus latency_slack seconds. The limit is increased by 1 / limit
+    for each response that is not slow, and halved at most once per decrease_interval seconds
+    for slow responses and on congestion.
+    """
+
+    def __init__(
+        self,
+        maximum,
+        minimum=1,
+        initial=None,
+        latency_factor=3.0,
+        latency_slack=0.1,
+        decrease_interval=1.0,
+    ):
+        if minimum < 1 or maximum < minimum:
+            raise ValueError("limits must satisfy 1 <= minimum <= maximum")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_factor = latency_factor
+        self.latency_slack = latency_slack
+        self.decrease_interval = decrease_interval
+        self._limit = float(initial if initial is not None else maximum)
+        self._min_latency = {}
+        self._last_decrease = float("-inf")
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def acquire(self):
+        """Wait for a free request slot"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_response(self, endpoint, latency):
+        with self._condition:
+            min_latency = min(self._min_latency.get(endpoint, latency), latency)
+            self._min_latency[endpoint] = min_latency
+            if latency > self.latency_factor * min_latency + self.latency_slack:
+                self._decrease()
+            else:
+                self._limit = min(self.maximum, self._limit + 1 / self._limit)
+                self._condition.notify_all()
+
+    def on_congestion(self):
+        with self._condition:
+            self._decrease()
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease >= self.decrease_interval:
+            self._limit = max(self.minimum, self._limit / 2)
+            self._last_decrease = now
+
+
+class RequestScheduler:
+    """Rate limit, retry policy and adaptive concurrency shared by the requests of a backup.
+
+    max_rate is the maximum number of requests per second, None for no limit. A request is
+    retried at most max_retries times, waiting a random time up to
+    min(backoff_max, backoff_base * 2**attempt) seconds, or longer if the Salt Portal asks so
+    with Retry-After. Concurrent requests are limited to max_concurrency, adapted between 1
+    and max_concurrency. timeouts updates ENDPOINT_TIMEOUTS, as endpoint: (connect, read),
+    and default_timeout is used for other endpoints. Retries are recorded in stats if given.
+    """
+
+    def __init__(
+        self,
+        max_rate=None,
+        max_concurrency=8,
+        max_retries=5,
+        backoff_base=0.5,
+        backoff_max=60.0,
+        timeouts=None,
+        default_timeout=DEFAULT_TIMEOUT,
+        stats=None,
+    ):
+        if max_retries < 0:
+            raise ValueError("max_retries must be at least 0")
+        self.rate_limit = TokenBucket(max_rate) if max_rate is not None else None
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeouts = {**ENDPOINT_TIMEOUTS, **(timeouts or {})}
+        self.default_timeout = default_timeout
+        self.stats = stats
+        self._random = random.Random()
+
+    def timeout(self, url):
+        return self.timeouts.get(endpoint_name(url), self.default_timeout)
+
+    def rate_delay(self):
+        """Seconds to wait before the next request is sent"""
+        return self.rate_limit.reserve() if self.rate_limit is not None else 0.0
+
+    def retry_delay(self, method, url, attempt, status=None, sent=True, retry_after=None):
+        """Seconds to wait before retrying a failed request, or None if it is not retried.
+
+        status is the status of the response, or None if the request failed without a
+        response, with sent=False if the connection failed before the request was sent.
+        attempt is the number of retries done so far.
+        """
+        if status is None:
+            # a request failing after it was sent may have been processed
+            retry = method in IDEMPOTENT_METHODS or not sent
+        elif status in RETRY_STATUSES:
+            retry = method in IDEMPOTENT_METHODS or status in NOT_PROCESSED_STATUSES
+        else:
+            return None
+
+        self.concurrency.on_congestion()
+        if not retry or attempt >= self.max_retries:
+            return None
+
+        if self.stats is not None:
+            self.stats.record_retry(url)
+        delay = self._random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+        retry_after = retry_after_seconds(retry_after)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    def send(self, send, request, **kwargs):
+        """Send the prepared request with send, a requests adapter send method, retrying
+        failed requests. Unless stream=True the body is read before the response is returned,
+        so a connection dropped while the body is read is retried as well. Returns the response,
+        or raises the last error, an HTTPError if the request still fails with a status in
+        RETRY_STATUSES."""
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout(request.url)
+        endpoint = endpoint_name(request.url)
+
+        attempt = 0
+        while True:
+            time.sleep(self.rate_delay())
+            self.concurrency.acquire()
+            start = time.perf_counter()
+            try:
+                response = send(request, **kwargs)
+                if not kwargs.get("stream"):
+                    # reads the body, which requests otherwise reads after the adapter
+                    response.content
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout,
+            ) as error:
+                delay = self.retry_delay(
+                    request.method,
+                    request.url,
+                    attempt,
+                    sent=not isinstance(error, requests.exceptions.ConnectTimeout),
+                )
+                if delay is None:
+                    raise
+            else:
+                delay = self.retry_delay(
+                    request.method,
+                    request.url,
+                    attempt,
+                    status=response.status_code,
+                    retry_after=response.headers.get("Retry-After"),
+                )
+                if delay is None:
+                    if response.status_code in RETRY_STATUSES:
+                        response.raise_for_status()
+                    if response.status_code < 400:
+                        self.concurrency.on_response(endpoint, time.perf_counter() - start)
+                    return response
+                response.close()
+            finally:
+                self.concurrency.release()
+
+            time.sleep(delay)
+            attempt += 1
+
+
+class ScheduledAdapter(HTTPAdapter):
+    """requests transport adapter sending the requests through a RequestScheduler"""
+
+    def __init__(self, scheduler=None, **kwargs):
+        self.scheduler = scheduler
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if self.scheduler is None:
+            return super().send(request, **kwargs)
+        return self.scheduler.send(super().send, request, **kwargs)
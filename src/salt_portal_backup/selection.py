@@ -0,0 +1,103 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Selection of the stations to backup, by project and station id, station name and shard.
+
+With a shard i/n the stations are partitioned into n shards by a hash of the station id,
+so n processes or computers can backup disjoint parts of the organization into separate
+databases, which are combined with salt_portal_backup.merge.merge_backups.
+"""
+
+import fnmatch
+import re
+import zlib
+
+
+def parse_shard(shard):
+    """Parse a shard "i/n", i from 1 to n, returns (i, n)"""
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", shard)
+    if match is None:
+        raise ValueError(f"Shard must be given as i/n, e.g. 1/4, not {shard}")
+    i, n = int(match.group(1)), int(match.group(2))
+    if not 1 <= i <= n:
+        raise ValueError(f"Shard {shard} must satisfy 1 <= i <= n")
+    return i, n
+
+
+def station_shard(station_id, n):
+    """Shard, from 1 to n, of a station. Stable between runs and computers."""
+    return zlib.crc32(str(int(station_id)).encode()) % n + 1
+
+
+class StationSelection:
+    """Stations to backup.
+
+    A station is selected when its project is in project_ids and its id in station_ids, if
+    given, and its name matches one of the glob patterns in station_names, if given. Stations
+    whose project, id or name matches the exclude arguments are not selected. Name patterns
+    are matched case insensitive, e.g. "River*". shard is "i/n" or (i, n), selecting only
+    the stations of shard i of n.
+    """
+
+    def __init__(
+        self,
+        project_ids=None,
+        exclude_project_ids=None,
+        station_ids=None,
+        exclude_station_ids=None,
+        station_names=None,
+        exclude_station_names=None,
+        shard=None,
+    ):
+        self.project_ids = _id_set(project_ids)
+        self.exclude_project_ids = _id_set(exclude_project_ids) or set()
+        self.station_ids = _id_set(station_ids)
+        self.exclude_station_ids = _id_set(exclude_station_ids) or set()
+        self.station_names = list(station_names) if station_names else None
+        self.exclude_station_names = list(exclude_station_names or [])
+        self.shard = parse_shard(shard) if isinstance(shard, str) else shard
+
+    def selects(self, station_id, station_name, project_id):
+        station_id, project_id = int(station_id), int(project_id)
+        if self.project_ids is not None and project_id not in self.project_ids:
+            return False
+        if project_id in self.exclude_project_ids:
+            return False
+        if self.station_ids is not None and station_id not in self.station_ids:
+            return False
+        if station_id in self.exclude_station_ids:
+            return False
+        if self.station_names is not None and not _matches(station_name, self.station_names):
+            return False
+        if _matches(station_name, self.exclude_station_names):
+            return False
+        if self.shard is not None:
+            i, n = self.shard
+            return station_shard(station_id, n) == i
+        return True
+
+    def apply(self, projects, stations):
+        """Select stations, a frame as from parse_projects_stations, and the projects with
+        selected stations. Returns (projects, stations)."""
+        selected = [
+            self.selects(station_id, station_name, project_id)
+            for station_id, station_name, project_id in zip(
+                stations["station_id"], stations["station_name"], stations["project_id"]
+            )
+        ]
+        stations = stations[selected]
+        projects = projects[projects["project_id"].isin(stations["project_id"])]
+        return projects, stations
+
+
+def _id_set(ids):
+    if not ids:
+        return None
+    return {int(i) for i in ids}
+
+
+def _matches(name, patterns):
+    name = str(name).lower()
+    return any(fnmatch.fnmatchcase(name, pattern.lower()) for pattern in patterns)
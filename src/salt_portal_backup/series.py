@@ -0,0 +1,160 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Parsing of the downloaded measurement csv files into numeric time series.
+
+The measurement csv files start with a block of metadata, followed by the logged time series.
+The header row of the time series is found by its column names, and the series is read with
+the pandas csv reader into the columns of the measurement_series table:
+
+sample       row number in the series, starting at 0
+datetime     time of the sample, as text, e.g. 2023-05-01 10:00:00
+time_s       seconds since the first sample
+ec           electrical conductivity
+ec_t         temperature compensated electrical conductivity
+temperature  water temperature
+
+Columns not found in a csv file are missing values. The datetime is read from the csv file
+when its times are datetimes. When the times are seconds, the datetime is missing until
+fill_series_datetime adds time_s to the datetime of the measurement, taken as the time of
+the first sample.
+"""
+
+import re
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+SERIES_COLUMNS = ("time_s", "ec", "ec_t", "temperature")
+
+# patterns of the csv column names, ec_t is matched before ec
+SERIES_COLUMN_PATTERNS = {
+    "time_s": re.compile(r"^(date ?)?time(stamp)?\b|^datetime\b|^seconds\b"),
+    "ec_t": re.compile(r"^ec[._ ]?t\b|^ec ?25\b|^temperature compensated"),
+    "ec": re.compile(r"^ec\b|^conductivity\b"),
+    "temperature": re.compile(r"^temp(erature)?\b|^t ?\((°|deg)?c\)"),
+}
+
+# number of lines searched for the header row of the series
+MAX_HEADER_LINES = 200
+
+
+def _match_columns(names):
+    """Map the series columns to the positions of the matching csv columns"""
+    positions = {}
+    for position, name in enumerate(names):
+        name = name.strip().strip('"').lower()
+        for column, pattern in SERIES_COLUMN_PATTERNS.items():
+            if column not in positions and pattern.search(name):
+                positions[column] = position
+                break
+    return positions
+
+
+def find_series_header(csv_lines):
+    """Index of the header row of the time series and the positions of its columns, or None
+    if there is no row with a time column and an ec or ec_t column"""
+    for i_line, line in enumerate(csv_lines[:MAX_HEADER_LINES]):
+        positions = _match_columns(line.decode("utf-8", errors="replace").split(","))
+        if "time_s" in positions and ("ec" in positions or "ec_t" in positions):
+            return i_line, positions
+    return None
+
+
+def datetime_text(timestamps):
+    """Timestamps as text, as the datetimes of the Salt Portal, with fractional seconds only
+    if any timestamp has them"""
+    timestamps = pd.Series(timestamps)
+    if (timestamps.dt.microsecond != 0).any():
+        return timestamps.dt.strftime("%Y-%m-%d %H:%M:%S.%f").to_numpy()
+    return timestamps.dt.strftime("%Y-%m-%d %H:%M:%S").to_numpy()
+
+
+def _times(time_values):
+    """Seconds since the first sample, from seconds or from datetimes, and the datetimes of
+    the samples as text if the times are datetimes, otherwise None"""
+    seconds = pd.to_numeric(time_values, errors="coerce")
+    if seconds.notna().any():
+        return seconds.to_numpy(dtype=float) - seconds.iloc[0], None
+
+    timestamps = pd.to_datetime(time_values, errors="coerce")
+    return (
+        (timestamps - timestamps.iloc[0]).dt.total_seconds().to_numpy(),
+        datetime_text(timestamps),
+    )
+
+
+def parse_measurement_series(csv_data):
+    """Parse the time series of a measurement csv file, returns a data frame with sample and
+    the SERIES_COLUMNS. The data frame is empty if no time series is found."""
+    if isinstance(csv_data, str):
+        csv_data = csv_data.encode()
+
+    empty = pd.DataFrame(columns=["sample", "datetime", *SERIES_COLUMNS])
+
+    if not csv_data:
+        return empty
+
+    header = find_series_header(csv_data.splitlines()[:MAX_HEADER_LINES])
+    if header is None:
+        return empty
+    header_line, positions = header
+
+    data = pd.read_csv(
+        BytesIO(csv_data),
+        skiprows=header_line + 1,
+        header=None,
+        usecols=sorted(positions.values()),
+        dtype=str,
+        skip_blank_lines=True,
+        on_bad_lines="skip",
+    )
+    if data.empty:
+        return empty
+
+    series = pd.DataFrame({"sample": np.arange(data.shape[0]), "datetime": None})
+    for column in SERIES_COLUMNS:
+        if column not in positions:
+            series[column] = np.nan
+        elif column == "time_s":
+            series[column], datetimes = _times(data[positions[column]])
+            if datetimes is not None:
+                series["datetime"] = datetimes
+        else:
+            series[column] = pd.to_numeric(data[positions[column]], errors="coerce").to_numpy()
+
+    return series
+
+
+def series_frame(measurement_csvs):
+    """Time series of several measurements as one data frame, measurement_csvs is a list of
+    (measurement_id, csv_data)"""
+    frames = []
+    for measurement_id, csv_data in measurement_csvs:
+        series = parse_measurement_series(csv_data)
+        if not series.empty:
+            series.insert(0, "measurement_id", measurement_id)
+            frames.append(series)
+
+    if not frames:
+        return pd.DataFrame(columns=["measurement_id", "sample", "datetime", *SERIES_COLUMNS])
+
+    # datetimes as python strings, as the datetimes filled by fill_series_datetime
+    return pd.concat(frames, ignore_index=True).astype({"datetime": object})
+
+
+def fill_series_datetime(series, start_datetimes):
+    """Fill the missing datetimes of a series frame from time_s and start_datetimes, the
+    datetime of the first sample by measurement id"""
+    missing = series["datetime"].isna()
+    if missing.any():
+        starts = pd.to_datetime(
+            series.loc[missing, "measurement_id"].map(start_datetimes), errors="coerce"
+        )
+        datetimes = starts + pd.to_timedelta(series.loc[missing, "time_s"], unit="s")
+        series = series.astype({"datetime": object})
+        series.loc[missing, "datetime"] = datetime_text(datetimes)
+    return series
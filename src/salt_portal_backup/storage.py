@@ -0,0 +1,133 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Storage codecs for the downloaded csv files stored in the backup database.
+
+With the codec none the files are stored inline as before. With zlib or zstd each file is
+compressed and stored once in the blob table, keyed by the sha256 of the uncompressed
+content, and the tables holding the files reference the blob instead.
+
+zstd requires the zstandard package, install with: pip install salt-portal-backup[zstd]
+
+Downloads can also be streamed with spool_payload, compressing the content chunk by chunk
+into a temporary file which is only kept in memory up to SPOOL_MAX_MEMORY bytes.
+"""
+
+import hashlib
+import tempfile
+import zlib
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import zstandard
+else:
+    try:
+        import zstandard
+    except ImportError:  # optional dependency
+        zstandard = None
+
+CODECS = ("none", "zlib", "zstd")
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 10
+
+SPOOL_MAX_MEMORY = 1024 * 1024
+SPOOL_CHUNK_SIZE = 64 * 1024
+
+
+def check_codec(codec):
+    if codec not in CODECS:
+        raise ValueError(f"Unknown storage codec {codec}, must be one of {', '.join(CODECS)}")
+    if codec == "zstd" and zstandard is None:
+        raise ImportError(
+            "The zstd storage codec requires zstandard, "
+            "install with: pip install salt-portal-backup[zstd]"
+        )
+
+
+def compress(payload, codec):
+    if codec == "zlib":
+        return zlib.compress(payload, ZLIB_LEVEL)
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(payload)
+    return payload
+
+
+def decompress(data, codec):
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "zstd":
+        if zstandard is None:
+            check_codec(codec)
+        # streamed data is compressed without the content size in the frame header
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def _compressobj(codec):
+    if codec == "zlib":
+        return zlib.compressobj(ZLIB_LEVEL)
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return None
+
+
+def content_hash(payload):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return hashlib.sha256(payload).hexdigest()
+
+
+class SpooledPayload:
+    """Downloaded file compressed with codec into a spooled temporary file.
+
+    size is the size of the uncompressed file, stored_size the size of the spooled data and
+    sha256 the hash of the uncompressed file, as content_hash.
+    """
+
+    def __init__(self, spool, codec, size, stored_size, sha256):
+        self.spool = spool
+        self.codec = codec
+        self.size = size
+        self.stored_size = stored_size
+        self.sha256 = sha256
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.spool.close()
+
+    def chunks(self, chunk_size=SPOOL_CHUNK_SIZE):
+        """Iterate over the spooled, possibly compressed, data"""
+        self.spool.seek(0)
+        return iter(lambda: self.spool.read(chunk_size), b"")
+
+    def read_payload(self):
+        """The uncompressed file"""
+        self.spool.seek(0)
+        return decompress(self.spool.read(), self.codec)
+
+
+def spool_payload(chunks, codec="none", max_memory=SPOOL_MAX_MEMORY):
+    """Write the chunks of a download to a spooled temporary file, compressed with codec"""
+    compressor = _compressobj(codec)
+    sha256 = hashlib.sha256()
+    spool = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    size = 0
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+        size += len(chunk)
+        sha256.update(chunk)
+        spool.write(chunk if compressor is None else compressor.compress(chunk))
+    if compressor is not None:
+        spool.write(compressor.flush())
+
+    return SpooledPayload(spool, codec, size, spool.tell(), sha256.hexdigest())
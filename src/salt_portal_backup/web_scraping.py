@@ -2,27 +2,44 @@
 #
 # SPDX-License-Identifier: BSD-3-Clause
 
+import os
 import re
 from io import BytesIO
-from datetime import datetime
+from typing import TYPE_CHECKING
 
 from bs4 import BeautifulSoup as bs
+from bs4 import SoupStrainer
 import pandas as pd
 
+if TYPE_CHECKING:
+    import lxml.html
+else:
+    try:
+        import lxml.html
+    except ImportError:  # optional dependency, station pages are parsed with html.parser instead
+        lxml = None
+
 # import polars as pl
 import numpy as np
 
-URL_LOGIN = "https://wit.fathomscientific.com/accounts/login/"
+# the Salt Portal address can be changed with the SALT_PORTAL_URL environment variable,
+# e.g. for a local stand-in of the Salt Portal as used by the benchmarks
+URL_BASE = os.environ.get("SALT_PORTAL_URL", "https://wit.fathomscientific.com").rstrip("/")
+URL_LOGIN = f"{URL_BASE}/accounts/login/"
+URL_STATION_LIST = f"{URL_BASE}/station-cfts/"
+
+MEASUREMENT_UPDATE_PATTERN = re.compile(r"/measurement/(\d+)/update")
+CALIBRATION_UPDATE_PATTERN = re.compile(r"/calibration/(\d+)/update")
 
 header_login = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/117.0",
     "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8",
     "Accept-Language": "en-US,en;q=0.5",
     "Accept-Encoding": "gzip, deflate, br",
-    "Referer": "https://wit.fathomscientific.com/accounts/login/?next=/",
+    "Referer": f"{URL_LOGIN}?next=/",
     "Content-Type": "application/x-www-form-urlencoded",
     "Content-Length": "134",
-    "Origin": "https://wit.fathomscientific.com",
+    "Origin": URL_BASE,
     "DNT": "1",
     "Connection": "keep-alive",
     "Cookie": "csrftoken={token}",
@@ -50,34 +67,196 @@ header_data_template = {
 }
 
 
-def login_salt_portal(s_request, session_token, username, password):
-    header_login["Cookie"] = header_login["Cookie"].format(token=session_token)
-    login_payload = {
+def get_login_token(login_page_html):
+    """Get the csrf token from the html of the login page"""
+    html = bs(login_page_html, "html.parser")
+    return html.find("input", {"name": "csrfmiddlewaretoken"}).attrs["value"]
+
+
+def get_login_payload(session_token, username, password):
+    return {
         "_method": "login",
         "csrfmiddlewaretoken": session_token,
         "login": username,
         "password": password,
         "next": "/",
     }
-    return s_request.post(URL_LOGIN, data=login_payload, headers=header_login)
+
+
+def get_login_header(session_token):
+    header = header_login.copy()
+    header["Cookie"] = header["Cookie"].format(token=session_token)
+    return header
+
+
+def get_data_header(session_token):
+    """Copy of the data header template with the session token set"""
+    header = header_data_template.copy()
+    header["Cookie"] = header["Cookie"].format(token=session_token)
+    return header
+
+
+def check_login(main_page_html):
+    """Check that the login succeeded, returns the Salt Portal version from the main page"""
+    html_main_page = bs(main_page_html, "html.parser")
+    if html_main_page.find("li", string=re.compile("Successfully signed in")) is None:
+        raise Exception("Login failed")
+
+    html_sidenav = html_main_page.find("div", class_="wh-sidenav-content")
+    full_version_tag = html_sidenav.find("p", string=re.compile("Salt Portal "))
+    return full_version_tag.text.strip().lstrip("Salt Portal ")
+
+
+def login_salt_portal(s_request, session_token, username, password):
+    login_payload = get_login_payload(session_token, username, password)
+    return s_request.post(
+        URL_LOGIN, data=login_payload, headers=get_login_header(session_token)
+    )
 
 
 def get_projects_stations(s_request, header_organization):
     """Retrieve the station csv file from SP, which also contains project information"""
 
-    header_organization["Referer"] = "https://wit.fathomscientific.com/"
-    station_csv = s_request.get(
-        "https://wit.fathomscientific.com/station-cfts/", headers=header_organization
-    )
+    header_organization["Referer"] = f"{URL_BASE}/"
+    station_csv = s_request.get(URL_STATION_LIST, headers=header_organization)
+
+    projects, stations = parse_projects_stations(station_csv.content)
+
+    return projects, stations, station_csv.content
+
 
+def parse_projects_stations(station_csv):
     station_csv_header = b"station_name,station_id,project_name,project_id,cft_1,cft_2,cft_3\r\n"
-    stations = pd.read_csv(BytesIO(station_csv_header + station_csv.content))
+    stations = pd.read_csv(BytesIO(station_csv_header + station_csv))
     # stations_pl = pl.read_csv(BytesIO(station_csv_header + station_csv.content))
 
     projects = stations[["project_name", "project_id"]].drop_duplicates()
     # projects_pl = stations_pl[["project_name", "project_id"]].unique()
 
-    return projects, stations, station_csv.content
+    return projects, stations
+
+
+def station_page_url(station_id):
+    return f"{URL_BASE}/station/{station_id}/"
+
+
+def station_csv_url(station_id, table):
+    """Url of the measurements or calibrations csv file of a station"""
+    return f"{URL_BASE}/station/{station_id}/{table}"
+
+
+def group_csv_url(group_id):
+    return f"{URL_BASE}/group-measurement/{group_id}/csv-download"
+
+
+class StationPage:
+    """The html page of a station, holding the measurement (table_1) and calibration (table_2)
+    tables.
+
+    The page is fetched and parsed on first access only, and then shared by
+    parse_station_calibrations and parse_station_measurements. The page is fetched with
+    fetch_page if given, a callable returning the html of the page, or else with s_request.
+
+    Only the two tables are parsed, with lxml if installed and otherwise with BeautifulSoup
+    and html.parser.
+    """
+
+    def __init__(
+        self, s_request, project_id, station_id, header_station_page, fetch_page=None
+    ):
+        self.s_request = s_request
+        self.project_id = project_id
+        self.station_id = station_id
+        self.header_station_page = header_station_page
+        self.fetch_page = fetch_page
+        self._page_html = None
+        self._html = None
+        self._lxml_tables = None
+
+    @property
+    def page_html(self):
+        if self._page_html is None:
+            self.header_station_page["Referer"] = f"{URL_BASE}/project/{self.project_id}/"
+            if self.fetch_page is not None:
+                self._page_html = self.fetch_page(
+                    station_page_url(self.station_id), self.header_station_page
+                )
+            else:
+                self._page_html = self.s_request.get(
+                    station_page_url(self.station_id), headers=self.header_station_page
+                ).text
+        return self._page_html
+
+    @property
+    def html(self):
+        """The tables of the page parsed by BeautifulSoup"""
+        if self._html is None:
+            self._html = bs(
+                self.page_html,
+                "html.parser",
+                parse_only=SoupStrainer("table", id=["table_1", "table_2"]),
+            )
+        return self._html
+
+    @property
+    def table_1(self):
+        return self.html.find("table", id="table_1")
+
+    @property
+    def table_2(self):
+        return self.html.find("table", id="table_2")
+
+    def _table_rows(self, table_id):
+        """Rows in the body of the table, as (text of the first cell, link hrefs of each cell)"""
+        if lxml is not None:
+            if self._lxml_tables is None:
+                document = lxml.html.fromstring(self.page_html)
+                self._lxml_tables = {
+                    table.get("id"): table
+                    for table in document.xpath('//table[@id="table_1" or @id="table_2"]')
+                }
+            rows = []
+            for tr in self._lxml_tables[table_id].xpath("tbody/tr"):
+                tds = tr.xpath("td")
+                rows.append(
+                    (tds[0].text_content() if tds else "", [td.xpath(".//a/@href") for td in tds])
+                )
+            return rows
+
+        table = self.table_1 if table_id == "table_1" else self.table_2
+        rows = []
+        for tr in table.tbody.find_all("tr"):
+            tds = tr.find_all("td")
+            rows.append(
+                (
+                    tds[0].get_text() if tds else "",
+                    [[a.get("href", "") for a in td.find_all("a")] for td in tds],
+                )
+            )
+        return rows
+
+    def measurement_links(self):
+        """(measurement id, download link) of the measurements in table_1. The id is taken from
+        the update link, the first link in the cell of the download link."""
+        links = []
+        for _, row_hrefs in self._table_rows("table_1"):
+            for hrefs in row_hrefs:
+                for href in hrefs:
+                    if "download" in href:
+                        match = MEASUREMENT_UPDATE_PATTERN.search(hrefs[0])
+                        links.append((int(match.group(1)), href))
+        return links
+
+    def calibration_ids(self):
+        """(row number, calibration id, datetime) of the calibrations in table_2. The id is taken
+        from the first link in the row, the datetime from the first cell."""
+        calibrations = []
+        for i_row, (first_text, row_hrefs) in enumerate(self._table_rows("table_2")):
+            for hrefs in row_hrefs:
+                if hrefs:
+                    match = CALIBRATION_UPDATE_PATTERN.search(hrefs[0])
+                    calibrations.append((i_row, int(match.group(1)), first_text.strip()))
+        return calibrations
 
 
 def get_station_data(
@@ -85,133 +264,121 @@ def get_station_data(
 ):
     """Retrieve measurement and calibration info and data for a specific station"""
 
-    calibrations_csv, calibrations = get_station_calibrations(
-        s_request, project_id, station_id, header_station_measurements, header_station_page
+    measurements_csv, calibrations_csv = get_station_csvs(
+        s_request, station_id, header_station_measurements
     )
-    measurements_csv, measurements = get_station_measurements(
-        s_request, project_id, station_id, header_station_measurements, header_station_page
+
+    station_page = StationPage(s_request, project_id, station_id, header_station_page)
+    measurements, calibrations = parse_station_data(
+        station_id, measurements_csv, calibrations_csv, station_page
     )
 
     return measurements_csv, measurements, calibrations_csv, calibrations
 
 
-def get_station_calibrations(
-    s_request, project_id, station_id, header_station_measurements, header_station_page
-):
+def get_station_csvs(s_request, station_id, header_station_measurements):
+    """Retrieve the raw measurement and calibration csv files for a specific station"""
+
     calibrations_csv = s_request.get(
-        f"https://wit.fathomscientific.com/station/{station_id}/calibrations",
-        headers=header_station_measurements,
+        station_csv_url(station_id, "calibrations"), headers=header_station_measurements
     )
+    measurements_csv = s_request.get(
+        station_csv_url(station_id, "measurements"), headers=header_station_measurements
+    )
+
+    return measurements_csv.content, calibrations_csv.content
+
+
+def parse_station_data(station_id, measurements_csv, calibrations_csv, station_page):
+    """Parse the measurement and calibration csv files of a station, adding the measurement
+    download links and calibration ids from the station page"""
+
+    calibrations = parse_station_calibrations(station_id, calibrations_csv, station_page)
+    measurements = parse_station_measurements(station_id, measurements_csv, station_page)
+
+    return measurements, calibrations
+
 
-    calibrations = pd.read_csv(BytesIO(calibrations_csv.content))
+def parse_station_calibrations(station_id, calibrations_csv, station_page):
+    calibrations = pd.read_csv(BytesIO(calibrations_csv))
     calibrations["station_id"] = station_id
 
     if calibrations.size == 0:
-        return calibrations_csv.content, calibrations
+        return calibrations
 
     # get calibration id, insert to calibrations dataframe
     # matching on order and datetime intead. If this causes problems and raises
     # the Exception below, also include match on filename.
     calibrations["ID"] = pd.array([pd.NA] * calibrations.shape[0], dtype="Int64")
 
-    header_station_page["Referer"] = f"https://wit.fathomscientific.com/project/{project_id}/"
-
-    station_page_get = s_request.get(
-        f"https://wit.fathomscientific.com/station/{station_id}/", headers=header_station_page
+    calibration_ids = pd.DataFrame(
+        station_page.calibration_ids(), columns=["row", "ID", "html_datetime"]
+    ).drop_duplicates("row", keep="last")
+
+    if calibration_ids.empty:
+        return calibrations
+
+    # the html table does not round the time, just truncates the datetime str so
+    # e.g. 17:32:59 -> 17:32, but also removes leading zeroes 09:00 -> 9:00
+    # format should be "%Y-%m-%d %H:%M", apart from the missing leading zeros.
+    # add leading zeroes to be able to compared with what is stored in the table
+    html_calib_datetime = pd.to_datetime(
+        calibration_ids["html_datetime"], format="%Y-%m-%d %H:%M"
+    ).dt.strftime("%Y-%m-%d %H:%M")
+
+    table_calib_datetime = (
+        calibrations.loc[calibration_ids["row"], "Date of Calibration"]
+        .str[:16]  # length of "%Y-%m-%d %H:%M"
+        .to_numpy()
     )
 
-    station_html = bs(station_page_get.text, "html.parser")
-
-    table_2 = station_html.find("table", id="table_2")
-    for i_row, row in enumerate(table_2.tbody.find_all("tr")):
-        columns = row.find_all("td")
-        for td in columns:
-            td_links = td.find_all("a")
-            if len(td_links) > 0:
-                match_upd = re.search(r"/calibration/(\d+)/update", td_links[0]["href"])
-                calibration_id = int(match_upd.group(1))
-
-                html_calib_datetime = columns[0].string
-
-                # the html table does not round the time, just truncates the datetime str so
-                # e.g. 17:32:59 -> 17:32, but also removes leading zeroes 09:00 -> 9:00
-                # format should be "%Y-%m-%d %H:%M", apart from the missing leading zeros.
-                # add leading zeroes to be able to compared with what is stored in the table
-
-                html_calib_datetime = datetime.strptime(
-                    html_calib_datetime, "%Y-%m-%d %H:%M"
-                ).strftime("%Y-%m-%d %H:%M")
-
-                table_calib_datetime = calibrations.loc[i_row, "Date of Calibration"][
-                    : len(html_calib_datetime)
-                ]
+    mismatch = html_calib_datetime.to_numpy() != table_calib_datetime
+    if mismatch.any():
+        i_mismatch = mismatch.argmax()
+        raise Exception(
+            f"Calibration id - no match on datetime. "
+            f"Datetime from html {html_calib_datetime.iloc[i_mismatch]} not equal to "
+            f"datetime from csv table {table_calib_datetime[i_mismatch]}"
+        )
 
-                if html_calib_datetime == table_calib_datetime:
-                    calibrations.loc[i_row, "ID"] = calibration_id
-                else:
-                    raise Exception(
-                        f"Calibration id - no match on datetime. "
-                        f"Datetime from html {html_calib_datetime} not equal to "
-                        f"datetime from csv table {table_calib_datetime}"
-                    )
+    calibrations.loc[calibration_ids["row"], "ID"] = calibration_ids["ID"].to_numpy()
 
-    return calibrations_csv.content, calibrations
+    return calibrations
 
 
-def get_station_measurements(
-    s_request, project_id, station_id, header_station_measurements, header_station_page
-):
-    measurements_csv = s_request.get(
-        f"https://wit.fathomscientific.com/station/{station_id}/measurements",
-        headers=header_station_measurements,
-    )
-
-    measurements = pd.read_csv(BytesIO(measurements_csv.content))
+def parse_station_measurements(station_id, measurements_csv, station_page):
+    measurements = pd.read_csv(BytesIO(measurements_csv))
     measurements["station_id"] = station_id
 
-    download_base = "https://wit.fathomscientific.com"
+    download_base = URL_BASE
     measurements["download_link"] = None
 
-    header_station_page["Referer"] = f"https://wit.fathomscientific.com/project/{project_id}/"
-
-    station_page_get = s_request.get(
-        f"https://wit.fathomscientific.com/station/{station_id}/", headers=header_station_page
-    )
-
-    station_html = bs(station_page_get.text, "html.parser")
-    table_1 = station_html.find("table", id="table_1")
-
     if measurements.size == 0:
-        return measurements_csv.content, measurements
+        return measurements
 
-    # Get download link and add to measurements
-    for row in table_1.tbody.find_all("tr"):
-        # Find all data for each column
-        columns = row.find_all("td")
-        for td in columns:
-            td_links = td.find_all("a")
-            if len(td_links) > 0:  # has link(s)
-                for td_link in td_links:
-                    if "download" in td_link["href"]:
-                        csv_dl_partial_link = td_link["href"]
+    # Get download link and add to measurements, joined on the measurement id
+    download_links = pd.DataFrame(
+        station_page.measurement_links(), columns=["ID", "download_link"]
+    ).drop_duplicates("ID", keep="last")
+    download_links["download_link"] = download_base + download_links["download_link"]
 
-                        match = re.search(r"/measurement/(\d+)/update", td_links[0]["href"])
-                        measurement_id = int(match.group(1))
+    links = measurements["ID"].map(download_links.set_index("ID")["download_link"])
+    measurements["download_link"] = links.astype(object).where(links.notna(), None)
 
-                        measurements.loc[measurements["ID"] == measurement_id, "download_link"] = (
-                            download_base + csv_dl_partial_link
-                        )
+    return measurements
 
-    return measurements_csv.content, measurements
 
+def station_group_ids(measurements):
+    """Sorted ids of the measurement groups of the measurements"""
+    return sorted({int(x) for x in measurements["group"] if ~np.isnan(x)})
 
-def get_station_groups(s, header_station_measurements, measurements):
-    groups = [int(x) for x in set(measurements["group"]) if ~np.isnan(x)]
-    for group in groups:
-        group_csv_link = f"https://wit.fathomscientific.com/group-measurement/{group}/csv-download"
-        group_csv_data = s.get(group_csv_link, headers=header_station_measurements)
 
+def get_station_groups(s, header_station_measurements, measurements):
+    """Download the group summaries of the groups of the measurements, returns a dict of
+    group id: group summary csv"""
     # don't need the dataframe where, csv data is not returned with a fixed strucutre
     # group_df = pd.read_csv(BytesIO(group_csv_data.content), skiprows=2)
-
-    return group_csv_data
+    return {
+        group: s.get(group_csv_url(group), headers=header_station_measurements).content
+        for group in station_group_ids(measurements)
+    }
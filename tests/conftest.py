@@ -0,0 +1,71 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+"""
+Fixtures running the backup against the local Salt Portal stand-in of the benchmarks.
+
+The url of the Salt Portal is read when salt_portal_backup is imported, so one stand-in
+server is started here, before the tests import the package, and each test gets its own
+portal content served by it.
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "benchmarks"))
+from portal_standin import PortalStandin, serve  # type: ignore[import-not-found]  # noqa: E402
+
+
+class _CurrentPortal:
+    """Serves the portal of the running test"""
+
+    portal = None
+
+    @property
+    def etags(self):
+        return self.portal.etags
+
+    def route(self, method, path):
+        return self.portal.route(method, path)
+
+
+_current_portal = _CurrentPortal()
+_server = serve(_current_portal)
+os.environ["SALT_PORTAL_URL"] = f"http://127.0.0.1:{_server.server_address[1]}"
+os.environ["TQDM_DISABLE"] = "1"
+
+
+@pytest.fixture
+def make_portal():
+    """Serve a new PortalStandin with the given arguments, returns it"""
+
+    def make(*args, **kwargs):
+        kwargs.setdefault("n_samples", 20)
+        _current_portal.portal = PortalStandin(*args, **kwargs)
+        return _current_portal.portal
+
+    yield make
+    _current_portal.portal = None
+
+
+@pytest.fixture
+def portal(make_portal):
+    """A small portal of 2 projects with 3 stations of 5 measurements each"""
+    return make_portal(2, 3, 5, 2)
+
+
+@pytest.fixture
+def backup(tmp_path):
+    """Run run_backup to a database in tmp_path, returns the path of the database"""
+    from salt_portal_backup import run_backup
+
+    def run(name="backup.db", **backup_kwargs):
+        database_path = tmp_path / name
+        run_backup("standin", "standin", str(database_path), **backup_kwargs)
+        return database_path
+
+    return run
@@ -0,0 +1,50 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+import os
+
+import pytest
+
+from salt_portal_backup.archive import (
+    add_snapshot,
+    list_snapshots,
+    restore_snapshot,
+    run_backup_archive,
+)
+from salt_portal_backup.diff import diff_backups
+
+
+@pytest.mark.parametrize("storage_codec", ["none", "zstd"])
+def test_archive_restore(portal, backup, tmp_path, storage_codec):
+    database_path = backup(storage_codec=storage_codec)
+    archive_path = tmp_path / "archive.db"
+
+    add_snapshot(database_path, archive_path)
+    size = os.path.getsize(archive_path)
+    add_snapshot(database_path, archive_path)
+    assert os.path.getsize(archive_path) == size  # nothing new to store
+    assert list(list_snapshots(archive_path)["id"]) == [1, 2]
+
+    restored = tmp_path / "restored.db"
+    restore_snapshot(archive_path, restored, snapshot_id=1)
+    assert diff_backups(database_path, restored).empty
+
+
+def test_incremental_archive(portal, backup, tmp_path):
+    archive_path = tmp_path / "archive.db"
+    run_backup_archive("standin", "standin", archive_path)
+
+    station_id = portal.stations[0][1]
+    changed = portal.measurements[station_id][0]
+    changed["Modified"] = "2024-01-01 00:00:00"
+    portal.measurement_csvs[changed["ID"]] = b"Time,EC\r\n1,2\r\n"
+    summary = run_backup_archive("standin", "standin", archive_path, incremental=True)
+    assert summary["snapshot_id"] == 2
+
+    first, latest = tmp_path / "first.db", tmp_path / "latest.db"
+    restore_snapshot(archive_path, first, snapshot_id=1)
+    restore_snapshot(archive_path, latest)
+    assert diff_backups(backup("reference.db"), latest).empty
+    changes = diff_backups(first, latest)
+    assert set(changes["id"]) == {changed["ID"]}
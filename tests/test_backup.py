@@ -0,0 +1,273 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+import datetime
+import sqlite3
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import salt_portal_backup.salt_portal
+from salt_portal_backup.diff import diff_backups
+
+
+def count_rows(database_path, table):
+    with sqlite3.connect(database_path) as connection:
+        return connection.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+
+
+def test_full_backup(portal, backup):
+    database_path = backup()
+
+    n_measurements = sum(len(m) for m in portal.measurements.values())
+    n_calibrations = sum(len(c) for c in portal.calibrations.values())
+    assert count_rows(database_path, "project") == 2
+    assert count_rows(database_path, "station") == len(portal.stations)
+    assert count_rows(database_path, "measurement") == n_measurements
+    assert count_rows(database_path, "measurement_csv_data") == n_measurements
+    assert count_rows(database_path, "calibration") == n_calibrations
+    assert count_rows(database_path, "run_stats") == 1
+
+    with sqlite3.connect(database_path) as connection:
+        csv_data = connection.execute(
+            "SELECT csv_data FROM measurement_csv_data WHERE measurement_id = 1001"
+        ).fetchone()[0]
+    assert csv_data == portal.measurement_csvs[1001]
+
+
+@pytest.mark.parametrize(
+    "backup_kwargs",
+    [
+        {"storage_codec": "zlib"},
+        {"stream_downloads": True, "storage_codec": "zstd"},
+        {"parse_workers": 1, "parse_series": True},
+        {"parse_workers": 1, "stream_downloads": True, "parse_series": True},
+        {"max_workers": 4, "low_memory": True},
+    ],
+)
+def test_backup_modes_match(portal, backup, backup_kwargs):
+    reference = backup("reference.db")
+    database_path = backup(**backup_kwargs)
+    assert diff_backups(reference, database_path).empty
+
+
+@pytest.mark.parametrize("backup_kwargs", [{}, {"parse_workers": 1, "stream_downloads": True}])
+def test_incremental_backup(portal, backup, backup_kwargs):
+    database_path = backup(**backup_kwargs)
+
+    requests_before = portal.requests
+    backup(incremental=True, **backup_kwargs)
+    # only the login, the station list and the csv files of the unchanged stations
+    assert portal.requests - requests_before == 3 + 2 * len(portal.stations)
+
+    station_id = portal.stations[0][1]
+    changed, removed = portal.measurements[station_id][:2]
+    changed["Modified"] = "2024-01-01 00:00:00"
+    portal.measurement_csvs[changed["ID"]] = b"Time,EC\r\n1,2\r\n"
+    portal.measurements[station_id].remove(removed)
+
+    reference = backup("reference.db")
+    backup(incremental=True, **backup_kwargs)
+    assert diff_backups(reference, database_path).empty
+    assert count_rows(database_path, "run_stats") == 3
+
+
+def test_resume_interrupted_backup(portal, backup, monkeypatch):
+    store_station = salt_portal_backup.salt_portal.store_station
+    stored = []
+
+    def interrupted_store_station(*args, **kwargs):
+        if len(stored) == 2:
+            raise KeyboardInterrupt
+        store_station(*args, **kwargs)
+        stored.append(args[4])
+
+    monkeypatch.setattr(salt_portal_backup.salt_portal, "store_station", interrupted_store_station)
+    with pytest.raises(KeyboardInterrupt):
+        backup()
+    monkeypatch.setattr(salt_portal_backup.salt_portal, "store_station", store_station)
+
+    database_path = backup(resume=True)
+    assert count_rows(database_path, "station_checkpoint") == len(portal.stations)
+
+    reference = backup("reference.db")
+    assert diff_backups(reference, database_path).empty
+
+
+def test_incremental_backup_removes_many_measurements(make_portal, backup):
+    portal = make_portal(1, 1, 700, 1, n_samples=2)
+    database_path = backup()
+    portal.measurements[portal.stations[0][1]].clear()
+
+    def limit_variables(dbapi_connection, connection_record):
+        # below the number of removed measurements, as an SQLite built with a low limit
+        dbapi_connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 600)
+
+    event.listen(Engine, "connect", limit_variables)
+    try:
+        backup(incremental=True)
+    finally:
+        event.remove(Engine, "connect", limit_variables)
+
+    assert count_rows(database_path, "measurement") == 0
+    assert count_rows(database_path, "measurement_csv_data") == 0
+
+
+@pytest.mark.parametrize("engine", ["threads", "async"])
+def test_incremental_backup_removes_unlisted_stations(portal, backup, engine):
+    database_path = backup()
+
+    # a station of project 100 and all the stations of project 101
+    removed_station = portal.stations.pop(0)
+    portal.stations = [station for station in portal.stations if station[3] == 100]
+
+    if engine == "async":
+        import asyncio
+
+        from salt_portal_backup import run_backup_async
+
+        asyncio.run(run_backup_async("standin", "standin", str(database_path), incremental=True))
+    else:
+        backup(incremental=True, storage_codec="zlib")
+
+    reference = backup("reference.db")
+    assert diff_backups(reference, database_path).empty
+    with sqlite3.connect(database_path) as connection:
+        for table in ("measurement_raw", "calibration_raw", "calibration", "station_checkpoint"):
+            assert not connection.execute(
+                f"SELECT count(*) FROM {table} WHERE station_id = ?", (removed_station[1],)
+            ).fetchone()[0]
+        assert connection.execute("SELECT id FROM project").fetchall() == [(100,)]
+        assert connection.execute(
+            "SELECT count(*) FROM measurement_group WHERE id NOT IN "
+            "(SELECT group_id FROM measurement WHERE group_id IS NOT NULL)"
+        ).fetchone()[0] == 0
+
+
+def test_resume_completed_backup_starts_new_run(portal, backup):
+    database_path = backup()
+    station_id = portal.stations[0][1]
+    portal.measurements[station_id][0]["Modified"] = "2024-01-01 00:00:00"
+
+    backup(resume=True)
+    with sqlite3.connect(database_path) as connection:
+        run_ids = [row[0] for row in connection.execute("SELECT run_id FROM run_stats")]
+        stored_run_id = connection.execute("SELECT run_id FROM version").fetchone()[0]
+        modified = connection.execute(
+            "SELECT datetime_modified FROM measurement WHERE id = ?",
+            (portal.measurements[station_id][0]["ID"],),
+        ).fetchone()[0]
+    assert len(set(run_ids)) == 2
+    assert stored_run_id == run_ids[-1]
+    assert modified == "2024-01-01 00:00:00"
+
+
+def test_resume_with_other_storage_codec(portal, backup, monkeypatch):
+    def interrupted_store_station(*args, **kwargs):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(salt_portal_backup.salt_portal, "store_station", interrupted_store_station)
+    with pytest.raises(KeyboardInterrupt):
+        backup(storage_codec="zlib")
+    monkeypatch.undo()
+
+    with pytest.raises(ValueError, match="storage codec zlib"):
+        backup(resume=True, storage_codec="none")
+
+
+def test_parse_series(portal, backup):
+    portal.measurement_csvs[1002] = b"Time,EC\r\n0,100\r\n1.5,101\r\n"
+    database_path = backup(parse_series=True)
+    streamed_path = backup("streamed.db", parse_series=True, stream_downloads=True)
+
+    query = "SELECT * FROM measurement_series ORDER BY measurement_id, sample"
+    with sqlite3.connect(database_path) as connection:
+        series = connection.execute(query).fetchall()
+        start = connection.execute("SELECT datetime FROM measurement WHERE id = 1002").fetchone()[0]
+        absolute = connection.execute(
+            "SELECT datetime, time_s FROM measurement_series WHERE measurement_id = 1001 "
+            "AND sample = 5"
+        ).fetchone()
+        relative = connection.execute(
+            "SELECT datetime FROM measurement_series WHERE measurement_id = 1002 ORDER BY sample"
+        ).fetchall()
+    with sqlite3.connect(streamed_path) as connection:
+        assert connection.execute(query).fetchall() == series
+
+    # datetimes of the csv data as is, relative times from the datetime of the measurement
+    assert absolute == ("2023-05-01 10:00:05", 5.0)
+    start = datetime.datetime.fromisoformat(start)
+    assert [datetime.datetime.fromisoformat(dt) for (dt,) in relative] == [
+        start,
+        start + datetime.timedelta(seconds=1.5),
+    ]
+
+
+@pytest.mark.parametrize(
+    "max_workers, max_per_host, parse_workers, max_concurrency",
+    [(1, 4, 0, 1), (4, 8, 0, 4), (8, 2, 0, 2), (1, 4, 1, 3), (1, 4, 2, 4)],
+)
+def test_request_concurrency(
+    portal, backup, monkeypatch, max_workers, max_per_host, parse_workers, max_concurrency
+):
+    schedulers = []
+
+    class RecordedScheduler(salt_portal_backup.salt_portal.RequestScheduler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            schedulers.append(self)
+
+    monkeypatch.setattr(salt_portal_backup.salt_portal, "RequestScheduler", RecordedScheduler)
+    backup(max_workers=max_workers, max_per_host=max_per_host, parse_workers=parse_workers)
+    assert schedulers[0].concurrency.maximum == max_concurrency
+
+
+@pytest.mark.parametrize(
+    "max_concurrency, max_per_host, limit_per_host, request_concurrency",
+    [(16, None, 0, 16), (16, 4, 4, 4), (2, 4, 4, 2)],
+)
+def test_async_request_concurrency(
+    portal,
+    tmp_path,
+    monkeypatch,
+    max_concurrency,
+    max_per_host,
+    limit_per_host,
+    request_concurrency,
+):
+    import asyncio
+
+    import aiohttp
+
+    import salt_portal_backup.async_backup
+    from salt_portal_backup import run_backup_async
+
+    connectors = []
+    schedulers = []
+
+    class RecordedConnector(aiohttp.TCPConnector):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            connectors.append(self)
+
+    class RecordedScheduler(salt_portal_backup.async_backup.RequestScheduler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            schedulers.append(self)
+
+    monkeypatch.setattr(aiohttp, "TCPConnector", RecordedConnector)
+    monkeypatch.setattr(salt_portal_backup.async_backup, "RequestScheduler", RecordedScheduler)
+    asyncio.run(
+        run_backup_async(
+            "standin",
+            "standin",
+            str(tmp_path / "backup.db"),
+            max_concurrency=max_concurrency,
+            max_per_host=max_per_host,
+        )
+    )
+    assert connectors[0].limit == max_concurrency
+    assert connectors[0].limit_per_host == limit_per_host
+    assert schedulers[0].concurrency.maximum == request_concurrency
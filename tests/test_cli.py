@@ -0,0 +1,41 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+import pytest
+from click.testing import CliRunner
+
+import salt_portal_backup.async_backup
+from salt_portal_backup.backup import main
+
+
+@pytest.mark.parametrize(
+    "options, message",
+    [
+        (["--http_cache", "cache.db"], "--http_cache can not be used with --async"),
+        (["--stream_downloads"], "--stream_downloads can not be used with --async"),
+        (["--low_memory"], "--low_memory can not be used with --async"),
+        (["--max_workers", "4"], "--max_workers can not be used with --async"),
+    ],
+)
+def test_backup_options_not_supported_with_async(options, message):
+    result = CliRunner().invoke(
+        main, ["backup", "-u", "user", "-p", "password", "--async", *options]
+    )
+    assert result.exit_code == 2
+    assert message in result.output
+
+
+@pytest.mark.parametrize("options, max_per_host", [([], None), (["--max_per_host", "2"], 2)])
+def test_async_max_per_host(monkeypatch, options, max_per_host):
+    calls = []
+
+    async def run_backup_async(*args, **kwargs):
+        calls.append(kwargs)
+
+    monkeypatch.setattr(salt_portal_backup.async_backup, "run_backup_async", run_backup_async)
+    result = CliRunner().invoke(
+        main, ["backup", "-u", "user", "-p", "password", "--async", *options]
+    )
+    assert result.exit_code == 0, result.output
+    assert calls[0]["max_per_host"] == max_per_host
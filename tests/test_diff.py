@@ -0,0 +1,73 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+import hashlib
+import sqlite3
+
+import pytest
+
+from salt_portal_backup.diff import diff_backups, diff_summary
+
+
+def test_diff_backups(portal, backup):
+    old = backup("old.db", storage_codec="zlib")
+    assert diff_backups(old, old).empty
+
+    station_id = portal.stations[0][1]
+    changed, removed = portal.measurements[station_id][:2]
+    changed["Flow (cms)"] = 9.9
+    portal.measurements[station_id].remove(removed)
+    portal.measurement_csvs[changed["ID"]] = b"Time,EC\r\n1,2\r\n"
+    new = backup("new.db")
+
+    changes = diff_backups(old, new)
+    assert set(zip(changes["table"], changes["id"], changes["change"])) == {
+        ("measurement", changed["ID"], "changed"),
+        ("measurement", removed["ID"], "removed"),
+        ("measurement_csv_data", changed["ID"], "changed"),
+        ("measurement_csv_data", removed["ID"], "removed"),
+    }
+    assert (changes["station_id"] == station_id).all()
+
+    summary = diff_summary(changes)
+    assert summary.loc["measurement", "changed"] == 1
+    assert summary.loc["station"].sum() == 0
+
+
+def test_diff_backups_grouped_and_ungrouped(make_portal, backup):
+    # a station with grouped measurements only, the group column is parsed as integers
+    portal = make_portal(1, 1, 1, 1)
+    old = backup("old.db")
+
+    # an ungrouped measurement makes the group column floats, the grouped one is unchanged
+    station_id = portal.stations[0][1]
+    grouped = portal.measurements[station_id][0]
+    added = {**grouped, "ID": grouped["ID"] + 1, "group": ""}
+    portal.measurements[station_id].append(added)
+    portal.measurement_csvs[added["ID"]] = portal.measurement_csvs[grouped["ID"]]
+    new = backup("new.db")
+
+    changes = diff_backups(old, new)
+    assert changes[changes["id"] != added["ID"]].empty
+    assert set(zip(changes["table"], changes["change"])) == {
+        ("measurement", "added"),
+        ("measurement_csv_data", "added"),
+    }
+    assert diff_backups(new, backup("rerun.db")).empty
+
+
+@pytest.mark.parametrize(
+    "backup_kwargs",
+    [{}, {"storage_codec": "zstd"}, {"stream_downloads": True}],
+)
+def test_csv_data_hash_stored(portal, backup, backup_kwargs):
+    database_path = backup(**backup_kwargs)
+    with sqlite3.connect(database_path) as connection:
+        hashes = dict(
+            connection.execute("SELECT measurement_id, payload_sha256 FROM measurement_csv_data")
+        )
+    assert hashes == {
+        measurement_id: hashlib.sha256(csv_data).hexdigest()
+        for measurement_id, csv_data in portal.measurement_csvs.items()
+    }
@@ -0,0 +1,55 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+import sqlite3
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from salt_portal_backup.export import export_parquet  # noqa: E402
+
+
+def test_export_parquet(portal, backup, tmp_path):
+    database_path = backup(storage_codec="zstd")
+    output_dir = tmp_path / "parquet"
+    paths = export_parquet(database_path, output_dir, decode_series=True, batch_size=7)
+
+    measurements = pd.read_parquet(paths["measurement"])
+    assert sorted(measurements["id"]) == sorted(
+        m["ID"] for station in portal.measurements.values() for m in station
+    )
+    csv_data = pd.read_parquet(paths["measurement_csv_data"])
+    assert bytes(csv_data.set_index("measurement_id").loc[1001, "csv_data"]) == (
+        portal.measurement_csvs[1001]
+    )
+    series = pd.read_parquet(paths["measurement_series"])
+    assert series.groupby("measurement_id").size().eq(20).all()
+
+
+def test_export_parquet_many_stations(portal, backup, tmp_path):
+    database_path = backup()
+    # a measurement at each of more stations than the default partition limit of pyarrow
+    station_ids = range(10_000, 11_100)
+    with sqlite3.connect(database_path) as connection:
+        connection.executemany(
+            "INSERT INTO station (id, station_name, project_id, cft_1, cft_2, cft_3) "
+            "SELECT ?, station_name, project_id, cft_1, cft_2, cft_3 FROM station LIMIT 1",
+            [(station_id,) for station_id in station_ids],
+        )
+        columns = [
+            row[1]
+            for row in connection.execute("PRAGMA table_info(measurement)")
+            if row[1] not in ("id", "station_id")
+        ]
+        connection.executemany(
+            f"INSERT INTO measurement (id, station_id, {', '.join(columns)}) "
+            f"SELECT ?, ?, {', '.join(columns)} FROM measurement LIMIT 1",
+            [(100_000 + station_id, station_id) for station_id in station_ids],
+        )
+
+    paths = export_parquet(database_path, tmp_path / "parquet", tables=["measurement"])
+    measurements = pd.read_parquet(paths["measurement"])
+    assert measurements["station_id"].nunique() == len(portal.stations) + len(station_ids)
@@ -0,0 +1,32 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+import re
+import sqlite3
+
+import pytest
+
+from salt_portal_backup.diff import diff_backups
+
+
+@pytest.mark.parametrize("stream_downloads", [False, True])
+def test_http_cache_stores_downloads(make_portal, backup, tmp_path, stream_downloads):
+    portal = make_portal(1, 2, 3, 1, etags=True)
+    cache_path = tmp_path / "cache.db"
+    database_path = backup(http_cache=str(cache_path), stream_downloads=stream_downloads)
+
+    with sqlite3.connect(cache_path) as connection:
+        stored = dict(connection.execute("SELECT url, content FROM response").fetchall())
+    measurement_csvs = {
+        int(match.group(1)): content
+        for url, content in stored.items()
+        if (match := re.search(r"/measurement/(\d+)/csv-download", url))
+    }
+    assert measurement_csvs == portal.measurement_csvs
+
+    # the downloads of the second backup are revalidated and read from the cache
+    cached_path = backup(
+        "cached.db", http_cache=str(cache_path), stream_downloads=stream_downloads
+    )
+    assert diff_backups(database_path, cached_path).empty
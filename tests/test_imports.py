@@ -0,0 +1,34 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+import subprocess
+import sys
+
+import pytest
+
+# loaded only by the commands using them
+HEAVY_MODULES = (
+    "aiohttp",
+    "bs4",
+    "lxml",
+    "numpy",
+    "pandas",
+    "pyarrow",
+    "requests",
+    "sqlalchemy",
+    "tqdm",
+)
+
+
+@pytest.mark.parametrize("module", ["salt_portal_backup", "salt_portal_backup.backup"])
+def test_import_loads_no_heavy_modules(module):
+    # in a new process, the tests have already imported the engines
+    code = (
+        f"import sys, {module}; "
+        f"print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    )
+    assert result.stdout.split() == []
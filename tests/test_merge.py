@@ -0,0 +1,18 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+from salt_portal_backup.diff import diff_backups
+from salt_portal_backup.merge import merge_backups
+from salt_portal_backup.selection import StationSelection
+
+
+def test_merge_shards(portal, backup, tmp_path):
+    reference = backup("reference.db")
+    shards = [
+        backup(f"shard_{i}.db", selection=StationSelection(shard=f"{i}/2")) for i in (1, 2)
+    ]
+
+    merged = tmp_path / "merged.db"
+    merge_backups(shards, str(merged))
+    assert diff_backups(reference, merged).empty
@@ -0,0 +1,61 @@
+# SPDX-FileCopyrightText: 2024-present Reinert Huseby Karlsen <rhkarls@proton.me>
+#
+# SPDX-License-Identifier: BSD-3-Clause
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from salt_portal_backup.scheduler import RequestScheduler, ScheduledAdapter
+
+BODY = b"x" * 1000
+
+
+@pytest.fixture
+def truncating_server():
+    """Server closing the connection after 10 bytes of the body on the first request"""
+    calls = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            calls.append(self.path)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY if len(calls) > 1 else BODY[:10])
+            self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/file.csv", calls
+    server.shutdown()
+    server.server_close()
+
+
+def scheduled_session(max_retries):
+    session = requests.Session()
+    scheduler = RequestScheduler(max_retries=max_retries, backoff_base=0.01)
+    session.mount("http://", ScheduledAdapter(scheduler))
+    return session
+
+
+def test_truncated_body_is_retried(truncating_server):
+    url, calls = truncating_server
+    with scheduled_session(max_retries=2) as session:
+        response = session.get(url)
+    assert response.content == BODY
+    assert len(calls) == 2
+
+
+def test_truncated_body_without_retries(truncating_server):
+    url, calls = truncating_server
+    with scheduled_session(max_retries=0) as session, pytest.raises(
+        requests.exceptions.ChunkedEncodingError
+    ):
+        session.get(url)
+    assert len(calls) == 1